@@ -0,0 +1,221 @@
+#! -*- coding: utf-8 -*-
+# 权重转换工具：按声明式的规则逐个tensor转换，源权重mmap加载，输出边转换边分片保存
+# 避免像之前的转换脚本那样同时持有新旧两份完整的权重
+
+import os
+import re
+import json
+import warnings
+import torch
+from bert4torch.snippets import load_checkpoint, parse_size, compact_tensor
+
+
+def transpose(w):
+    return w.T
+
+
+def chunk(chunks, dim=0, transposed=False):
+    '''把合并的权重(如qkv)拆分为chunks份, transposed=True时每份再转置
+    '''
+    def fn(w):
+        ws = torch.chunk(w, chunks, dim=dim)
+        return tuple(w.T for w in ws) if transposed else ws
+    return fn
+
+
+def swap_first_tokens(w):
+    '''交换词表中前两个token的embedding, 如CDial-GPT的[CLS]是0、[PAD]是1
+    '''
+    return torch.cat([w[1:2], w[:1], w[2:]], dim=0)
+
+
+# ========================= 各模型的转换规则 =========================
+# 每条规则为(源key正则, 目标key或目标key列表, 变换函数), 变换函数可省略
+# 按顺序取第一条fullmatch的规则, 目标key中的{}依次填入正则的分组; 目标key为列表时变换函数需返回同样个数的tensor
+
+def bert_rules():
+    '''huggingface的bert-base-chinese, LayerNorm用的是gamma/beta
+    '''
+    return [
+        (r'(.*)LayerNorm\.gamma', '{}LayerNorm.weight'),
+        (r'(.*)LayerNorm\.beta', '{}LayerNorm.bias'),
+        (r'(.*)', '{}'),
+    ]
+
+
+def gpt2_rules(prefix='gpt2', src_prefix='transformer.'):
+    '''gpt2系列(Conv1D的权重需要转置), 适用于CPM-Generate、gpt2-ml、CDial-GPT
+    '''
+    src = re.escape(src_prefix)
+    layer = f'{prefix}.encoder.layer.{{}}.'
+    qkv = ['query', 'key', 'value']
+    return [
+        (src + r'wte\.weight', f'{prefix}.embeddings.word_embeddings.weight'),
+        (src + r'wpe\.weight', f'{prefix}.embeddings.position_embeddings.weight'),
+        (src + r'emb_norm\.(weight|bias)', f'{prefix}.embeddings.LayerNorm.{{}}'),
+        (src + r'h\.(\d+)\.attn\.c_attn\.weight', [layer + f'attention.self.{k}.weight' for k in qkv], chunk(3, dim=1, transposed=True)),
+        (src + r'h\.(\d+)\.attn\.c_attn\.bias', [layer + f'attention.self.{k}.bias' for k in qkv], chunk(3, dim=0)),
+        (src + r'h\.(\d+)\.attn\.c_proj\.weight', layer + 'attention.output.dense.weight', transpose),
+        (src + r'h\.(\d+)\.attn\.c_proj\.bias', layer + 'attention.output.dense.bias'),
+        (src + r'h\.(\d+)\.ln_1\.(weight|bias)', layer + 'attention.output.LayerNorm.{}'),
+        (src + r'h\.(\d+)\.mlp\.c_fc\.weight', layer + 'intermediate.dense.weight', transpose),
+        (src + r'h\.(\d+)\.mlp\.c_fc\.bias', layer + 'intermediate.dense.bias'),
+        (src + r'h\.(\d+)\.mlp\.c_proj\.weight', layer + 'output.dense.weight', transpose),
+        (src + r'h\.(\d+)\.mlp\.c_proj\.bias', layer + 'output.dense.bias'),
+        (src + r'h\.(\d+)\.ln_2\.(weight|bias)', layer + 'output.LayerNorm.{}'),
+        (src + r'ln_f\.(weight|bias)', f'{prefix}.LayerNormFinal.{{}}'),
+    ]
+
+
+def gpt2_ml_rules():
+    return gpt2_rules(prefix='gpt2_ml', src_prefix='')
+
+
+def cdial_gpt_rules():
+    return [
+        (r'transformer\.tokens_embed\.weight', 'gpt.embeddings.word_embeddings.weight', swap_first_tokens),
+        (r'transformer\.positions_embed\.weight', 'gpt.embeddings.position_embeddings.weight'),
+    ] + gpt2_rules(prefix='gpt', src_prefix='transformer.')
+
+
+def transformer_xl_rules():
+    layer = 'encoderLayer.{}.'
+    return [
+        (r'transformer\.word_emb\.(emb_layers\.\d+\.weight|emb_projs\.\d+)', 'embeddings.{}'),
+        (r'transformer\.layers\.(\d+)\.dec_attn\.qkv_net\.weight', [layer + f'multiHeadAttention.{k}.weight' for k in 'qkv'], chunk(3, dim=0)),
+        (r'transformer\.layers\.(\d+)\.dec_attn\.(r_r_bias|r_w_bias)', layer + 'multiHeadAttention.{}'),
+        (r'transformer\.layers\.(\d+)\.dec_attn\.o_net\.weight', layer + 'multiHeadAttention.o.weight'),
+        (r'transformer\.layers\.(\d+)\.dec_attn\.r_net\.weight', layer + 'multiHeadAttention.r.weight'),
+        (r'transformer\.layers\.(\d+)\.dec_attn\.layer_norm\.(weight|bias)', layer + 'layerNorm1.{}'),
+        (r'transformer\.layers\.(\d+)\.pos_ff\.CoreNet\.0\.(weight|bias)', layer + 'feedForward.intermediateDense.{}'),
+        (r'transformer\.layers\.(\d+)\.pos_ff\.CoreNet\.3\.(weight|bias)', layer + 'feedForward.outputDense.{}'),
+        (r'transformer\.layers\.(\d+)\.pos_ff\.layer_norm\.(weight|bias)', layer + 'layerNorm2.{}'),
+    ]
+
+
+def bart_cloudwalk_rules():
+    rules = [
+        (r'bart\.embeddings\.word_embeddings\.weight', 'encoder.embed_tokens.weight'),
+        (r'bart\.embeddings\.position_embeddings\.weight', 'encoder.embed_positions.weight'),
+        (r'bart\.embeddings\.LayerNorm\.(weight|bias)', 'encoder.layernorm_embedding.{}'),
+    ]
+    attentions = [('encoder', 'encoder_layer', 'attention', 'self_attn'),
+                  ('decoder', 'decoder_layer', 'attention', 'self_attn'),
+                  ('decoder', 'decoder_layer', 'crossattention', 'encoder_attn')]
+    for stack, src_layer, src_attn, attn in attentions:
+        src = rf'bart\.{stack}\.{src_layer}\.(\d+)\.{src_attn}\.'
+        layer = f'{stack}.layers.{{}}.'
+        rules += [
+            (src + r'self\.(q|k|v)[a-z]*\.(weight|bias)', layer + attn + '.{}_proj.{}'),
+            (src + r'output\.dense\.(weight|bias)', layer + attn + '.out_proj.{}'),
+            (src + r'output\.LayerNorm\.(weight|bias)', layer + attn + '_layer_norm.{}'),
+        ]
+    for stack, src_layer in [('encoder', 'encoder_layer'), ('decoder', 'decoder_layer')]:
+        src = rf'bart\.{stack}\.{src_layer}\.(\d+)\.'
+        layer = f'{stack}.layers.{{}}.'
+        rules += [
+            (src + r'intermediate\.dense\.(weight|bias)', layer + 'fc1.{}'),
+            (src + r'output\.dense\.(weight|bias)', layer + 'fc2.{}'),
+            (src + r'output\.LayerNorm\.(weight|bias)', layer + 'final_layer_norm.{}'),
+        ]
+    return rules
+
+
+CONVERT_RULES = {
+    'bert': bert_rules,
+    'gpt2': gpt2_rules,
+    'gpt2_ml': gpt2_ml_rules,
+    'cdial_gpt': cdial_gpt_rules,
+    'transformer_xl': transformer_xl_rules,
+    'bart_cloudwalk': bart_cloudwalk_rules,
+}
+
+
+class ShardedCheckpointWriter(object):
+    '''边转换边写出的分片保存, 文件格式与snippets.save_sharded_state_dict一致
+    总分片数要写完才知道, 因此先以临时文件名保存, close时再重命名为{name}-00001-of-00003{ext}
+    '''
+    def __init__(self, save_path, max_shard_size='2GB'):
+        self.save_path = save_path
+        self.max_shard_size = None if max_shard_size is None else parse_size(max_shard_size)
+        self.save_dir, file_name = os.path.split(save_path)
+        self.stem, self.ext = os.path.splitext(file_name)
+        self.shard, self.shard_size, self.shard_group = {}, 0, None
+        self.shard_files, self.weight_map, self.total_size = [], {}, 0
+
+    def add(self, name, tensor):
+        tensor = compact_tensor(tensor.contiguous())
+        size = tensor.numel() * tensor.element_size()
+        group = name.rsplit('.', 2)[0]
+        # 同一个模块下的权重(如q/k/v)不会被拆到不同分片
+        if (self.max_shard_size is not None) and self.shard and (group != self.shard_group) and \
+            (self.shard_size + size > self.max_shard_size):
+            self.flush()
+        self.shard[name] = tensor
+        self.shard_size += size
+        self.total_size += size
+        self.shard_group = group
+
+    def flush(self):
+        shard_file = f'{self.stem}-{len(self.shard_files)+1:05d}{self.ext}.tmp'
+        torch.save(self.shard, os.path.join(self.save_dir, shard_file))
+        self.weight_map.update({name: len(self.shard_files) for name in self.shard})
+        self.shard_files.append(shard_file)
+        self.shard, self.shard_size = {}, 0
+
+    def close(self):
+        '''写出剩余的权重, 返回保存的文件路径(分片时为索引文件)
+        '''
+        if self.max_shard_size is None:
+            torch.save(self.shard, self.save_path)
+            return self.save_path
+
+        if self.shard:
+            self.flush()
+        shard_names = [f'{self.stem}-{i+1:05d}-of-{len(self.shard_files):05d}{self.ext}' for i in range(len(self.shard_files))]
+        for tmp_file, shard_file in zip(self.shard_files, shard_names):
+            os.replace(os.path.join(self.save_dir, tmp_file), os.path.join(self.save_dir, shard_file))
+
+        index = {'metadata': {'total_size': self.total_size},
+                 'weight_map': {name: shard_names[i] for name, i in self.weight_map.items()}}
+        with open(self.save_path + '.index.json', 'w', encoding='utf-8') as f:
+            json.dump(index, f, indent=2, ensure_ascii=False)
+        return self.save_path + '.index.json'
+
+
+def convert_checkpoint(checkpoint, save_path, rules, max_shard_size='2GB', strict=False, **kwargs):
+    '''按rules逐个tensor转换checkpoint, 内存中最多只有一个输出分片
+    checkpoint: 源权重, 支持.bin/.safetensors/分片索引, 均以mmap方式加载
+    rules: CONVERT_RULES中的名称(kwargs传给规则函数), 或者[(源key正则, 目标key, 变换函数)]
+    max_shard_size: 输出的分片大小, 为None时保存为单个文件
+    strict: 源权重中存在没有匹配规则的key时是否报错, 否则仅警告并跳过
+    '''
+    if isinstance(rules, str):
+        rules = CONVERT_RULES[rules](**kwargs)
+    rules = [(re.compile(rule[0]), rule[1], rule[2] if len(rule) > 2 else None) for rule in rules]
+
+    source = load_checkpoint(checkpoint, mmap=True)
+    writer = ShardedCheckpointWriter(save_path, max_shard_size)
+    unmatched_keys = []
+    for name in source:
+        for pattern, target, fn in rules:
+            match = pattern.fullmatch(name)
+            if match:
+                break
+        else:
+            unmatched_keys.append(name)
+            continue
+
+        with torch.no_grad():
+            tensors = source[name] if fn is None else fn(source[name])
+        if isinstance(target, str):
+            target, tensors = [target], [tensors]
+        assert len(target) == len(tensors), f'{name} is converted to {len(tensors)} tensors, but {len(target)} keys given'
+        for key, tensor in zip(target, tensors):
+            writer.add(key.format(*match.groups()), tensor)
+
+    if unmatched_keys:
+        if strict:
+            raise ValueError(f'No convert rule matched keys: {unmatched_keys}')
+        warnings.warn(f'Skip keys without convert rule: {unmatched_keys}')
+    return writer.close()
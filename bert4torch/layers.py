@@ -3,7 +3,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
 import math
-from bert4torch.snippets import get_sinusoid_encoding_table
+from typing import Optional
+from bert4torch.snippets import get_sinusoid_encoding_table, pad_input, unpad_input
 from bert4torch.activations import get_activation
 
 
@@ -17,10 +18,17 @@ class LayerNorm(nn.Module):
         # 兼容roformer_v2不包含weight
         if weight:
             self.weight = nn.Parameter(torch.ones(hidden_size))
+        else:
+            self.register_parameter('weight', None)
         # 兼容t5不包含bias项, 和t5使用的RMSnorm
         if bias:
             self.bias = nn.Parameter(torch.zeros(hidden_size))
+        else:
+            self.register_parameter('bias', None)
         self.norm_mode = norm_mode
+        self.normalized_shape = (hidden_size,)
+        # fused_ops时非条件layernorm直接调用F.layer_norm, 不再逐步计算均值方差
+        self.fused_ops = kwargs.get('fused_ops', False)
 
         self.eps = eps
         self.conditional_size = conditional_size
@@ -35,27 +43,56 @@ class LayerNorm(nn.Module):
     def forward(self, x):
         inputs = x[0]
 
+        if self.fused_ops and (not self.conditional_size):
+            if self.norm_mode == 'rmsnorm':
+                return rms_norm(inputs, self.weight, self.bias, self.eps)
+            return F.layer_norm(inputs, self.normalized_shape, self.weight, self.bias, self.eps)
+
         if self.norm_mode == 'rmsnorm':
             # t5使用的是RMSnorm
             variance = inputs.to(torch.float32).pow(2).mean(-1, keepdim=True)
-            o = inputs * torch.rsqrt(variance + self.eps)
+            o = (inputs * torch.rsqrt(variance + self.eps)).to(inputs.dtype)
         else:
-            u = inputs.mean(-1, keepdim=True)
-            s = (inputs - u).pow(2).mean(-1, keepdim=True)
-            o = (inputs - u) / torch.sqrt(s + self.eps)
+            # fp16/bf16(如autocast)时均值方差在float32下计算，避免精度损失
+            hidden = inputs.float() if inputs.dtype in {torch.float16, torch.bfloat16} else inputs
+            u = hidden.mean(-1, keepdim=True)
+            s = (hidden - u).pow(2).mean(-1, keepdim=True)
+            o = ((hidden - u) / torch.sqrt(s + self.eps)).to(inputs.dtype)
 
-        if not hasattr(self, 'weight'):
-            self.weight = 1
-        if not hasattr(self, 'bias'):
-            self.bias = 0
+        weight = 1 if self.weight is None else self.weight
+        bias = 0 if self.bias is None else self.bias
 
         if self.conditional_size:
             cond = x[1]
             for _ in range(len(inputs.shape) - len(cond.shape)):
                 cond = cond.unsqueeze(dim=1)
-            return (self.weight + self.dense1(cond)) * o + (self.bias + self.dense2(cond))
+            return (weight + self.dense1(cond)) * o + (bias + self.dense2(cond))
         else:
-            return self.weight * o + self.bias
+            return weight * o + bias
+
+
+def rms_norm(x, weight: Optional[torch.Tensor], bias: Optional[torch.Tensor], eps: float):
+    """t5使用的RMSnorm, 方差在fp32下计算
+    """
+    variance = x.to(torch.float32).pow(2).mean(-1, keepdim=True)
+    o = (x * torch.rsqrt(variance + eps)).to(x.dtype)
+    if weight is not None:
+        o = weight * o
+    if bias is not None:
+        o = o + bias
+    return o
+
+
+def dropout_add(x, residual, p: float, training: bool):
+    """dropout和残差连接, 不需要梯度且dtype、shape一致时原地加到x上, 少分配一个tensor
+       x为attention/ffn新计算出的输出, 不会被其他地方引用
+       autocast下x可能是半精度而residual是fp32, 此时不能原地加(会把残差降为半精度), 走普通的加法做类型提升
+    """
+    if training and p > 0:
+        x = F.dropout(x, p=p, training=True)
+    elif (not torch.is_grad_enabled()) and (x.dtype == residual.dtype) and (x.shape == residual.shape):
+        return x.add_(residual)
+    return residual + x
 
 
 class MultiHeadAttentionLayer(nn.Module):
@@ -72,9 +109,17 @@ class MultiHeadAttentionLayer(nn.Module):
         self.return_attention_scores = return_attention_scores
 
         self.bias = bias
-        self.q = nn.Linear(hidden_size, hidden_size, bias=bias)
-        self.k = nn.Linear(hidden_size, hidden_size, bias=bias)
-        self.v = nn.Linear(hidden_size, hidden_size, bias=bias)
+        # attn_impl='sdpa'时q/k/v合并为一个Linear, 并使用F.scaled_dot_product_attention计算attention
+        self.attn_impl = kwargs.get('attn_impl')
+        if self.attn_impl == 'sdpa':
+            self.qkv = nn.Linear(hidden_size, hidden_size * 3, bias=bias)
+            # state_dict中仍拆分为q/k/v, 以兼容原有的checkpoint和variable_mapping
+            self._register_state_dict_hook(self._split_qkv_state_dict)
+            self._register_load_state_dict_pre_hook(self._merge_qkv_state_dict)
+        else:
+            self.q = nn.Linear(hidden_size, hidden_size, bias=bias)
+            self.k = nn.Linear(hidden_size, hidden_size, bias=bias)
+            self.v = nn.Linear(hidden_size, hidden_size, bias=bias)
         self.o = nn.Linear(hidden_size, hidden_size, bias=bias)
         self.dropout = nn.Dropout(attention_probs_dropout_prob)
 
@@ -93,60 +138,151 @@ class MultiHeadAttentionLayer(nn.Module):
                                                                   relative_attention_num_buckets=kwargs.get('relative_attention_num_buckets'), 
                                                                   is_decoder=kwargs.get('is_decoder'))
             self.relative_positions_encoding = nn.Embedding(kwargs.get('relative_attention_num_buckets'), self.num_attention_heads)
+            self._position_bias_cache = None  # 推理时缓存的(cache_key, position_bias)
 
     def transpose_for_scores(self, x):
         new_x_shape = x.size()[:-1] + (self.num_attention_heads, self.attention_head_size)
         x = x.view(*new_x_shape)
         return x.permute(0, 2, 1, 3)
 
-    def forward(self, hidden_states, attention_mask=None, encoder_hidden_states=None, encoder_attention_mask=None):
+    @staticmethod
+    def _split_qkv_state_dict(module, state_dict, prefix, local_metadata):
+        """保存时将qkv拆分成q/k/v
+        """
+        for name in ['weight', 'bias']:
+            if prefix + 'qkv.' + name in state_dict:
+                for k, v in zip(['q', 'k', 'v'], state_dict.pop(prefix + 'qkv.' + name).chunk(3, dim=0)):
+                    state_dict[prefix + k + '.' + name] = v
+        return state_dict
+
+    @staticmethod
+    def _merge_qkv_state_dict(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        """加载时将q/k/v合并成qkv, q/k/v不全时不做处理
+        """
+        for name in ['weight', 'bias']:
+            keys = [prefix + k + '.' + name for k in ['q', 'k', 'v']]
+            if all(k in state_dict for k in keys):
+                state_dict[prefix + 'qkv.' + name] = torch.cat([state_dict.pop(k) for k in keys], dim=0)
+
+    def project_qkv(self, hidden_states, encoder_hidden_states=None, query_only=False):
+        """计算q/k/v, encoder_hidden_states不为None时k/v由encoder_hidden_states计算
+        """
+        if self.attn_impl != 'sdpa':
+            if query_only:
+                return self.q(hidden_states)
+            kv_states = hidden_states if encoder_hidden_states is None else encoder_hidden_states
+            return self.q(hidden_states), self.k(kv_states), self.v(kv_states)
+        elif (encoder_hidden_states is None) and (not query_only):
+            # self attention一次矩阵乘法得到q/k/v
+            return self.qkv(hidden_states).chunk(3, dim=-1)
+
+        # cross attention时按行切分qkv的权重, 切片不产生拷贝
+        weight, bias = self.qkv.weight, self.qkv.bias
+        mixed_query_layer = F.linear(hidden_states, weight[:self.hidden_size], None if bias is None else bias[:self.hidden_size])
+        if query_only:
+            return mixed_query_layer
+        mixed_kv_layer = F.linear(encoder_hidden_states, weight[self.hidden_size:], None if bias is None else bias[self.hidden_size:])
+        return (mixed_query_layer,) + mixed_kv_layer.chunk(2, dim=-1)
+
+    def get_position_bias(self, query_len, key_len):
+        """t5_relative的位置偏置[1, num_attention_heads, query_len, key_len], 由第一层计算后各层共享
+           不需要梯度时按(query_len, key_len, device)缓存, 权重更新后自动失效
+           增量解码时query_len < key_len, 只计算最后query_len个位置的偏置, 且不占用完整序列的缓存
+        """
+        weight = self.relative_positions_encoding.weight
+        cache_key = (query_len, key_len, weight.device, weight.dtype, weight._version)
+        use_cache = (not torch.is_grad_enabled()) and (query_len == key_len)
+        if use_cache and (self._position_bias_cache is not None) and (self._position_bias_cache[0] == cache_key):
+            return self._position_bias_cache[1]
+
+        relations_keys = self.relative_positions.get_relative_positions(query_len, key_len)
+        position_bias = self.relative_positions_encoding(relations_keys).permute([2, 0, 1]).unsqueeze(0)
+        if use_cache:
+            self._position_bias_cache = (cache_key, position_bias)
+        return position_bias
+
+    def use_sdpa(self):
+        """是否走F.scaled_dot_product_attention, 需要额外relative position项或返回attention_scores时回退到原实现
+        """
+        if (self.attn_impl != 'sdpa') or (not hasattr(F, 'scaled_dot_product_attention')) or self.return_attention_scores:
+            return False
+        return not ((self.p_bias in {'typical_relative', 't5_relative'}) and hasattr(self, 'relative_positions_encoding'))
+
+    def forward(self, hidden_states, attention_mask=None, encoder_hidden_states=None, encoder_attention_mask=None, past_key_value=None, use_states=False,
+                unpad_indices=None, position_bias=None):
         # hidden_states shape: [batch_size, seq_q, hidden_size]
-        # attention_mask shape: [batch_size, 1, 1, seq_q] 或者 [batch_size, 1, seq_q, seq_q]
+        # attention_mask shape: [batch_size, 1, 1, seq_q] 或者 [batch_size, 1, seq_q, seq_q], 为加性mask(可见为0, 不可见为-10000)
         # encoder_hidden_states shape: [batch_size, seq_k, hidden_size]
         # encoder_attention_mask shape: [batch_size, 1, 1, seq_k]
-
-        mixed_query_layer = self.q(hidden_states)
-        if encoder_hidden_states is not None:
-            mixed_key_layer = self.k(encoder_hidden_states)
-            mixed_value_layer = self.v(encoder_hidden_states)
+        # past_key_value: 增量解码时缓存的(key, value), shape均为[batch_size, num_attention_heads, past_len, attention_head_size]
+        # use_states: 是否额外返回当前的(key, value), 用于下一步解码
+        # unpad_indices: 不为None时hidden_states为去除padding后的[total_tokens, hidden_size], 仅在计算attention时恢复成padding格式
+        # position_bias: t5_relative时外部预先计算好的位置偏置, 为None时在本层计算
+
+        if (encoder_hidden_states is not None) and (past_key_value is not None):
+            # cross attention的key和value仅由encoder决定，解码过程中不变，直接复用缓存
+            mixed_query_layer = self.project_qkv(hidden_states, query_only=True)
+            query_layer = self.transpose_for_scores(mixed_query_layer)
+            key_layer, value_layer = past_key_value
             attention_mask = encoder_attention_mask
         else:
-            mixed_key_layer = self.k(hidden_states)
-            mixed_value_layer = self.v(hidden_states)
-        # mixed_query_layer shape: [batch_size, query_len, hidden_size]
-        # mixed_query_layer shape: [batch_size, key_len, hidden_size]
-        # mixed_query_layer shape: [batch_size, value_len, hidden_size]
-
-        query_layer = self.transpose_for_scores(mixed_query_layer)
-        key_layer = self.transpose_for_scores(mixed_key_layer)
-        value_layer = self.transpose_for_scores(mixed_value_layer)
-        # query_layer shape: [batch_size, num_attention_heads, query_len, attention_head_size]
-        # key_layer shape: [batch_size, num_attention_heads, key_len, attention_head_size]
-        # value_layer shape: [batch_size, num_attention_heads, value_len, attention_head_size]
-
-        if self.p_bias == 'rotary':
-            query_layer = self.relative_positions_encoding(query_layer)
-            key_layer = self.relative_positions_encoding(key_layer)
+            mixed_query_layer, mixed_key_layer, mixed_value_layer = self.project_qkv(hidden_states, encoder_hidden_states)
+            if unpad_indices is not None:
+                batch_size, seq_len = attention_mask.size(0), attention_mask.size(-1)
+                mixed_query_layer, mixed_key_layer, mixed_value_layer = [pad_input(i, unpad_indices, batch_size, seq_len) 
+                                                                         for i in [mixed_query_layer, mixed_key_layer, mixed_value_layer]]
+            if encoder_hidden_states is not None:
+                attention_mask = encoder_attention_mask
+            query_layer = self.transpose_for_scores(mixed_query_layer)
+            # query_layer shape: [batch_size, num_attention_heads, query_len, attention_head_size]
+            key_layer = self.transpose_for_scores(mixed_key_layer)
+            value_layer = self.transpose_for_scores(mixed_value_layer)
+            # key_layer shape: [batch_size, num_attention_heads, key_len, attention_head_size]
+            # value_layer shape: [batch_size, num_attention_heads, value_len, attention_head_size]
+
+            # self attention时，新token的位置需要从past_len开始计算
+            past_len = past_key_value[0].size(2) if past_key_value is not None else 0
+            if self.p_bias == 'rotary':
+                query_layer = self.relative_positions_encoding(query_layer, offset=past_len)
+                key_layer = self.relative_positions_encoding(key_layer, offset=past_len)
+
+            # 拼接历史的key和value
+            if past_key_value is not None:
+                key_layer = torch.cat([past_key_value[0], key_layer], dim=2)
+                value_layer = torch.cat([past_key_value[1], value_layer], dim=2)
+
+        if self.use_sdpa():
+            context_layer = self.sdpa_attention(query_layer, key_layer, value_layer, attention_mask)
+            context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
+            context_layer = context_layer.view(*(context_layer.size()[:-2] + (self.hidden_size,)))
+            if unpad_indices is not None:
+                context_layer = unpad_input(context_layer, unpad_indices)
+            outputs = self.o(context_layer)
+            return (outputs, (key_layer, value_layer)) if use_states else outputs
 
         # 交换k的最后两个维度，然后q和k执行点积, 获得attention score
         attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
 
         # attention_scores shape: [batch_size, num_attention_heads, query_len, key_len]
+        query_len, key_len = attention_scores.shape[-2:]
         if (self.p_bias == 'typical_relative') and hasattr(self, 'relative_positions_encoding'):
-            relations_keys = self.relative_positions_encoding(attention_scores.shape[-1], attention_scores.shape[-1])  # [to_seq_len, to_seq_len, d_hid]
+            # 有缓存时query_len < key_len, query对应最后query_len个位置
             # 旧实现，方便读者理解维度转换
             # query_layer_t = query_layer.permute(2, 0, 1, 3)
             # query_layer_r = query_layer_t.contiguous().view(from_seq_length, batch_size * num_attention_heads, self.attention_head_size)
             # key_position_scores = torch.matmul(query_layer_r, relations_keys.permute(0, 2, 1))
             # key_position_scores_r = key_position_scores.view(from_seq_length, batch_size, num_attention_heads, from_seq_length)
             # key_position_scores_r_t = key_position_scores_r.permute(1, 2, 0, 3)
-            # 新实现
-            key_position_scores_r_t = torch.einsum('bnih,ijh->bnij', query_layer, relations_keys)
+            # 中间实现, relations_keys为[to_seq_len, to_seq_len, d_hid]的完整编码
+            # relations_keys = self.relative_positions_encoding(key_len, key_len)[-query_len:]
+            # key_position_scores_r_t = torch.einsum('bnih,ijh->bnij', query_layer, relations_keys)
+            # 新实现，直接使用[2*max_relative_position+1, d_hid]的编码表
+            key_position_scores_r_t = self.relative_positions_encoding.key_position_scores(query_layer, key_len)
             attention_scores = attention_scores + key_position_scores_r_t
         elif (self.p_bias == 't5_relative') and hasattr(self, 'relative_positions_encoding'):
-            relations_keys = self.relative_positions(attention_scores.shape[-1], attention_scores.shape[-1])
-            key_position_scores_r_t = self.relative_positions_encoding(relations_keys).permute([2, 0, 1]).unsqueeze(0)
-            attention_scores = attention_scores + key_position_scores_r_t
+            if position_bias is None:
+                position_bias = self.get_position_bias(query_len, key_len)
+            attention_scores = attention_scores + position_bias
 
         # 是否进行attention scale
         if self.attention_scale:
@@ -155,7 +291,8 @@ class MultiHeadAttentionLayer(nn.Module):
         # 值为-1e10，经过softmax后，attention_probs几乎为0，所以不会attention到mask为0的部分
         if attention_mask is not None:
             # attention_scores = attention_scores.masked_fill(attention_mask == 0, -1e10)
-            attention_mask = (1.0 - attention_mask) * -10000.0  # 所以传入的mask的非padding部分为1, padding部分为0
+            # attention_mask = (1.0 - attention_mask) * -10000.0  # 所以传入的mask的非padding部分为1, padding部分为0
+            # 传入的已是在apply_embeddings中转换好的加性mask, 非padding部分为0, padding部分为-10000
             attention_scores = attention_scores + attention_mask
 
         # 将attention score 归一化到0-1
@@ -164,15 +301,17 @@ class MultiHeadAttentionLayer(nn.Module):
         context_layer = torch.matmul(attention_probs, value_layer)  # [batch_size, num_attention_heads, query_len, attention_head_size]
 
         if (self.p_bias == 'typical_relative') and hasattr(self, 'relative_positions_encoding'):
-            relations_values = self.relative_positions_encoding(attention_scores.shape[-1], attention_scores.shape[-1])
             # 旧实现，方便读者理解维度转换
             # attention_probs_t = attention_probs.permute(2, 0, 1, 3)
             # attentions_probs_r = attention_probs_t.contiguous().view(from_seq_length, batch_size * num_attention_heads, to_seq_length)
             # value_position_scores = torch.matmul(attentions_probs_r, relations_values)
             # value_position_scores_r = value_position_scores.view(from_seq_length, batch_size, num_attention_heads, self.attention_head_size)
             # value_position_scores_r_t = value_position_scores_r.permute(1, 2, 0, 3)
+            # 中间实现
+            # relations_values = self.relative_positions_encoding(key_len, key_len)[-query_len:]
+            # value_position_scores_r_t = torch.einsum('bnij,ijh->bnih', attention_probs, relations_values)
             # 新实现
-            value_position_scores_r_t = torch.einsum('bnij,ijh->bnih', attention_probs, relations_values)
+            value_position_scores_r_t = self.relative_positions_encoding.value_position_scores(attention_probs)
             context_layer = context_layer + value_position_scores_r_t
 
         # context_layer shape: [batch_size, query_len, num_attention_heads, attention_head_size]
@@ -182,13 +321,30 @@ class MultiHeadAttentionLayer(nn.Module):
 
         new_context_layer_shape = context_layer.size()[:-2] + (self.hidden_size,)
         context_layer = context_layer.view(*new_context_layer_shape)
+        if unpad_indices is not None:
+            context_layer = unpad_input(context_layer, unpad_indices)
 
         # 是否返回attention scores
         if self.return_attention_scores:
             # 这里返回的attention_scores没有经过softmax, 可在外部进行归一化操作
-            return self.o(context_layer), attention_scores
+            outputs = (self.o(context_layer), attention_scores)
         else:
-            return self.o(context_layer)
+            outputs = self.o(context_layer)
+
+        # 增量解码时额外返回拼接后的key和value
+        return (outputs, (key_layer, value_layer)) if use_states else outputs
+
+    def sdpa_attention(self, query_layer, key_layer, value_layer, attention_mask=None):
+        """使用F.scaled_dot_product_attention计算attention, 避免单独物化mask/softmax/dropout的中间结果
+        """
+        if attention_mask is not None:
+            # 传入的已是additive mask
+            attention_mask = attention_mask.to(query_layer.dtype)
+        if not self.attention_scale:
+            # sdpa内部固定除以sqrt(d), 这里预先乘回去
+            query_layer = query_layer * math.sqrt(self.attention_head_size)
+        dropout_p = self.dropout.p if self.training else 0.0
+        return F.scaled_dot_product_attention(query_layer, key_layer, value_layer, attn_mask=attention_mask, dropout_p=dropout_p)
 
 
 class PositionWiseFeedForward(nn.Module):
@@ -266,7 +422,8 @@ class GatedAttentionUnit(nn.Module):
              attention_scores = attention_scores / math.sqrt(self.attention_head_size)
 
         if attention_mask is not None:
-            attention_mask = (1.0 - attention_mask) * -1e12
+            # 传入的是加性mask(padding部分为-10000)，这里仍使用-1e12，以便attention_normalize中统计有效长度
+            attention_mask = (attention_mask < 0).to(attention_scores.dtype) * -1e12
             attention_scores = attention_scores + attention_mask.squeeze(1)
 
         # 归一化
@@ -348,7 +505,7 @@ class BertEmbeddings(nn.Module):
         if embedding_size != hidden_size:
             self.embedding_hidden_mapping_in = nn.Linear(embedding_size, hidden_size)
 
-    def forward(self, token_ids, segment_ids=None, conditional_emb=None, additional_embs=None):
+    def forward(self, token_ids, segment_ids=None, conditional_emb=None, additional_embs=None, position_ids=None):
         if (not token_ids.requires_grad) and (token_ids.dtype in {torch.long, torch.int}):
             words_embeddings = self.word_embeddings(token_ids)
         else:
@@ -371,9 +528,10 @@ class BertEmbeddings(nn.Module):
                 embeddings += emb
 
         if hasattr(self, 'position_embeddings'):
-            seq_length = token_ids.size(1)
-            position_ids = torch.arange(seq_length, dtype=torch.long, device=token_ids.device)
-            position_ids = position_ids.unsqueeze(0).repeat(token_ids.shape[0], 1)
+            if position_ids is None:
+                seq_length = token_ids.size(1)
+                position_ids = torch.arange(seq_length, dtype=torch.long, device=token_ids.device)
+                position_ids = position_ids.unsqueeze(0).repeat(token_ids.shape[0], 1)
             position_embeddings = self.position_embeddings(position_ids)
             embeddings += position_embeddings
 
@@ -412,22 +570,49 @@ class BertLayer(nn.Module):
             self.crossAttention = MultiHeadAttentionLayer(hidden_size, num_attention_heads, attention_probs_dropout_prob, **kwargs)
             self.dropout3 = nn.Dropout(dropout_rate)
             self.layerNorm3 = LayerNorm(hidden_size, eps=1e-12, conditional_size=conditional_size, **kwargs)
-
-    def forward(self, hidden_states, attention_mask, conditional_emb=None, encoder_hidden_states=None, encoder_attention_mask=None):
-        self_attn_output = self.multiHeadAttention(hidden_states, attention_mask)  # self.decoder为true时候，这里的attention_mask是三角的
-        hidden_states = hidden_states + self.dropout1(self_attn_output)
+        self.fused_ops = kwargs.get('fused_ops', False)
+
+    def forward(self, hidden_states, attention_mask, conditional_emb=None, encoder_hidden_states=None, encoder_attention_mask=None, 
+                past_key_value=None, use_states=False, unpad_indices=None):
+        # past_key_value: 增量解码的缓存, 格式为(self_key, self_value)或(self_key, self_value, cross_key, cross_value)
+        # unpad_indices: 去除padding执行时有效token的位置, 此时hidden_states为[total_tokens, hidden_size], 除attention外均逐token计算
+        self_attn_output = self.multiHeadAttention(hidden_states, attention_mask, past_key_value=self.get_past_key_value(past_key_value), 
+                                                   use_states=use_states, unpad_indices=unpad_indices)  # self.decoder为true时候，这里的attention_mask是三角的
+        if use_states:
+            self_attn_output, present_key_value = self_attn_output
+        hidden_states = self.residual(self_attn_output, hidden_states, self.dropout1)
         hidden_states = self.layerNorm1((hidden_states, conditional_emb))
         
         # cross attention
         if self.is_decoder and encoder_hidden_states is not None:
-            cross_attn_output = self.crossAttention(hidden_states, None, encoder_hidden_states, encoder_attention_mask)
-            hidden_states = hidden_states + self.dropout3(cross_attn_output)
+            cross_attn_output = self.crossAttention(hidden_states, None, encoder_hidden_states, encoder_attention_mask, 
+                                                    past_key_value=self.get_past_key_value(past_key_value, cross=True), use_states=use_states)
+            if use_states:
+                cross_attn_output, cross_key_value = cross_attn_output
+                present_key_value = present_key_value + cross_key_value
+            hidden_states = self.residual(cross_attn_output, hidden_states, self.dropout3)
             hidden_states = self.layerNorm3((hidden_states, conditional_emb))
             
         self_attn_output2 = self.feedForward(hidden_states)
-        hidden_states = hidden_states + self.dropout2(self_attn_output2)
+        hidden_states = self.residual(self_attn_output2, hidden_states, self.dropout2)
         hidden_states = self.layerNorm2((hidden_states, conditional_emb))
-        return hidden_states
+        return (hidden_states, present_key_value) if use_states else hidden_states
+
+    def residual(self, x, hidden_states, dropout):
+        """残差连接: hidden_states + dropout(x), fused_ops时使用dropout_add
+        """
+        if self.fused_ops:
+            return dropout_add(x, hidden_states, dropout.p, self.training)
+        return hidden_states + dropout(x)
+
+    @staticmethod
+    def get_past_key_value(past_key_value, cross=False):
+        """从层的缓存中取出self attention或cross attention对应的(key, value)
+        """
+        if past_key_value is None:
+            return None
+        past_key_value = past_key_value[2:] if cross else past_key_value[:2]
+        return past_key_value if len(past_key_value) == 2 else None
 
 
 class T5Layer(BertLayer):
@@ -448,22 +633,31 @@ class T5Layer(BertLayer):
             del self.crossAttention.relative_positions_encoding
             del self.crossAttention.relative_positions
 
-    def forward(self, hidden_states, attention_mask, conditional_emb=None, encoder_hidden_states=None, encoder_attention_mask=None):
+    def forward(self, hidden_states, attention_mask, conditional_emb=None, encoder_hidden_states=None, encoder_attention_mask=None, 
+                past_key_value=None, use_states=False, position_bias=None):
         # bert的layernorm是在attn/ffc之后，Openai-gpt2是在之前
+        # position_bias: 各层共享的相对位置偏置，仅self attention使用
         x = self.layerNorm1((hidden_states, conditional_emb))
-        self_attn_output = self.multiHeadAttention(x, attention_mask)
-        hidden_states = hidden_states + self.dropout1(self_attn_output)
+        self_attn_output = self.multiHeadAttention(x, attention_mask, past_key_value=self.get_past_key_value(past_key_value), use_states=use_states,
+                                                   position_bias=position_bias)
+        if use_states:
+            self_attn_output, present_key_value = self_attn_output
+        hidden_states = self.residual(self_attn_output, hidden_states, self.dropout1)
 
         # cross attention
         if self.is_decoder and encoder_hidden_states is not None:
             x = self.layerNorm3((hidden_states, conditional_emb))
-            cross_attn_output = self.crossAttention(x, None, encoder_hidden_states, encoder_attention_mask)
-            hidden_states = hidden_states + self.dropout3(cross_attn_output)
+            cross_attn_output = self.crossAttention(x, None, encoder_hidden_states, encoder_attention_mask, 
+                                                    past_key_value=self.get_past_key_value(past_key_value, cross=True), use_states=use_states)
+            if use_states:
+                cross_attn_output, cross_key_value = cross_attn_output
+                present_key_value = present_key_value + cross_key_value
+            hidden_states = self.residual(cross_attn_output, hidden_states, self.dropout3)
 
         x = self.layerNorm2((hidden_states, conditional_emb))
         ffn_output = self.feedForward(x)
-        hidden_states = hidden_states + self.dropout2(ffn_output)
-        return hidden_states
+        hidden_states = self.residual(ffn_output, hidden_states, self.dropout2)
+        return (hidden_states, present_key_value) if use_states else hidden_states
 
     class T5PositionWiseFeedForward(PositionWiseFeedForward):
         '''参考transformer包: https://github.com/huggingface/transformers/blob/main/src/transformers/models/t5/modeling_t5.py
@@ -507,14 +701,14 @@ class XlnetLayer(BertLayer):
         if self.pre_lnorm:
             hidden_states_cat = self.layerNorm1((hidden_states_cat, conditional_emb))
         self_attn_output = self.multiHeadAttention(hidden_states, hidden_states_cat, pos_emb, attention_mask, segment_ids)
-        hidden_states = hidden_states + self.dropout1(self_attn_output)
+        hidden_states = self.residual(self_attn_output, hidden_states, self.dropout1)
         if not self.pre_lnorm:  # post_lnorm
             hidden_states = self.layerNorm1((hidden_states, conditional_emb))
 
         # FFN
         x = self.layerNorm2((hidden_states, conditional_emb)) if self.pre_lnorm else hidden_states
         self_attn_output2 = self.feedForward(x)
-        hidden_states = hidden_states + self.dropout2(self_attn_output2)
+        hidden_states = self.residual(self_attn_output2, hidden_states, self.dropout2)
         if not self.pre_lnorm:  # post_lnorm
             hidden_states = self.layerNorm2((hidden_states, conditional_emb))
         return hidden_states
@@ -523,6 +717,7 @@ class XlnetLayer(BertLayer):
         '''Transformer_XL式相对位置编码, 这里修改成了MultiHeadAttentionLayer的batch_first代码格式
         '''
         def __init__(self, *args, r_w_bias=None, r_r_bias=None, r_s_bias=None, **kwargs):
+            kwargs.pop('attn_impl', None)  # 需要单独使用q/k/v, 不支持sdpa
             super().__init__(*args, **kwargs)
             segment_vocab_size = kwargs.get('segment_vocab_size')
             if r_r_bias is None or r_w_bias is None:  # Biases are not shared
@@ -689,8 +884,9 @@ class Identity(nn.Module):
     def __init__(self, *args, **kwargs):
         super(Identity, self).__init__()
 
-    def forward(self, *args):
-        return args[0]
+    def forward(self, *args, **kwargs):
+        # 增量解码时和其他层保持一致，额外返回空的缓存
+        return (args[0], None) if kwargs.get('use_states') else args[0]
 
 
 class XlnetPositionsEncoding(nn.Module):
@@ -711,6 +907,7 @@ class XlnetPositionsEncoding(nn.Module):
 class RelativePositionsEncoding(nn.Module):
     """nezha用的google相对位置编码
     来自论文：https://arxiv.org/abs/1803.02155
+    只保存[2*max_relative_position+1, embedding_size]的编码表和[qlen, klen]的索引, 不再物化[qlen, klen, embedding_size]的完整矩阵
     """
     def __init__(self, qlen, klen, embedding_size, max_relative_position=127):
         super(RelativePositionsEncoding, self).__init__()
@@ -723,25 +920,43 @@ class RelativePositionsEncoding(nn.Module):
         # sinusoid_encoding编码的位置矩阵
         embeddings_table = get_sinusoid_encoding_table(vocab_size, embedding_size)
 
-        # 实现方式1
-        # flat_relative_positions_matrix = final_mat.view(-1)
-        # one_hot_relative_positions_matrix = torch.nn.functional.one_hot(flat_relative_positions_matrix, num_classes=vocab_size).float()
-        # position_embeddings = torch.matmul(one_hot_relative_positions_matrix, embeddings_table)
-        # my_shape = list(final_mat.size())
-        # my_shape.append(embedding_size)
-        # position_embeddings = position_embeddings.view(my_shape)
-
-        # 实现方式2
-        # position_embeddings = torch.take_along_dim(embeddings_table, final_mat.flatten().unsqueeze(1), dim=0)
-        # position_embeddings = position_embeddings.reshape(*final_mat.shape, embeddings_table.shape[-1])  # [seq_len, seq_len, hdsz]
-        # self.register_buffer('position_embeddings', position_embeddings)
-        
-        # 实现方式3
-        position_embeddings = nn.Embedding.from_pretrained(embeddings_table, freeze=True)(final_mat)
-        self.register_buffer('position_embeddings', position_embeddings)
+        # 编码表和索引均可由配置重新生成，不写入state_dict
+        self.register_buffer('embeddings_table', embeddings_table, persistent=False)  # [vocab_size, embedding_size]
+        self.register_buffer('relative_positions', final_mat, persistent=False)  # [qlen, klen]
+        # 兼容旧版本保存的权重中的position_embeddings
+        self._register_load_state_dict_pre_hook(self._drop_position_embeddings)
+
+    @staticmethod
+    def _drop_position_embeddings(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        state_dict.pop(prefix + 'position_embeddings', None)
+
+    def get_relative_positions(self, qlen, klen):
+        """相对位置索引，query对应最后qlen个位置(增量解码时qlen < klen)
+        """
+        return self.relative_positions[klen-qlen:klen, :klen]
+
+    def key_position_scores(self, query_layer, klen):
+        """等价于torch.einsum('bnih,ijh->bnij', query_layer, self(qlen, klen))
+        先和编码表相乘得到[btz, n_heads, qlen, vocab_size]，再按索引gather
+        """
+        qlen = query_layer.shape[-2]
+        index = self.get_relative_positions(qlen, klen)
+        scores = torch.matmul(query_layer, self.embeddings_table.to(query_layer.dtype).t())  # [btz, n_heads, qlen, vocab_size]
+        return torch.gather(scores, -1, index.expand(*scores.shape[:2], qlen, klen))
+
+    def value_position_scores(self, attention_probs):
+        """等价于torch.einsum('bnij,ijh->bnih', attention_probs, self(qlen, klen))
+        先把attention_probs按索引累加到[btz, n_heads, qlen, vocab_size]，再和编码表相乘
+        """
+        qlen, klen = attention_probs.shape[-2:]
+        index = self.get_relative_positions(qlen, klen).expand_as(attention_probs)
+        probs = attention_probs.new_zeros(*attention_probs.shape[:-1], self.embeddings_table.shape[0])
+        probs = probs.scatter_add_(-1, index, attention_probs)
+        return torch.matmul(probs, self.embeddings_table.to(attention_probs.dtype))
 
     def forward(self, qlen, klen):
-        return self.position_embeddings[:qlen, :klen, :]
+        # 完整的[qlen, klen, embedding_size]编码，仅保留兼容，attention中使用key/value_position_scores
+        return F.embedding(self.relative_positions[:qlen, :klen], self.embeddings_table)
 
 
 class RelativePositionsEncodingT5(nn.Module):
@@ -759,7 +974,19 @@ class RelativePositionsEncodingT5(nn.Module):
             bidirectional=not is_decoder,
             num_buckets=relative_attention_num_buckets,
         )
-        self.register_buffer('relative_position', relative_position)
+        # 可由配置重新生成，不写入state_dict，各层共享同一份
+        self.register_buffer('relative_position', relative_position, persistent=False)
+        # 兼容旧版本保存的权重中的relative_position
+        self._register_load_state_dict_pre_hook(self._drop_relative_position)
+
+    @staticmethod
+    def _drop_relative_position(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        state_dict.pop(prefix + 'relative_position', None)
+
+    def get_relative_positions(self, qlen, klen):
+        """相对位置的bucket索引，query对应最后qlen个位置(增量解码时qlen < klen)
+        """
+        return self.relative_position[klen-qlen:klen, :klen]
 
     def forward(self, qlen, klen):
         return self.relative_position[:qlen, :klen]
@@ -813,11 +1040,11 @@ class RoPEPositionEncoding(nn.Module):
         self.register_buffer('cos_position', cos_position)
         self.register_buffer('sin_position', sin_position)
     
-    def forward(self, qw, seq_dim=-2):
-        # 默认最后两个维度为[seq_len, hdsz]
+    def forward(self, qw, seq_dim=-2, offset=0):
+        # 默认最后两个维度为[seq_len, hdsz], offset为起始位置(增量解码时为历史长度)
         seq_len = qw.shape[seq_dim]
         qw2 = torch.stack([-qw[..., 1::2], qw[..., ::2]], dim=-1).reshape_as(qw)
-        return qw * self.cos_position[:seq_len] + qw2 * self.sin_position[:seq_len]
+        return qw * self.cos_position[offset:offset+seq_len] + qw2 * self.sin_position[offset:offset+seq_len]
 
 
 class CRF(nn.Module):
@@ -844,69 +1071,39 @@ class CRF(nn.Module):
     # feats: [bts, seq_len, num_labels+2]
     # mask: [bts, seq_len]
     def _forward_alg(self, feats, mask):
+        """逐时间步在[bts, tag_size, tag_size]上做logsumexp，不再展开成[seq_len * bts, tag_size, tag_size]
+        """
         bts, seq_len, tag_size = feats.size()
-        ins_num = bts * seq_len
-
-        mask = mask.transpose(1, 0).contiguous()  # [seq_len, bsz]
-
-        # [seq_len * bts, tag_size, tag_size]
-        feats = feats.transpose(1, 0).contiguous().view(ins_num, 1, tag_size).expand(ins_num, tag_size, tag_size)
-
-        # [seq_len * bts, tag_size, tag_size]
-        scores = feats + self.transitions.view(1, tag_size, tag_size).expand(ins_num, tag_size, tag_size)
-        scores = scores.view(seq_len, bts, tag_size, tag_size)  # [seq_len, bts, tag_size, tag_size]
-        seq_iter = enumerate(scores)
+        mask = mask.bool()
 
         """ only need start from start_tag """
-        _, inivalues = next(seq_iter)  # [bts, tag_size, tag_size]
-        partition = inivalues[:, self.START_TAG_IDX, :].clone().view(bts, tag_size, 1)  # [bts, tag_size, 1]
-
-        for idx, cur_values in seq_iter:  # scalar, [bts, tag_size, tag_size]
-            # [bts, tag_size, tag_size]
-            cur_values = cur_values + partition.contiguous().view(bts, tag_size, 1).expand(bts, tag_size, tag_size)
-            cur_partition = self.log_sum_exp(cur_values, tag_size)  # [bts, tag_size]
-            mask_idx = mask[idx, :].view(bts, 1).expand(bts, tag_size)  # [bts, tag_size]
-            """ effective updated partition part, only keep the partition value of mask value = 1 """
-            masked_cur_partition = cur_partition.masked_select(mask_idx.bool())  # [x * tag_size]
-            if masked_cur_partition.dim() != 0:
-                mask_idx = mask_idx.contiguous().view(bts, tag_size, 1)  # [bts, tag_size, 1]
-                """ replace the partition where the maskvalue=1, other partition value keeps the same """
-                partition.masked_scatter_(mask_idx.bool(), masked_cur_partition)
-        # [bts, tag_size, tag_size]
-        cur_values = self.transitions.view(1, tag_size, tag_size).expand(bts, tag_size, tag_size) + \
-                     partition.contiguous().view(bts, tag_size, 1).expand(bts, tag_size, tag_size)
-        cur_partition = self.log_sum_exp(cur_values, tag_size)  # [bts, tag_size]
-        final_partition = cur_partition[:, self.END_TAG_IDX]  # [bts]
-        return final_partition.sum(), scores
-
-    # scores: [seq_len, bts, tag_size, tag_size]
+        partition = feats[:, 0] + self.transitions[self.START_TAG_IDX].unsqueeze(0)  # [bts, tag_size]
+        for idx in range(1, seq_len):
+            # [bts, tag_size(from), tag_size(to)] -> [bts, tag_size]
+            cur_partition = torch.logsumexp(partition.unsqueeze(2) + self.transitions.unsqueeze(0), dim=1) + feats[:, idx]
+            """ only keep the partition value of mask value = 1 """
+            partition = torch.where(mask[:, idx:idx+1], cur_partition, partition)
+        # [bts]
+        final_partition = torch.logsumexp(partition + self.transitions[:, self.END_TAG_IDX].unsqueeze(0), dim=1)
+        return final_partition.sum()
+
+    # feats: [bts, seq_len, num_labels+2]
     # mask: [bts, seq_len]
     # tags: [bts, seq_len]
-    def _score_sentence(self, scores, mask, tags):
-        seq_len, btz, tag_size, _ = scores.size()
-
-        """ convert tag value into a new format, recorded label bigram information to index """
-        new_tags = torch.empty(btz, seq_len, requires_grad=True).to(tags)  # [btz, seq_len]
-        for idx in range(seq_len):
-            if idx == 0:
-                new_tags[:, 0] = (tag_size - 2) * tag_size + tags[:, 0]  # `tag_size - 2` account for `START_TAG_IDX`
-            else:
-                new_tags[:, idx] = tags[:, idx - 1] * tag_size + tags[:, idx]
-        new_tags = new_tags.transpose(1, 0).contiguous().view(seq_len, btz, 1)  # [seq_len, btz, 1]
+    def _score_sentence(self, feats, mask, tags):
+        btz, seq_len, tag_size = feats.size()
+        mask = mask.bool()
 
-        # get all energies except end energy
-        tg_energy = torch.gather(scores.view(seq_len, btz, -1), 2, new_tags).view(seq_len, btz)  # [seq_len, btz]
-        tg_energy = tg_energy.masked_select(mask.transpose(1, 0).bool())  # list
+        """ emission score and transition score(from previous tag, START_TAG for the first word) of gold path """
+        prev_tags = torch.cat([torch.full_like(tags[:, :1], tag_size - 2), tags[:, :-1]], dim=1)  # `tag_size - 2` account for `START_TAG_IDX`
+        tg_energy = torch.gather(feats, 2, tags.unsqueeze(2)).squeeze(2) + self.transitions[prev_tags, tags]  # [btz, seq_len]
+        tg_energy = torch.where(mask, tg_energy, torch.zeros_like(tg_energy))
 
-        """ transition for label to STOP_TAG """
-        # [btz, tag_size]
-        end_transition = self.transitions[:, self.END_TAG_IDX].contiguous().view(1, tag_size).expand(btz, tag_size)
         """ length for batch,  last word position = length - 1 """
         length_mask = torch.sum(mask, dim=1, keepdim=True).long()  # [bts, 1]
-        """ index the label id of last word """
-        end_ids = torch.gather(tags, 1, length_mask - 1)  # [bts, 1]
-        """ index the transition score for end_id to STOP_TAG """
-        end_energy = torch.gather(end_transition, 1, end_ids)  # [bts, 1]
+        """ index the label id of last word, then the transition score for end_id to STOP_TAG """
+        end_ids = torch.gather(tags, 1, length_mask - 1).squeeze(1)  # [bts]
+        end_energy = self.transitions[end_ids, self.END_TAG_IDX]  # [bts]
 
         gold_score = tg_energy.sum() + end_energy.sum()
 
@@ -917,85 +1114,59 @@ class CRF(nn.Module):
     # tags: [bts, seq_len]
     def neg_log_likelihood_loss(self, feats, mask, tags):
         bts = feats.size(0)
-        # scalar, [seq_len, bts, tag_size, tag_size]
-        forward_score, scores = self._forward_alg(feats, mask)
-        gold_score = self._score_sentence(scores, mask, tags)
+        forward_score = self._forward_alg(feats, mask)  # scalar
+        gold_score = self._score_sentence(feats, mask, tags)
         return (forward_score - gold_score) / bts
 
     # feats: [bts, seq_len, num_labels+2]
     # mask: [bts, seq_len]
-    def _viterbi_decode(self, feats, mask):
+    def _viterbi_decode(self, feats, mask, nbest=1):
+        """n-best viterbi解码，仅保留[bts, tag_size, nbest]的累计分数和int16/int32的回溯指针，mask可为任意长度的batch
+           返回paths: [bts, nbest, seq_len], padding部分为0; scores: [bts, nbest], 路径数不足nbest时分数为-inf
+        """
         bts, seq_len, tag_size = feats.size()
-        ins_num = seq_len * bts
-        """ calculate sentence length for each sentence """
-        length_mask = torch.sum(mask, dim=1, keepdim=True).long()  # [bts, 1]
-        mask = mask.transpose(1, 0).contiguous()  # [seq_len, bts]
-
-        # [seq_len * bts, tag_size, tag_size]
-        feats = feats.transpose(1, 0).contiguous().view(ins_num, 1, tag_size).expand(ins_num, tag_size, tag_size)
-
-        # [seq_len * bts, tag_size, tag_size]
-        scores = feats + self.transitions.view(1, tag_size, tag_size).expand(ins_num, tag_size, tag_size)
-        scores = scores.view(seq_len, bts, tag_size, tag_size)  # [seq_len, bts, tag_size, tag_size]
-
-        seq_iter = enumerate(scores)
-        # record the position of the best score
-        back_points = []
-        partition_history = []
-        mask = (1 - mask.long()).bool()  # [seq_len, bts]
-        _, inivalues = next(seq_iter)  # [bts, tag_size, tag_size]
-        """ only need start from start_tag """
-        partition = inivalues[:, self.START_TAG_IDX, :].clone().view(bts, tag_size, 1)  # [bts, tag_size,1]
-        partition_history.append(partition)
-
-        for idx, cur_values in seq_iter:  # scalar, [bts, tag_size, tag_size]
-            # [bts, tag_size, tag_size]
-            cur_values = cur_values + partition.contiguous().view(bts, tag_size, 1).expand(bts, tag_size, tag_size)
-            """ do not consider START_TAG/STOP_TAG """
-            partition, cur_bp = torch.max(cur_values, 1)  # [bts, tag_size], [bts, tag_size]
-            partition_history.append(partition.unsqueeze(-1))
-            """ set padded label as 0, which will be filtered in post processing"""
-            cur_bp.masked_fill_(mask[idx].view(bts, 1).expand(bts, tag_size), 0)  # [bts, tag_size]
-            back_points.append(cur_bp)
-
-        # [bts, seq_len, tag_size]
-        partition_history = torch.cat(partition_history).view(seq_len, bts, -1).transpose(1, 0).contiguous()
-        """ get the last position for each setences, and select the last partitions using gather() """
-        last_position = length_mask.view(bts, 1, 1).expand(bts, 1, tag_size) - 1  # [bts, 1, tag_size]
-        # [bts, tag_size, 1]
-        last_partition = torch.gather(partition_history, 1, last_position).view(bts, tag_size, 1)
-        """ calculate the score from last partition to end state (and then select the STOP_TAG from it) """
-        # [bts, tag_size, tag_size]
-        last_values = last_partition.expand(bts, tag_size, tag_size) + \
-                      self.transitions.view(1, tag_size, tag_size).expand(bts, tag_size, tag_size)
-        _, last_bp = torch.max(last_values, 1)  # [bts, tag_size]
-        """ select end ids in STOP_TAG """
-        pointer = last_bp[:, self.END_TAG_IDX]  # [bts]
-
-        pad_zero = torch.zeros(bts, tag_size, requires_grad=True).to(mask).long()  # [bts, tag_size]
-        back_points.append(pad_zero)
-        back_points = torch.cat(back_points).view(seq_len, bts, tag_size)  # [seq_len, bts, tag_size]
-
-        insert_last = pointer.contiguous().view(bts, 1, 1).expand(bts, 1, tag_size)  # [bts, 1, tag_size]
-        back_points = back_points.transpose(1, 0).contiguous()  # [bts, seq_len, tag_size]
-        """move the end ids(expand to tag_size) to the corresponding position of back_points to replace the 0 values """
-        back_points.scatter_(1, last_position, insert_last)  # [bts, seq_len, tag_size]
-
-        back_points = back_points.transpose(1, 0).contiguous()  # [seq_len, bts, tag_size]
-        """ decode from the end, padded position ids are 0, which will be filtered if following evaluation """
-        decode_idx = torch.empty(seq_len, bts, requires_grad=True).to(pointer)  # [seq_len, bts]
-        decode_idx[-1] = pointer.data
-        for idx in range(len(back_points) - 2, -1, -1):
-            pointer = torch.gather(back_points[idx], 1, pointer.contiguous().view(bts, 1))
-            decode_idx[idx] = pointer.view(-1).data
-        decode_idx = decode_idx.transpose(1, 0)  # [bts, seq_len]
-        return decode_idx
+        mask = mask.bool()
+        # 回溯指针记录上一步的tag_id * nbest + 第几条路径
+        bp_dtype = torch.int16 if tag_size * nbest <= torch.iinfo(torch.int16).max else torch.int32
+        back_points = torch.zeros(seq_len, bts, tag_size, nbest, dtype=bp_dtype, device=feats.device)
+        # padding位置的指针指向自身, 使得分数和路径原样保留到最后一个有效位置
+        self_points = torch.arange(tag_size * nbest, device=feats.device).view(1, tag_size, nbest).to(bp_dtype)
+
+        """ only need start from start_tag, only one path at the beginning """
+        partition = feats.new_full((bts, tag_size, nbest), float('-inf'))  # [bts, tag_size, nbest]
+        partition[:, :, 0] = feats[:, 0] + self.transitions[self.START_TAG_IDX].unsqueeze(0)
+        for idx in range(1, seq_len):
+            # [bts, tag_size(from) * nbest, tag_size(to)]
+            cur_values = (partition.unsqueeze(3) + self.transitions.view(1, tag_size, 1, tag_size)).view(bts, tag_size * nbest, tag_size)
+            cur_partition, cur_bp = cur_values.topk(nbest, dim=1)  # [bts, nbest, tag_size]
+            # transpose后非连续, torch.where会保留该stride, 需转为连续的以便下一步view
+            cur_partition = (cur_partition.transpose(1, 2) + feats[:, idx].unsqueeze(2)).contiguous()  # [bts, tag_size, nbest]
+            mask_idx = mask[:, idx].view(bts, 1, 1)
+            partition = torch.where(mask_idx, cur_partition, partition)
+            back_points[idx] = torch.where(mask_idx, cur_bp.transpose(1, 2).to(bp_dtype), self_points)
+
+        """ transition to STOP_TAG """
+        last_values = partition + self.transitions[:, self.END_TAG_IDX].view(1, tag_size, 1)  # [bts, tag_size, nbest]
+        scores, pointer = last_values.view(bts, -1).topk(nbest, dim=1)  # [bts, nbest]
+
+        """ decode from the end """
+        paths = torch.zeros(bts, nbest, seq_len, dtype=torch.long, device=feats.device)
+        for idx in range(seq_len - 1, -1, -1):
+            paths[:, :, idx] = torch.div(pointer, nbest, rounding_mode='floor')
+            if idx > 0:
+                pointer = torch.gather(back_points[idx].view(bts, -1), 1, pointer).long()
+        paths = paths.masked_fill(~mask.unsqueeze(1), 0)
+        return paths, scores
 
     # feats: [bts, seq_len, num_labels+2]
     # mask: [bts, seq_len]
-    def forward(self, feats, mask):
-        best_path = self._viterbi_decode(feats, mask)  # [bts, seq_len]
-        return best_path
+    def forward(self, feats, mask, nbest=1, return_scores=False):
+        """nbest=1时返回[bts, seq_len]的最优路径, nbest>1时返回[bts, nbest, seq_len]; return_scores时同时返回路径分数
+        """
+        paths, scores = self._viterbi_decode(feats, mask, nbest)
+        if nbest == 1:
+            paths, scores = paths[:, 0], scores[:, 0]
+        return (paths, scores) if return_scores else paths
     
     @staticmethod
     def log_sum_exp(vec, m_size):
@@ -1078,13 +1249,49 @@ class GlobalPointer(nn.Module):
             logits = logits.masked_fill(attention_mask1.bool(), value=-float('inf'))
             logits = logits.masked_fill(attention_mask2.bool(), value=-float('inf'))
 
-        # 排除下三角
+        # 排除下三角, [seq_len, seq_len]的mask广播即可
         if self.tril_mask:
-            logits = logits - torch.tril(torch.ones_like(logits), -1) * 1e12
+            seq_len = logits.size(-1)
+            logits = logits - torch.ones(seq_len, seq_len, dtype=logits.dtype, device=logits.device).tril(-1) * 1e12
 
         # scale返回
         return logits / self.head_size**0.5
 
+    def decode(self, logits, mask=None, threshold=0, topk=None):
+        """从logits中直接解码出span, 整个batch一起处理
+           logits: [btz, heads, seq_len, seq_len], forward的输出
+           mask: [btz, seq_len], padding部分为0, 按位置过滤, 无需logits已经mask
+           threshold: 仅保留分数大于threshold的span, 为None时不过滤
+           topk: 每个样本每个head仅保留分数最高的topk个span
+           return: spans: [n, 4], 每行为(batch_id, head_id, start, end); scores: [n]
+        """
+        btz, heads, seq_len, _ = logits.shape
+        if topk is not None:
+            # 先排除padding和下三角, 再取topk
+            invalid = torch.zeros(1, 1, seq_len, seq_len, dtype=torch.bool, device=logits.device)
+            if self.tril_mask:
+                invalid = invalid | torch.ones(seq_len, seq_len, dtype=torch.bool, device=logits.device).tril(-1)
+            if mask is not None:
+                invalid = invalid | (mask == 0).view(btz, 1, seq_len, 1) | (mask == 0).view(btz, 1, 1, seq_len)
+            scores, index = logits.masked_fill(invalid, -float('inf')).flatten(2).topk(min(topk, seq_len * seq_len), dim=-1)
+            batch_ids = torch.arange(btz, device=logits.device).view(btz, 1, 1).expand_as(index)
+            head_ids = torch.arange(heads, device=logits.device).view(1, heads, 1).expand_as(index)
+            spans = torch.stack([batch_ids, head_ids, torch.div(index, seq_len, rounding_mode='floor'), index % seq_len], dim=-1).view(-1, 4)
+            scores = scores.flatten()
+            keep = scores > -float('inf') if threshold is None else scores > threshold
+            return spans[keep], scores[keep]
+
+        # 仅对大于阈值的位置按index过滤
+        spans = (logits > (-float('inf') if threshold is None else threshold)).nonzero()  # [n, 4]
+        keep = torch.ones(spans.size(0), dtype=torch.bool, device=logits.device)
+        if self.tril_mask:
+            keep &= spans[:, 2] <= spans[:, 3]
+        if mask is not None:
+            keep &= (mask[spans[:, 0], spans[:, 2]] > 0) & (mask[spans[:, 0], spans[:, 3]] > 0)
+        spans = spans[keep]
+        scores = logits[spans[:, 0], spans[:, 1], spans[:, 2], spans[:, 3]]
+        return spans, scores
+
 
 class EfficientGlobalPointer(nn.Module):
     """更加参数高效的GlobalPointer
@@ -1128,12 +1335,16 @@ class EfficientGlobalPointer(nn.Module):
             logits = logits.masked_fill(attention_mask1.bool(), value=-float('inf'))
             logits = logits.masked_fill(attention_mask2.bool(), value=-float('inf'))
 
-        # 排除下三角
+        # 排除下三角, [seq_len, seq_len]的mask广播即可
         if self.tril_mask:
-            logits = logits - torch.tril(torch.ones_like(logits), -1) * 1e12
+            seq_len = logits.size(-1)
+            logits = logits - torch.ones(seq_len, seq_len, dtype=logits.dtype, device=logits.device).tril(-1) * 1e12
 
         return logits
 
+    # 解码方式与GlobalPointer一致
+    decode = GlobalPointer.decode
+
 
 class TplinkerHandshakingKernel(nn.Module):
     '''Tplinker的HandshakingKernel实现
@@ -1157,25 +1368,39 @@ class TplinkerHandshakingKernel(nn.Module):
         elif inner_enc_type == "lstm":
             self.inner_context_lstm = nn.LSTM(hidden_size, hidden_size, num_layers=1, bidirectional=False, batch_first=True)
         
-        # 自行实现的用torch.gather方式来做，避免循环，目前只实现了cat方式
-        # tag_ids = [(i, j) for i in range(maxlen) for j in range(maxlen) if j >= i]
-        # gather_idx = torch.tensor(tag_ids, dtype=torch.long).flatten()[None, :, None]
-        # self.register_buffer('gather_idx', gather_idx)
+        self.triu_index = None  # 上三角(i, j)的位置, 按seq_len缓存
+
+    def get_triu_index(self, seq_len, device):
+        """获取(0,0),(0,1),...,(seq_len-1,seq_len-1)对应的行列id
+        """
+        if (self.triu_index is None) or (self.triu_index.size(1) != seq_len * (seq_len + 1) // 2) or (self.triu_index.device != device):
+            self.triu_index = torch.triu_indices(seq_len, seq_len, device=device)
+        return self.triu_index
 
     def enc_inner_hiddens(self, seq_hiddens, inner_enc_type="lstm"):
-        # seq_hiddens: (batch_size, seq_len, hidden_size)
-        def pool(seqence, pooling_type):
-            if pooling_type == "mean_pooling":
-                pooling = torch.mean(seqence, dim = -2)
-            elif pooling_type == "max_pooling":
-                pooling, _ = torch.max(seqence, dim = -2)
-            elif pooling_type == "mix_pooling":
-                pooling = self.lamtha * torch.mean(seqence, dim = -2) + (1 - self.lamtha) * torch.max(seqence, dim = -2)[0]
-            return pooling
+        """一次计算所有起点i到终点j的inner context
+        seq_hiddens: (batch_size, seq_len, hidden_size)
+        return: (batch_size, seq_len(i), seq_len(j-i), hidden_size), j-i超出范围的部分无意义
+        """
+        btz, seq_len, hdsz = seq_hiddens.shape
+        # shifted_hiddens[:, i, t] = seq_hiddens[:, i+t], 超出部分用最后一个位置填充, 累积计算时不影响有效部分
+        offsets = torch.arange(seq_len, device=seq_hiddens.device)
+        shifted_hiddens = seq_hiddens[:, (offsets.unsqueeze(1) + offsets.unsqueeze(0)).clamp(max=seq_len-1)]
         if "pooling" in inner_enc_type:
-            inner_context = torch.stack([pool(seq_hiddens[:, :i+1, :], inner_enc_type) for i in range(seq_hiddens.size()[1])], dim = 1)
+            if inner_enc_type in {"mean_pooling", "mix_pooling"}:
+                mean_pooling = shifted_hiddens.cumsum(dim=2) / (offsets + 1).view(1, 1, seq_len, 1).to(seq_hiddens)
+            if inner_enc_type in {"max_pooling", "mix_pooling"}:
+                max_pooling = shifted_hiddens.cummax(dim=2)[0]
+            if inner_enc_type == "mean_pooling":
+                inner_context = mean_pooling
+            elif inner_enc_type == "max_pooling":
+                inner_context = max_pooling
+            else:
+                inner_context = self.lamtha * mean_pooling + (1 - self.lamtha) * max_pooling
         elif inner_enc_type == "lstm":
-            inner_context, _ = self.inner_context_lstm(seq_hiddens)
+            # 各个起点作为batch一起过单向lstm
+            inner_context, _ = self.inner_context_lstm(shifted_hiddens.reshape(btz * seq_len, seq_len, hdsz))
+            inner_context = inner_context.reshape(btz, seq_len, seq_len, -1)
             
         return inner_context
     
@@ -1185,37 +1410,21 @@ class TplinkerHandshakingKernel(nn.Module):
         return:
             shaking_hiddenss: (batch_size, (1 + seq_len) * seq_len / 2, hidden_size) (32, 5+4+3+2+1, 5)
         '''
-        seq_len = seq_hiddens.size()[-2]
-        shaking_hiddens_list = []
-        for ind in range(seq_len):
-            hidden_each_step = seq_hiddens[:, ind, :]
-            visible_hiddens = seq_hiddens[:, ind:, :] # ind: only look back
-            repeat_hiddens = hidden_each_step[:, None, :].repeat(1, seq_len - ind, 1)  
-            
-            if self.shaking_type == "cat":
-                shaking_hiddens = torch.cat([repeat_hiddens, visible_hiddens], dim = -1)
-                shaking_hiddens = torch.tanh(self.combine_fc(shaking_hiddens))
-            elif self.shaking_type == "cat_plus":
-                inner_context = self.enc_inner_hiddens(visible_hiddens, self.inner_enc_type)
-                shaking_hiddens = torch.cat([repeat_hiddens, visible_hiddens, inner_context], dim = -1)
-                shaking_hiddens = torch.tanh(self.combine_fc(shaking_hiddens))
-            elif self.shaking_type == "cln":
-                shaking_hiddens = self.tp_cln([visible_hiddens, repeat_hiddens])
-            elif self.shaking_type == "cln_plus":
-                inner_context = self.enc_inner_hiddens(visible_hiddens, self.inner_enc_type)
-                shaking_hiddens = self.tp_cln([visible_hiddens, repeat_hiddens])
-                shaking_hiddens = self.inner_context_cln([shaking_hiddens, inner_context])
-
-            shaking_hiddens_list.append(shaking_hiddens)
-        long_shaking_hiddens = torch.cat(shaking_hiddens_list, dim = 1)
-        return long_shaking_hiddens
-
-        # def handshaking_kernel(self, last_hidden_state):
-        #     '''获取(0,0),(0,1),...,(99,99))对应的序列id
-        #     '''
-        #     btz, _, hdsz = last_hidden_state.shape
-        #     gather_idx = self.gather_idx.repeat(btz, 1, hdsz)
-        #     concat_hidden_states = torch.gather(last_hidden_state, dim=1, index=gather_idx)  # [btz, pair_len*2, hdsz]
-        #     concat_hidden_states = concat_hidden_states.reshape(btz, -1, 2, hdsz)  # concat方式 [btz, pair_len, 2, hdsz]
-        #     shaking_hiddens = torch.cat(torch.chunk(concat_hidden_states, chunks=2, dim=-2), dim=-1).squeeze(-2)  # [btz, pair_len, hdsz*2]
-        #     return shaking_hiddens
\ No newline at end of file
+        seq_len, hdsz = seq_hiddens.shape[-2:]
+        rows, cols = self.get_triu_index(seq_len, seq_hiddens.device)  # 第i个位置和其后的第j个位置握手
+        
+        if self.shaking_type in {"cat", "cat_plus"}:
+            # 先分别投影再按位置取, 等价于cat后过combine_fc, 避免生成[btz, pair_len, hdsz*2]的中间结果
+            weight = self.combine_fc.weight
+            shaking_hiddens = F.linear(seq_hiddens, weight[:, :hdsz])[:, rows] + F.linear(seq_hiddens, weight[:, hdsz:2*hdsz], self.combine_fc.bias)[:, cols]
+            if self.shaking_type == "cat_plus":
+                inner_context = self.enc_inner_hiddens(seq_hiddens, self.inner_enc_type)
+                shaking_hiddens = shaking_hiddens + F.linear(inner_context[:, rows, cols - rows], weight[:, 2*hdsz:])
+            shaking_hiddens = torch.tanh(shaking_hiddens)
+        elif self.shaking_type in {"cln", "cln_plus"}:
+            repeat_hiddens, visible_hiddens = seq_hiddens[:, rows], seq_hiddens[:, cols]
+            shaking_hiddens = self.tp_cln([visible_hiddens, repeat_hiddens])
+            if self.shaking_type == "cln_plus":
+                inner_context = self.enc_inner_hiddens(seq_hiddens, self.inner_enc_type)
+                shaking_hiddens = self.inner_context_cln([shaking_hiddens, inner_context[:, rows, cols - rows]])
+        return shaking_hiddens
\ No newline at end of file
@@ -1,12 +1,16 @@
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 import copy
 import json
 import re
+import os
+from concurrent.futures import ThreadPoolExecutor
 from bert4torch.layers import LayerNorm, BertEmbeddings, BertLayer, Identity, T5Layer, GatedAttentionUnit, XlnetLayer
 from bert4torch.layers import AdaptiveEmbedding, XlnetPositionsEncoding
-from bert4torch.snippets import metric_mapping, search_layer, insert_arguments, delete_arguments, get_kw
-from bert4torch.snippets import ProgbarLogger, FGM, PGD, VAT
+from bert4torch.snippets import metric_mapping, search_layer, insert_arguments, delete_arguments, get_kw, pad_input, unpad_input
+from bert4torch.snippets import ProgbarLogger, FGM, PGD, VAT, load_checkpoint, skip_init_weights
+from bert4torch.snippets import get_shard_index_file, save_sharded_state_dict
 from bert4torch.activations import get_activation
 import warnings
 
@@ -18,7 +22,8 @@ class BaseModel(nn.Module):
         self.global_step, self.total_steps, self.epoch, self.train_dataloader = 0, 0, 0, None
         self.callbacks = []
     
-    def compile(self, loss, optimizer, scheduler=None, max_grad_norm=None, use_amp=False, metrics=None, adversarial_train={'name': ''}):
+    def compile(self, loss, optimizer, scheduler=None, max_grad_norm=None, use_amp=False, metrics=None, adversarial_train={'name': ''}, 
+                amp_dtype=None, device_type='cuda'):
         '''定义loss, optimizer, metrics, 是否在计算loss前reshape
         loss: loss
         optimizer: 优化器
@@ -26,17 +31,29 @@ class BaseModel(nn.Module):
         max_grad_norm: 是否使用梯度裁剪, 默认不启用
         use_amp: 是否使用混合精度，默认不启用
         metrics: 训练过程中需要打印的指标, loss相关指标默认会打印, 目前支持accuracy
+        amp_dtype: 混合精度的数据类型, 默认cuda为torch.float16, cpu为torch.bfloat16
+        device_type: 混合精度的设备类型, 'cuda'或'cpu', cpu时使用torch.autocast('cpu', dtype=torch.bfloat16)
         '''
         self.criterion = loss
         self.optimizer = optimizer
         self.scheduler = scheduler
         self.max_grad_norm = max_grad_norm
         self.use_amp = use_amp
+        self.scaler = None
         if use_amp:
             assert adversarial_train['name'] not in {'vat', 'gradient_penalty'}, 'Amp and adversarial_train both run is not supported in current version'
-            from torch.cuda.amp import autocast
-            self.autocast = autocast
-            self.scaler = torch.cuda.amp.GradScaler()
+            assert device_type in {'cuda', 'cpu'}, 'Amp only support cuda and cpu device_type'
+            if amp_dtype is None:
+                amp_dtype = torch.float16 if device_type == 'cuda' else torch.bfloat16
+            if hasattr(torch, 'autocast'):  # torch>=1.10
+                self.autocast = lambda: torch.autocast(device_type=device_type, dtype=amp_dtype)
+            else:
+                assert device_type == 'cuda', 'Amp on cpu requires torch>=1.10'
+                from torch.cuda.amp import autocast
+                self.autocast = autocast
+            # bfloat16的数值范围和float32一致，不需要loss scale
+            if (device_type == 'cuda') and (amp_dtype == torch.float16):
+                self.scaler = torch.cuda.amp.GradScaler()
 
         if metrics is None:
             metrics = []
@@ -171,7 +188,10 @@ class BaseModel(nn.Module):
             for callback in self.callbacks:
                 callback.on_dataloader_end()
 
-    def fit(self, train_dataloader, steps_per_epoch=None, epochs=1, grad_accumulation_steps=1, callbacks=[]):
+    def fit(self, train_dataloader, steps_per_epoch=None, epochs=1, grad_accumulation_steps=1, callbacks=[], log_interval=1):
+        '''log_interval: 每隔多少个step同步一次指标, 期间指标以tensor形式在device上累加, 
+           同步时callbacks收到的是这段时间的平均值, 其余step的logs中不含指标; 大于1时可减少每个step的host同步
+        '''
         steps_per_epoch = len(train_dataloader) if steps_per_epoch is None else steps_per_epoch
         self.total_steps = steps_per_epoch * epochs
         self.global_step = 0
@@ -184,6 +204,7 @@ class BaseModel(nn.Module):
         for epoch in range(epochs):
             self.epoch = epoch
             self.callback_fun('epoch_begin')
+            metrics_sum, metrics_count = {}, 0
             for bti in range(steps_per_epoch):
                 self.bti = bti
                 # 循环dataloader, 不要试用itertools的cycle，遇到过变量不释放的问题
@@ -213,7 +234,7 @@ class BaseModel(nn.Module):
                 output, loss, loss_detail = self.train_step(train_X, train_y, grad_accumulation_steps)
                 
                 retain_graph = True if self.adversarial['name'] in {'gradient_penalty', 'vat'} else False
-                if self.use_amp:  # 混合精度
+                if self.scaler is not None:  # 混合精度
                     scale_before_step = self.scaler.get_scale()
                     self.scaler.scale(loss).backward(retain_graph=retain_graph)
                 else:
@@ -226,7 +247,7 @@ class BaseModel(nn.Module):
                 if (self.global_step+1) % grad_accumulation_steps == 0:
                     skip_scheduler = False
                     # 混合精度
-                    if self.use_amp:
+                    if self.scaler is not None:
                         self.scaler.unscale_(self.optimizer)
                         if self.max_grad_norm is not None:  # 梯度裁剪
                             torch.nn.utils.clip_grad_norm_(self.parameters(), self.max_grad_norm)
@@ -242,29 +263,46 @@ class BaseModel(nn.Module):
                     if (self.scheduler is not None) and not skip_scheduler:
                         self.scheduler.step()
 
-                # 添加log打印
-                logs.update({'loss': loss.item()})
-                logs_loss_detail = {k: v.item() if isinstance(v, torch.Tensor) else v for k, v in loss_detail.items()}
-                logs.update(logs_loss_detail)
+                # 添加log打印, 指标先在device上累加, 每log_interval个step才同步一次
                 if self.global_step == 0:
-                    self.callbacks[0].add_metrics(list(logs_loss_detail.keys()), add_position=1)
+                    self.callbacks[0].add_metrics(list(loss_detail.keys()), add_position=1)
+                step_metrics = {'loss': loss, **loss_detail}
                 for metric in self.metrics:
                     tmp = metric_mapping(metric, output, train_y)  # 内置的一些accuracy指标
                     if tmp is not None:
-                        logs[metric] = tmp
+                        step_metrics[metric] = tmp
+                for k, v in step_metrics.items():
+                    v = v.detach().float() if isinstance(v, torch.Tensor) else v
+                    metrics_sum[k] = metrics_sum[k] + v if k in metrics_sum else v
+                metrics_count += 1
+                if ((bti+1) % log_interval == 0) or (bti+1 == steps_per_epoch):
+                    logs.update(self.sync_metrics(metrics_sum, metrics_count))
+                    metrics_sum, metrics_count = {}, 0
                 self.callback_fun('batch_end', logs)
 
                 self.global_step += 1
             self.callback_fun('epoch_end', logs)
         self.callback_fun('train_end', logs)
 
-    def predict(self, input_tensor_list, return_all=None):
+    @staticmethod
+    def sync_metrics(metrics_sum, metrics_count):
+        '''把累加的指标求平均并转为python数值, 所有tensor指标合并后只同步一次
+        '''
+        metrics = {k: v / metrics_count for k, v in metrics_sum.items()}
+        keys = [k for k, v in metrics.items() if isinstance(v, torch.Tensor)]
+        if keys:
+            device = metrics[keys[0]].device
+            values = torch.stack([metrics[k].reshape(()).to(device) for k in keys]).tolist()
+            metrics.update(zip(keys, values))
+        return metrics
+
+    def predict(self, input_tensor_list, return_all=None, **kwargs):
         self.eval()
         with torch.no_grad():
             if self.forward.__code__.co_argcount >= 3:
-                output = self.forward(*input_tensor_list)
+                output = self.forward(*input_tensor_list, **kwargs)
             else:
-                output = self.forward(input_tensor_list)
+                output = self.forward(input_tensor_list, **kwargs)
         if return_all is None:
             return output
         elif isinstance(output, (tuple, list)) and isinstance(return_all, int) and return_all < len(output):
@@ -272,34 +310,69 @@ class BaseModel(nn.Module):
         else:
             raise ValueError('Return format error')
     
-    def load_weights(self, load_path, strict=True, prefix=None):
-        state_dict = torch.load(load_path, map_location='cpu')
+    def load_weights(self, load_path, strict=True, prefix=None, num_threads=1):
+        """加载save_weights保存的权重
+           load_path为分片保存时的save_path或者索引文件时，逐个分片加载, num_threads>1时多线程并行加载各分片
+        """
         if prefix is None:
-            self.load_state_dict(state_dict, strict=strict)
+            mapping = None
         else:
             # 加载save_weights中to_raw_format=True的情形
             eval_str = 'self.variable_mapping()' if prefix == '' else f'self.{prefix}.variable_mapping()'
             mapping = {v:k for k, v in eval(eval_str).items()}
             mapping = mapping if prefix == '' else {k:f'{prefix}.{v}' for k,v in mapping.items()}
-            state_dict_raw = {}
-            for k, v in state_dict.items():
-                k = mapping.get(k, k)
-                state_dict_raw[k] = v
-            self.load_state_dict(state_dict_raw, strict=strict)
 
-    def save_weights(self, save_path, prefix=None):
+        def load_state_dict(state_dict):
+            if mapping is not None:
+                state_dict = {mapping.get(k, k): v for k, v in state_dict.items()}
+            return self.load_state_dict(state_dict, strict=False)
+
+        index_file = get_shard_index_file(load_path)
+        if index_file is None:
+            state_dict = torch.load(load_path, map_location='cpu')
+            if mapping is not None:
+                state_dict = {mapping.get(k, k): v for k, v in state_dict.items()}
+            self.load_state_dict(state_dict, strict=strict)
+            return
+
+        # 分片加载, 每次仅有num_threads个分片在内存中
+        with open(index_file, encoding='utf-8') as f:
+            shard_files = sorted(set(json.load(f)['weight_map'].values()))
+        load_shard = lambda shard_file: load_state_dict(load_checkpoint(os.path.join(os.path.dirname(index_file), shard_file)))
+        if num_threads > 1:
+            with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                results = list(executor.map(load_shard, shard_files))
+        else:
+            results = [load_shard(shard_file) for shard_file in shard_files]
+
+        # 所有分片中都缺失的才是真正缺失的key
+        missing_keys = set.intersection(*[set(r.missing_keys) for r in results]) if results else set()
+        unexpected_keys = set().union(*[set(r.unexpected_keys) for r in results])
+        if strict and (missing_keys or unexpected_keys):
+            raise RuntimeError(f'Error(s) in loading state_dict for {self.__class__.__name__}:\n\t'
+                               f'Missing key(s): {sorted(missing_keys)}\n\tUnexpected key(s): {sorted(unexpected_keys)}')
+
+    def save_weights(self, save_path, prefix=None, max_shard_size=None):
+        """保存权重
+           prefix不为None时按照variable_mapping()中原始的key保存，方便其他官方代码加载模型
+           max_shard_size: 如'2GB', 设置时分片保存, 并写入{save_path}.index.json索引文件
+        """
         if prefix is None:
-            torch.save(self.state_dict(), save_path)
+            state_dict = self.state_dict()
         else:  
             # 按照variable_mapping()中原始的key保存，方便其他官方代码加载模型
             eval_str = 'self.variable_mapping()' if prefix == '' else f'self.{prefix}.variable_mapping()'
             mapping = eval(eval_str)
             mapping = mapping if prefix == '' else {f'{prefix}.{k}':v for k,v in mapping.items()}
-            state_dict_raw = {}
+            state_dict = {}
             for k, v in self.state_dict().items():
                 k = mapping.get(k, k)
-                state_dict_raw[k] = v
-            torch.save(state_dict_raw, save_path)
+                state_dict[k] = v
+
+        if max_shard_size is None:
+            torch.save(state_dict, save_path)
+        else:
+            save_sharded_state_dict(state_dict, save_path, max_shard_size)
     
 
 class BaseModelDP(BaseModel, nn.DataParallel):
@@ -342,6 +415,8 @@ class BERT_BASE(BaseModel):
             ignore_invalid_weights=False,  # 允许跳过不存在的权重
             keep_hidden_layers=None, # 保留的hidden_layer层的id
             hierarchical_position=None,  # 是否层次分解位置编码
+            gradient_checkpointing=False,  # 训练时不保存各层的中间激活，反向传播时重新计算，用计算换显存
+            skip_init=False,  # 跳过Linear/Embedding的随机初始化且各层直接构建, 用于随后从checkpoint加载权重的场景
             **kwargs
     ):
         super(BERT_BASE, self).__init__()
@@ -371,6 +446,8 @@ class BERT_BASE(BaseModel):
         self.ignore_invalid_weights = ignore_invalid_weights
         self.keep_hidden_layers = set(range(num_hidden_layers)) if keep_hidden_layers is None else set(keep_hidden_layers)
         self.hierarchical_position = hierarchical_position
+        self.gradient_checkpointing = gradient_checkpointing
+        self.skip_init = skip_init
 
     def build(
         self,
@@ -401,15 +478,23 @@ class BERT_BASE(BaseModel):
         # ]
         self.output_all_encoded_layers = kwargs.get('output_all_encoded_layers', False)
 
-    def forward(self, inputs):
+    def forward(self, inputs, *, states=None, use_states=False):
         """定义模型的执行流程
+        states: 上一步解码返回的缓存, 格式为{'past_key_values': 各层的K/V, 'attention_mask': 历史key的mask}
+        use_states: 是否返回缓存, 为True时返回(outputs, states), 用于自回归解码时仅计算新生成的token
+        缓存经由cache沿调用链传递, 不保存在模型上, 多个解码过程可以交替调用同一个模型
         """
+        # cache['past_states']为上一步的缓存, 本次调用的缓存由apply_embeddings和apply_layers写入
+        cache = {'past_states': states} if use_states else None
+        cache_kwargs = {'cache': cache} if use_states else {}
         # Embedding
-        outputs = self.apply_embeddings(inputs)
+        outputs = self.apply_embeddings(inputs, **cache_kwargs)
         # Main
-        outputs = self.apply_main_layers(outputs)
+        outputs = self.apply_main_layers(outputs, **cache_kwargs)
         # Final
         outputs = self.apply_final_layers(outputs)
+        if use_states:
+            return outputs, {'past_key_values': cache['past_key_values'], 'attention_mask': cache['attention_mask']}
         return outputs
 
     def init_model_weights(self, module):
@@ -422,13 +507,33 @@ class BERT_BASE(BaseModel):
             # 固定的相对位置编码如Sinusoidal无需初始化
             module.weight.data.normal_(mean=0.0, std=self.initializer_range)
         elif isinstance(module, LayerNorm):
-            if hasattr(module, 'bias') and module.bias.requires_grad:  # T5等模型使用的是rmsnorm
+            if (module.bias is not None) and module.bias.requires_grad:  # T5等模型使用的是rmsnorm
                 module.bias.data.zero_()
-            if hasattr(module, 'weight') and module.weight.requires_grad:
+            if (module.weight is not None) and module.weight.requires_grad:
                 module.weight.data.fill_(1.0)
         if isinstance(module, nn.Linear) and (module.bias is not None) and (module.bias.requires_grad):
             module.bias.data.zero_()
 
+    def init_missing_weights(self, missing_keys):
+        """skip_init时仅初始化checkpoint中没有的权重, 规则同init_model_weights
+           skip_init只跳过了Linear/Embedding的初始化, 其余参数在构建时已正常初始化
+        """
+        model_state_dict = self.state_dict(keep_vars=True)
+        modules = dict(self.named_modules())
+        initialized = set()  # 共享的权重仅需初始化一次
+        with torch.no_grad():
+            for key in missing_keys:
+                tensor = model_state_dict[key]
+                module_name, name = key.rsplit('.', 1) if '.' in key else ('', key)
+                module = modules.get(module_name)  # sdpa时q/k/v为qkv的切片, 不在named_modules中
+                if (id(tensor) in initialized) or (not tensor.requires_grad) or (module is not None and not isinstance(module, (nn.Linear, nn.Embedding))):
+                    continue
+                initialized.add(id(tensor))
+                if name == 'bias':
+                    tensor.zero_()
+                else:
+                    tensor.normal_(mean=0.0, std=self.initializer_range)
+
     def variable_mapping(self):
         """构建pytorch层与checkpoint的变量名之间的映射表
         """
@@ -469,34 +574,50 @@ class BERT_BASE(BaseModel):
 
         return embeddings
 
-    def load_weights_from_pytorch_checkpoint(self, checkpoint, mapping=None):
+    def load_weights_from_pytorch_checkpoint(self, checkpoint, mapping=None, mmap=True):
         """根据mapping从checkpoint加载权重
+           mmap: 是否以mmap方式加载(torch>=2.1, 或.safetensors文件), 仅读取mapping中用到的tensor, 并逐个拷贝到参数中
         """
         # 加载模型文件
-        file_state_dict = torch.load(checkpoint, map_location='cpu')
+        file_state_dict = load_checkpoint(checkpoint, mmap=mmap)
         mapping = mapping or self.variable_mapping()
 
-        state_dict_new ={}
-        parameters_set = set([i[0] for i in self.named_parameters()])  # 可更新的变量
+        # 可更新的变量, 从state_dict取key以兼容sdpa模式下q/k/v合并保存的情形(此时q/k/v为qkv参数的切片)
+        # keep_hidden_layers中去掉的层不在state_dict中, 对应的权重不会被读取
+        model_state_dict = self.state_dict(keep_vars=True)
+        # 共享的权重(如lm的dense和word_embeddings)在state_dict中有多个key, 和named_parameters一样按tensor去重, 任一key加载即视为已加载
+        alias_keys = {}
+        for k, v in model_state_dict.items():
+            if isinstance(v, nn.Parameter) or v.requires_grad:
+                alias_keys.setdefault(id(v), []).append(k)
+        parameters_set = set([keys[0] for keys in alias_keys.values()])
+        not_found_keys = set()
         for new_key, old_key in mapping.items():
-            if new_key not in self.state_dict():
+            if new_key not in model_state_dict:
                 continue
             elif old_key in file_state_dict: # mapping中包含，且模型结构中有
-                state_dict_new[new_key] = self.load_variable(file_state_dict, old_key)
+                variable = self.load_variable(file_state_dict, old_key)
+                target = model_state_dict[new_key]
+                if target.shape != variable.shape:
+                    raise RuntimeError(f'size mismatch for {new_key}: copying a param with shape {variable.shape} from checkpoint, '
+                                       f'the shape in current model is {target.shape}.')
+                # 直接拷贝到参数中, 不再构建完整的state_dict_new
+                with torch.no_grad():
+                    target.copy_(variable)
+                del variable
+                # 仅成功拷贝的才算已加载, 其余的作为missing_keys返回, skip_init时需要初始化
+                parameters_set.difference_update(alias_keys.get(id(target), [new_key]))
             elif (old_key not in file_state_dict) and (not self.ignore_invalid_weights):
                 # mapping中包含，但模型文件中没有
                 print(f'[WARNIMG] {old_key} not found in pretrain models')
-            if new_key in parameters_set:
-                parameters_set.remove(new_key)
+                not_found_keys.update(alias_keys.get(id(model_state_dict[new_key]), [new_key]))
 
         # 未能加载预训练权重的Parameter
         if not self.ignore_invalid_weights:
-            for key in parameters_set:
+            for key in parameters_set - not_found_keys:
                 print(f'[WARNIMG] Parameter {key} not loaded from pretrain models')
-        del file_state_dict
-
-        # 将ckpt的权重load到模型结构中
-        self.load_state_dict(state_dict_new, strict=False)
+        del file_state_dict, model_state_dict
+        return parameters_set
     
     # def get_inputs(self):
     #     pass
@@ -515,6 +636,25 @@ class BERT_BASE(BaseModel):
     def apply_final_layers(self, inputs):
         raise NotImplementedError
 
+    def get_layers(self, layer_fn, use_keep_hidden_layers=True):
+        """构建num_hidden_layers个transformer层, use_keep_hidden_layers时keep_hidden_layers以外的层为Identity
+           skip_init时各层直接构建(参数不初始化, 不拷贝), 否则深拷贝同一个层
+        """
+        keep_hidden_layers = self.keep_hidden_layers if use_keep_hidden_layers else set(range(self.num_hidden_layers))
+        if self.skip_init:
+            return nn.ModuleList([layer_fn() if layer_id in keep_hidden_layers else Identity() for layer_id in range(self.num_hidden_layers)])
+        layer = layer_fn()
+        return nn.ModuleList([copy.deepcopy(layer) if layer_id in keep_hidden_layers else Identity() for layer_id in range(self.num_hidden_layers)])
+
+    def apply_layer(self, layer_module, *args, **kwargs):
+        """执行单个transformer层
+           gradient_checkpointing时训练阶段不保存层内的中间激活，反向传播时重新计算，dropout的随机状态会被保存并在重算时恢复
+        """
+        if self.gradient_checkpointing and self.training and torch.is_grad_enabled() and (not isinstance(layer_module, Identity)):
+            # 非reentrant模式(torch>=1.11)支持kwargs，conditional_emb/encoder_hidden_state/position_bias等输入也能正确回传梯度
+            return checkpoint(layer_module, *args, use_reentrant=False, **kwargs)
+        return layer_module(*args, **kwargs)
+
     def compute_attention_bias(self, inputs=None):
         """定义每一层的Attention Bias
         """
@@ -544,10 +684,16 @@ class LM_Mask(object):
     """
     def compute_attention_bias(self, inputs=None):
         """通过idxs序列的比较来得到对应的mask
+           下三角矩阵(long)按device缓存最长的一份，较短的输入直接切片
         """
-        seq_len = inputs[0].shape[1]
-        attention_bias = torch.tril(torch.ones(seq_len, seq_len, dtype=torch.long, device=inputs[0].device), diagonal=0)
-        self.attention_bias = attention_bias.unsqueeze(0).unsqueeze(1)
+        seq_len, device = inputs[0].shape[1], inputs[0].device
+        if not hasattr(self, 'causal_mask_cache'):
+            self.causal_mask_cache = {}
+        causal_mask = self.causal_mask_cache.get(device)
+        if (causal_mask is None) or (causal_mask.size(-1) < seq_len):
+            causal_mask = torch.tril(torch.ones(seq_len, seq_len, dtype=torch.long, device=device), diagonal=0)
+            self.causal_mask_cache[device] = causal_mask
+        self.attention_bias = causal_mask[:seq_len, :seq_len].unsqueeze(0).unsqueeze(1)
         return self.attention_bias
 
 def extend_with_language_model(InputModel):
@@ -609,6 +755,7 @@ class BERT(BERT_BASE):
             layer_add_embs=None, # addtional_embeddng, 比如加入词性，音调，word粒度的自定义embedding
             is_dropout=False,
             token_pad_ids=0,  # 默认0是padding ids, 但是注意google的mt5padding不是0
+            unpad=False,  # 是否去除padding后执行transformer层, 仅对padding mask的encoder生效
             **kwargs  # 其余参数
     ):
         super(BERT, self).__init__(**kwargs)
@@ -622,6 +769,7 @@ class BERT(BERT_BASE):
         self.shared_segment_embeddings = shared_segment_embeddings
         self.is_dropout = is_dropout
         self.token_pad_ids = token_pad_ids
+        self.unpad = unpad
         if self.with_nsp and not self.with_pool:
             self.with_pool = True
         self.layer_norm_conds = layer_norm_cond
@@ -630,9 +778,9 @@ class BERT(BERT_BASE):
         self.embeddings = BertEmbeddings(self.vocab_size, self.embedding_size, self.hidden_size, self.max_position, self.segment_vocab_size, self.shared_segment_embeddings, 
                                          self.dropout_rate, self.conditional_size, **get_kw(BertEmbeddings, kwargs))
         kwargs['max_position'] = self.max_position  # 相对位置编码需要使用    
-        layer = BertLayer(self.hidden_size, self.num_attention_heads, self.dropout_rate, self.attention_probs_dropout_prob, self.intermediate_size, self.hidden_act, 
-                          is_dropout=self.is_dropout, conditional_size=self.conditional_size, **get_kw(BertLayer, kwargs))
-        self.encoderLayer = nn.ModuleList([copy.deepcopy(layer) if layer_id in self.keep_hidden_layers else Identity() for layer_id in range(self.num_hidden_layers)])
+        self.encoderLayer = self.get_layers(lambda: BertLayer(self.hidden_size, self.num_attention_heads, self.dropout_rate, self.attention_probs_dropout_prob, 
+                                                              self.intermediate_size, self.hidden_act, is_dropout=self.is_dropout, 
+                                                              conditional_size=self.conditional_size, **get_kw(BertLayer, kwargs)))
         if self.with_pool:
             # Pooler部分（提取CLS向量）
             self.pooler = nn.Linear(self.hidden_size, self.hidden_size)
@@ -655,9 +803,10 @@ class BERT(BERT_BASE):
             self.mlmDecoder.bias = self.mlmBias
         # 下述继承于BERT的有声明新的参数，在这里初始化不能统一初始化到
 
-    def apply_embeddings(self, inputs):
+    def apply_embeddings(self, inputs, cache=None):
         """BERT的embedding是token、position、segment三者embedding之和
         默认顺序是token_ids, segment_ids(若有), position_ids(若有), custom_attention_mask(若有), conditional_input(若有)
+        cache: 增量解码时forward传入的缓存, 读取历史key的mask并写入本次的mask
         """
         token_ids = inputs[0]
         index_ = 1
@@ -667,7 +816,7 @@ class BERT(BERT_BASE):
         else:
             segment_ids = None
 
-        if self.custom_position_ids:  # 暂未使用到，暂保留
+        if self.custom_position_ids:  # 自定义位置id, 如拼接多个文档时每个文档的位置从0开始
             position_ids = inputs[index_]
             index_ += 1
         else:
@@ -675,7 +824,9 @@ class BERT(BERT_BASE):
         # 根据token_ids创建一个3D的attention mask矩阵，尺寸为[batch_size, 1, 1, to_seq_length]，
         # 目的是为了适配多头注意力机制，从而能广播到[batch_size, num_heads, from_seq_length, to_seq_length]尺寸
         if self.custom_attention_mask:
-            attention_mask = inputs[index_].long().unsqueeze(1).unsqueeze(2)
+            # [btz, seq_len]为key的padding mask, [btz, seq_len, seq_len]可自定义各token的可见范围(如拼接多个文档时文档间不可见)
+            attention_mask = inputs[index_].long()
+            attention_mask = attention_mask.unsqueeze(1).unsqueeze(2) if attention_mask.dim() == 2 else attention_mask.unsqueeze(1)
             index_ += 1
         elif (not token_ids.requires_grad) and (token_ids.dtype in {torch.long, torch.int}): # 正常的token_ids
             attention_mask = (token_ids != self.token_pad_ids).long().unsqueeze(1).unsqueeze(2)  # 默认0为mask_value
@@ -690,17 +841,34 @@ class BERT(BERT_BASE):
             attention_mask = attention_mask * self.attention_bias  # 不可访问padding
             # attention_mask = self.attention_bias  # 可以访问padding
 
+        # 增量解码: 新token可访问全部历史key(padding除外)，位置编号从历史长度开始
+        past_len = 0
+        if cache is not None:
+            key_mask = attention_mask[:, :, -1:, :]  # 最后一行即为当前各key是否可被后续token访问
+            if cache['past_states'] is not None:
+                past_attention_mask = cache['past_states']['attention_mask']  # [btz, 1, 1, past_len]
+                past_len = past_attention_mask.size(-1)
+                attention_mask = torch.cat([past_attention_mask.expand(-1, -1, attention_mask.size(2), -1), 
+                                            attention_mask.expand(past_attention_mask.size(0), -1, -1, -1)], dim=-1)
+                key_mask = torch.cat([past_attention_mask, key_mask], dim=-1)
+            cache['attention_mask'] = key_mask
+        if past_len > 0:
+            # 位置从各样本历史有效token数开始, 兼容batch解码时右侧padding的情况
+            position_ids = past_attention_mask.flatten(1).sum(1, keepdim=True) + torch.arange(token_ids.size(1), device=token_ids.device).unsqueeze(0)
+
         # pytorch >= 1.5时候会导致StopIteration错误
         # https://github.com/huggingface/transformers/issues/3936
         # https://github.com/huggingface/transformers/issues/4189
         # https://github.com/huggingface/transformers/issues/3936
+        # autocast时参数仍为float32, mask保持float32, 和bf16/fp16的attention_scores相加时会提升为float32再做softmax
         try:
             attention_mask = attention_mask.to(dtype=next(self.parameters()).dtype)  # 兼容fp16
         except StopIteration:
             attention_mask = attention_mask.to(dtype=torch.float32)
         
         # 对mask矩阵中，数值为0的转换成很大的负数，使得不需要attention的位置经过softmax后,分数趋近于0
-        # attention_mask = (1.0 - attention_mask) * -10000.0
+        # 仅在这里转换一次, 各层直接与attention_scores相加
+        attention_mask = (1.0 - attention_mask) * -10000.0
         # conditional layer_norm
         if self.layer_norm_conds is None:
             conditional_emb = None
@@ -722,10 +890,10 @@ class BERT(BERT_BASE):
             additional_embs = None
 
         # 进入embedding层
-        hidden_states = self.embeddings(token_ids, segment_ids, conditional_emb, additional_embs)
+        hidden_states = self.embeddings(token_ids, segment_ids, conditional_emb, additional_embs, position_ids)
         return [hidden_states, attention_mask, conditional_emb] + inputs[index_:]
 
-    def apply_main_layers(self, inputs):
+    def apply_main_layers(self, inputs, cache=None):
         """BERT的主体是基于Self-Attention的模块
         顺序:Att --> Add --> LN --> FFN --> Add --> LN
         默认第一个是hidden_states, 第二个是attention_mask, 第三个是conditional_emb
@@ -737,13 +905,57 @@ class BERT(BERT_BASE):
             encoder_hidden_state, encoder_attention_mask = None, None
 
         encoded_layers = [hidden_states] # 添加embedding的输出
-        for layer_module in self.encoderLayer:
-            hidden_states = layer_module(hidden_states, attention_mask, conditional_emb, encoder_hidden_state, encoder_attention_mask)
-            if self.output_all_encoded_layers:
-                encoded_layers.append(hidden_states)
+        hidden_states = self.apply_layers(self.encoderLayer, encoded_layers, attention_mask, conditional_emb, encoder_hidden_state, encoder_attention_mask,
+                                          cache=cache)
         if not self.output_all_encoded_layers:
             encoded_layers.append(hidden_states)
         return [encoded_layers, conditional_emb]
+
+    def apply_layers(self, layers, encoded_layers, attention_mask, conditional_emb, encoder_hidden_state=None, encoder_attention_mask=None, 
+                     position_bias=None, cache=None):
+        """依次执行各个transformer层，cache不为None时读取并记录各层的K/V缓存
+           position_bias: 各层共享的相对位置偏置(如t5)，不为None时传给各层
+        """
+        layer_kwargs = {} if position_bias is None else {'position_bias': position_bias}
+        if encoder_attention_mask is not None:
+            # encoder传入的是0/1的padding mask, 和self attention一样转成加性mask, 各层共用
+            encoder_attention_mask = (1.0 - encoder_attention_mask.to(encoder_hidden_state.dtype)) * -10000.0
+        hidden_states = encoded_layers[-1]
+        past_states = cache['past_states'] if cache is not None else None
+        past_key_values = past_states['past_key_values'] if past_states is not None else [None] * len(layers)
+        present_key_values = []
+        unpad_indices = None if cache is not None else self.get_unpad_indices(layers, attention_mask, conditional_emb, encoder_hidden_state)
+        if unpad_indices is not None:
+            batch_size, seq_len = hidden_states.shape[:2]
+            hidden_states = unpad_input(hidden_states, unpad_indices)  # [total_tokens, hidden_size]
+        for layer_module, past_key_value in zip(layers, past_key_values):
+            if cache is not None:
+                hidden_states, present_key_value = layer_module(hidden_states, attention_mask, conditional_emb, encoder_hidden_state, encoder_attention_mask,
+                                                                past_key_value=past_key_value, use_states=True, **layer_kwargs)
+                present_key_values.append(present_key_value)
+            elif unpad_indices is not None:
+                hidden_states = self.apply_layer(layer_module, hidden_states, attention_mask, unpad_indices=unpad_indices)
+            else:
+                hidden_states = self.apply_layer(layer_module, hidden_states, attention_mask, conditional_emb, encoder_hidden_state, encoder_attention_mask, 
+                                                 **layer_kwargs)
+            if self.output_all_encoded_layers:
+                encoded_layers.append(hidden_states if unpad_indices is None else pad_input(hidden_states, unpad_indices, batch_size, seq_len))
+
+        if unpad_indices is not None:
+            hidden_states = pad_input(hidden_states, unpad_indices, batch_size, seq_len)  # 恢复成padding格式, padding位置为0
+        if cache is not None:
+            cache['past_key_values'] = present_key_values
+        return hidden_states
+
+    def get_unpad_indices(self, layers, attention_mask, conditional_emb, encoder_hidden_state=None):
+        """unpad模式下返回有效token的位置, 不满足条件时返回None走原有的padding逻辑
+           仅支持纯padding mask(不含lm/unilm等mask)且各层为BertLayer的encoder
+        """
+        if (not self.unpad) or (attention_mask.size(2) != 1) or (conditional_emb is not None) or (encoder_hidden_state is not None):
+            return None
+        if any(type(layer).forward not in {BertLayer.forward, Identity.forward} for layer in layers):
+            return None
+        return (attention_mask.flatten() == 0).nonzero(as_tuple=True)[0]  # 加性mask中有效位置为0
     
     def apply_final_layers(self, inputs):
         """根据剩余参数决定输出
@@ -857,7 +1069,7 @@ class ALBERT(BERT):
 
         encoded_layers = [hidden_states] # 添加embedding的输出
         for _ in range(self.num_hidden_layers):
-            hidden_states = self.encoderLayer[0](hidden_states, attention_mask, conditional_emb, encoder_hidden_state, encoder_attention_mask)
+            hidden_states = self.apply_layer(self.encoderLayer[0], hidden_states, attention_mask, conditional_emb, encoder_hidden_state, encoder_attention_mask)
             if self.output_all_encoded_layers:
                 encoded_layers.append(hidden_states)
         if not self.output_all_encoded_layers:
@@ -943,7 +1155,7 @@ class ALBERT_Unshared(ALBERT):
 
         encoded_layers = [hidden_states] # 添加embedding的输出
         for i in range(self.num_hidden_layers):
-            hidden_states = self.encoderLayer[i](hidden_states, attention_mask, conditional_emb, encoder_hidden_state, encoder_attention_mask)
+            hidden_states = self.apply_layer(self.encoderLayer[i], hidden_states, attention_mask, conditional_emb, encoder_hidden_state, encoder_attention_mask)
             if self.output_all_encoded_layers:
                 encoded_layers.append(hidden_states)
         if not self.output_all_encoded_layers:
@@ -958,6 +1170,10 @@ class NEZHA(BERT):
     def __init__(self, *args, **kwargs):
         kwargs.update({'p_bias': 'typical_relative', 'max_relative_position': kwargs.get('max_relative_position')})  # p_bias来控制embedding阶段无pos_embedding
         super(NEZHA, self).__init__(*args, **kwargs)
+        # 相对位置编码不参与训练，各层共享同一份编码表
+        layers = [layer for layer in self.encoderLayer if hasattr(layer, 'multiHeadAttention')]
+        for layer in layers[1:]:
+            layer.multiHeadAttention.relative_positions_encoding = layers[0].multiHeadAttention.relative_positions_encoding
 
 
 class RoFormer(BERT):
@@ -1024,8 +1240,7 @@ class GAU_alpha(RoFormerV2):
         kwargs.update({'p_bias': 'rotary', 'weight': False, 'bias': False, 'norm_mode': 'rmsnorm', 'normalization': 'softmax_plus'})
         super().__init__(*args, **kwargs)
 
-        layer = self.GAU_Layer(**kwargs)
-        self.encoderLayer = nn.ModuleList([copy.deepcopy(layer) if layer_id in self.keep_hidden_layers else Identity() for layer_id in range(self.num_hidden_layers)])
+        self.encoderLayer = self.get_layers(lambda: self.GAU_Layer(**kwargs))
     
     def load_variable(self, state_dict, name, prefix=''):
         variable = state_dict[name]
@@ -1100,7 +1315,7 @@ class Encoder(BERT):
         """
         # Embedding
         outputs = self.apply_embeddings(inputs)
-        encoder_attention_mask = [outputs[1]]
+        encoder_attention_mask = [self.attention_mask_cache]  # 0/1的padding mask，outputs[1]已转为加性mask
         # Main
         outputs = self.apply_main_layers(outputs)
         # Final
@@ -1127,16 +1342,14 @@ class Decoder(LM_Mask, BERT):
             else:
                 self.x_logit_scale = 1.
 
-    def apply_main_layers(self, inputs):
+    def apply_main_layers(self, inputs, cache=None):
         """Dencoder主体是基于Self-Attention、Cross-Attention的模块
         顺序：Att1 --> Add --> LN --> Att2 --> Add -->  LN --> FFN --> Add --> LN
         """
         hidden_states, attention_mask, conditional_emb, encoder_hidden_state, encoder_attention_mask = inputs[:5]
         decoded_layers = [hidden_states] # 添加embedding的输出
-        for i, layer_module in enumerate(self.decoderLayer):
-            hidden_states = layer_module(hidden_states, attention_mask, conditional_emb, encoder_hidden_state, encoder_attention_mask)
-            if self.output_all_encoded_layers:
-                decoded_layers.append(hidden_states)
+        hidden_states = self.apply_layers(self.decoderLayer, decoded_layers, attention_mask, conditional_emb, encoder_hidden_state, encoder_attention_mask,
+                                          cache=cache)
         if not self.output_all_encoded_layers:
             decoded_layers.append(hidden_states)
         return [decoded_layers, conditional_emb]
@@ -1306,16 +1519,30 @@ class T5_Encoder(Encoder):
         del self.embeddings.layerNorm
 
         # t5的layernorm都在前面，因此重新定义了下
-        layer = T5Layer(self.hidden_size, self.num_attention_heads, self.dropout_rate, self.attention_probs_dropout_prob, self.intermediate_size, self.hidden_act, is_dropout=self.is_dropout, 
-                            conditional_size=self.conditional_size, **get_kw(BertLayer, kwargs))
-        self.encoderLayer = nn.ModuleList([copy.deepcopy(layer) for _ in range(self.num_hidden_layers)])
+        self.encoderLayer = self.get_layers(lambda: T5Layer(self.hidden_size, self.num_attention_heads, self.dropout_rate, self.attention_probs_dropout_prob, 
+                                                            self.intermediate_size, self.hidden_act, is_dropout=self.is_dropout, 
+                                                            conditional_size=self.conditional_size, **get_kw(BertLayer, kwargs)), 
+                                            use_keep_hidden_layers=False)
 
-        # 把第二层后的相对位置编码的权重绑定到第一层上，变相实现仅由第一层计算
+        # 把第二层后的相对位置编码的权重绑定到第一层上，实际由第一层计算后在apply_main_layers中传给各层
         for i in range(1, self.num_hidden_layers):
             self.encoderLayer[i].multiHeadAttention.relative_positions_encoding.weight = self.encoderLayer[0].multiHeadAttention.relative_positions_encoding.weight
-        self.final_layer_norm = LayerNorm(self.hidden_size, eps=1e-12, conditional_size=self.conditional_size, bias=False, mode='rmsnorm')
+            self.encoderLayer[i].multiHeadAttention.relative_positions = self.encoderLayer[0].multiHeadAttention.relative_positions
+        self.final_layer_norm = LayerNorm(self.hidden_size, eps=1e-12, conditional_size=self.conditional_size, bias=False, mode='rmsnorm', 
+                                          fused_ops=kwargs.get('fused_ops'))
         self.dropout = nn.Dropout(self.dropout_rate)
 
+    def apply_main_layers(self, inputs):
+        """相对位置偏置仅计算一次，各层共享
+        """
+        hidden_states, attention_mask, conditional_emb = inputs[:3]
+        position_bias = self.encoderLayer[0].multiHeadAttention.get_position_bias(hidden_states.size(1), attention_mask.size(-1))
+        encoded_layers = [hidden_states] # 添加embedding的输出
+        hidden_states = self.apply_layers(self.encoderLayer, encoded_layers, attention_mask, conditional_emb, position_bias=position_bias)
+        if not self.output_all_encoded_layers:
+            encoded_layers.append(hidden_states)
+        return [encoded_layers, conditional_emb]
+
     def apply_final_layers(self, inputs):
         hidden_states = super().apply_final_layers(inputs)
         return self.dropout(self.final_layer_norm([hidden_states]))
@@ -1363,16 +1590,31 @@ class T5_Decoder(Decoder):
         del self.embeddings.layerNorm
 
         # t5的layernorm都在前面，因此重新定义了下
-        layer = T5Layer(self.hidden_size, self.num_attention_heads, self.dropout_rate, self.attention_probs_dropout_prob, self.intermediate_size, self.hidden_act, is_dropout=self.is_dropout, 
-                            conditional_size=self.conditional_size, is_decoder=True, **get_kw(BertLayer, kwargs))
-        self.decoderLayer = nn.ModuleList([copy.deepcopy(layer) for _ in range(self.num_hidden_layers)])
+        self.decoderLayer = self.get_layers(lambda: T5Layer(self.hidden_size, self.num_attention_heads, self.dropout_rate, self.attention_probs_dropout_prob, 
+                                                            self.intermediate_size, self.hidden_act, is_dropout=self.is_dropout, 
+                                                            conditional_size=self.conditional_size, is_decoder=True, **get_kw(BertLayer, kwargs)), 
+                                            use_keep_hidden_layers=False)
         
-        # 把第二层后的相对位置编码的权重绑定到第一层上，变相实现仅由第一层计算
+        # 把第二层后的相对位置编码的权重绑定到第一层上，实际由第一层计算后在apply_main_layers中传给各层
         for i in range(1, self.num_hidden_layers):
             self.decoderLayer[i].multiHeadAttention.relative_positions_encoding.weight = self.decoderLayer[0].multiHeadAttention.relative_positions_encoding.weight
-        self.final_layer_norm = LayerNorm(self.hidden_size, eps=1e-12, conditional_size=self.conditional_size, bias=False, mode='rmsnorm')
+            self.decoderLayer[i].multiHeadAttention.relative_positions = self.decoderLayer[0].multiHeadAttention.relative_positions
+        self.final_layer_norm = LayerNorm(self.hidden_size, eps=1e-12, conditional_size=self.conditional_size, bias=False, mode='rmsnorm', 
+                                          fused_ops=kwargs.get('fused_ops'))
         self.dropout = nn.Dropout(self.dropout_rate)
 
+    def apply_main_layers(self, inputs, cache=None):
+        """相对位置偏置仅计算一次，各层共享，增量解码时key_len包含历史长度
+        """
+        hidden_states, attention_mask, conditional_emb, encoder_hidden_state, encoder_attention_mask = inputs[:5]
+        position_bias = self.decoderLayer[0].multiHeadAttention.get_position_bias(hidden_states.size(1), attention_mask.size(-1))
+        decoded_layers = [hidden_states] # 添加embedding的输出
+        hidden_states = self.apply_layers(self.decoderLayer, decoded_layers, attention_mask, conditional_emb, encoder_hidden_state, encoder_attention_mask,
+                                          position_bias=position_bias, cache=cache)
+        if not self.output_all_encoded_layers:
+            decoded_layers.append(hidden_states)
+        return [decoded_layers, conditional_emb]
+
     def apply_final_layers(self, inputs):
         inputs[0][1] = self.dropout(self.final_layer_norm([inputs[0][1]]))  # 在转logit前把最后一层的hidden_states加layernorm
         return super().apply_final_layers(inputs)
@@ -1499,9 +1741,10 @@ class GPT2(LM_Mask, BERT):
         """
         super(GPT2, self).__init__(max_position, **kwargs)
         del self.embeddings.layerNorm
-        layer = self.Gpt2Layer(self.hidden_size, self.num_attention_heads, self.dropout_rate, self.attention_probs_dropout_prob, self.intermediate_size, self.hidden_act, is_dropout=self.is_dropout, conditional_size=self.conditional_size)
-        self.encoderLayer = nn.ModuleList([copy.deepcopy(layer) if layer_id in self.keep_hidden_layers else Identity() for layer_id in range(self.num_hidden_layers)])
-        self.LayerNormFinal = LayerNorm(self.hidden_size, eps=1e-12, conditional_size=self.conditional_size)
+        self.encoderLayer = self.get_layers(lambda: self.Gpt2Layer(self.hidden_size, self.num_attention_heads, self.dropout_rate, self.attention_probs_dropout_prob, 
+                                                                 self.intermediate_size, self.hidden_act, is_dropout=self.is_dropout, conditional_size=self.conditional_size, 
+                                                                 attn_impl=kwargs.get('attn_impl'), fused_ops=kwargs.get('fused_ops')))
+        self.LayerNormFinal = LayerNorm(self.hidden_size, eps=1e-12, conditional_size=self.conditional_size, fused_ops=kwargs.get('fused_ops'))
         self.dense = nn.Linear(self.hidden_size, self.vocab_size, bias=False)
         self.dense.weight = self.embeddings.word_embeddings.weight
         self.final_activation = get_activation(self.final_activation)
@@ -1528,15 +1771,18 @@ class GPT2(LM_Mask, BERT):
         '''
         def __init__(self, *args, **kwargs):
             super().__init__(*args, **kwargs)
-        def forward(self, hidden_states, attention_mask, conditional_emb=None, encoder_hidden_states=None, encoder_attention_mask=None):
+        def forward(self, hidden_states, attention_mask, conditional_emb=None, encoder_hidden_states=None, encoder_attention_mask=None, 
+                    past_key_value=None, use_states=False):
             # bert的layernorm是在attn/ffc之后，Openai-gpt2是在之前
             x = self.layerNorm1((hidden_states, conditional_emb))
-            self_attn_output = self.multiHeadAttention(x, attention_mask)
-            hidden_states = hidden_states + self.dropout1(self_attn_output)
+            self_attn_output = self.multiHeadAttention(x, attention_mask, past_key_value=past_key_value, use_states=use_states)
+            if use_states:
+                self_attn_output, present_key_value = self_attn_output
+            hidden_states = self.residual(self_attn_output, hidden_states, self.dropout1)
             x = self.layerNorm2((hidden_states, conditional_emb))
             ffn_output = self.feedForward(x)
-            hidden_states = hidden_states + self.dropout2(ffn_output)
-            return hidden_states
+            hidden_states = self.residual(ffn_output, hidden_states, self.dropout2)
+            return (hidden_states, present_key_value) if use_states else hidden_states
 
 
 class GPT2_ML(LM_Mask, BERT):
@@ -1549,8 +1795,9 @@ class GPT2_ML(LM_Mask, BERT):
     @delete_arguments('with_pool', 'with_mlm', 'with_nsp')
     def __init__(self, max_position, **kwargs):
         super().__init__(max_position, **kwargs)
-        layer = self.Gpt2MlLayer(self.hidden_size, self.num_attention_heads, self.dropout_rate, self.attention_probs_dropout_prob, self.intermediate_size, self.hidden_act, is_dropout=self.is_dropout, conditional_size=self.conditional_size)
-        self.encoderLayer = nn.ModuleList([copy.deepcopy(layer) if layer_id in self.keep_hidden_layers else Identity() for layer_id in range(self.num_hidden_layers)])
+        self.encoderLayer = self.get_layers(lambda: self.Gpt2MlLayer(self.hidden_size, self.num_attention_heads, self.dropout_rate, self.attention_probs_dropout_prob, 
+                                                                 self.intermediate_size, self.hidden_act, is_dropout=self.is_dropout, conditional_size=self.conditional_size, 
+                                                                 attn_impl=kwargs.get('attn_impl'), fused_ops=kwargs.get('fused_ops')))
         self.dense = nn.Linear(self.hidden_size, self.vocab_size, bias=False)
         self.dense.weight = self.embeddings.word_embeddings.weight
         self.final_activation = get_activation(self.final_activation)
@@ -1575,15 +1822,18 @@ class GPT2_ML(LM_Mask, BERT):
         '''
         def __init__(self, *args, **kwargs):
             super().__init__(*args, **kwargs)
-        def forward(self, hidden_states, attention_mask, conditional_emb=None, encoder_hidden_states=None, encoder_attention_mask=None):
-            self_attn_output = self.multiHeadAttention(hidden_states, attention_mask)
-            hidden_states = hidden_states + self.dropout1(self_attn_output)
+        def forward(self, hidden_states, attention_mask, conditional_emb=None, encoder_hidden_states=None, encoder_attention_mask=None, 
+                    past_key_value=None, use_states=False):
+            self_attn_output = self.multiHeadAttention(hidden_states, attention_mask, past_key_value=past_key_value, use_states=use_states)
+            if use_states:
+                self_attn_output, present_key_value = self_attn_output
+            hidden_states = self.residual(self_attn_output, hidden_states, self.dropout1)
             x = self.layerNorm1((hidden_states, conditional_emb))
             # bert的跳跃连接是在layerNorm之后，gpt2_ml是在layerNorm之前
             ffn_output = self.feedForward(x)
-            hidden_states = hidden_states + self.dropout2(ffn_output)
+            hidden_states = self.residual(ffn_output, hidden_states, self.dropout2)
             hidden_states = self.layerNorm2((hidden_states, conditional_emb))
-            return hidden_states
+            return (hidden_states, present_key_value) if use_states else hidden_states
 
 
 class Transformer_XL(BERT):
@@ -1729,7 +1979,7 @@ class Transformer_XL(BERT):
 
         for i, layer_module in enumerate(self.encoderLayer):
             mems_i = None if self.mems is None else self.mems[i]
-            hidden_states = layer_module(hidden_states, segment_ids, pos_emb, attention_mask, mems_i, conditional_emb)
+            hidden_states = self.apply_layer(layer_module, hidden_states, segment_ids, pos_emb, attention_mask, mems_i, conditional_emb)
             encoded_layers.append(hidden_states)
         
         # 原实现中word_emb, pos_emb和core_out(hidden_states)使用同一个dropout
@@ -1912,12 +2162,21 @@ def build_transformer_model(
     elif application == 'unilm':
         MODEL = extend_with_unified_language_model(MODEL)
 
-    transformer = MODEL(**configs)
+    # skip_init仅在加载checkpoint时生效: 构建时不做随机初始化, 加载后仅初始化checkpoint中没有的权重
+    configs['skip_init'] = configs.get('skip_init', False) and (checkpoint_path is not None)
+    if configs['skip_init']:
+        with skip_init_weights():
+            transformer = MODEL(**configs)
+    else:
+        transformer = MODEL(**configs)
     transformer.build(**configs)
-    transformer.apply(transformer.init_model_weights)  # 初始化权重
+    if not configs['skip_init']:
+        transformer.apply(transformer.init_model_weights)  # 初始化权重
 
     if checkpoint_path is not None:
-        transformer.load_weights_from_pytorch_checkpoint(checkpoint_path)
+        missing_keys = transformer.load_weights_from_pytorch_checkpoint(checkpoint_path)
+        if configs['skip_init']:
+            transformer.init_missing_weights(missing_keys)
     if return_model_config:
         return transformer, configs
     else:
@@ -10,14 +10,17 @@ from torch.nn.utils.rnn import pad_sequence
 import time
 import sys
 import collections
+import collections.abc
+from contextlib import contextmanager
 import torch.nn as nn
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 import math
 import gc
 import inspect
 import json
 import torch.nn.functional as F
 import random
+import os
 
 
 is_py2 = six.PY2
@@ -225,6 +228,20 @@ def sequence_padding(inputs, length=None, value=0, seq_dims=1, mode='post'):
         raise ValueError('"input" argument must be tensor/list/ndarray.')
 
 
+def unpad_input(hidden_states, indices):
+    """去除padding, [btz, seq_len, ...] -> [total_tokens, ...], indices为有效token在btz*seq_len中的位置
+    """
+    return hidden_states.flatten(0, 1).index_select(0, indices)
+
+
+def pad_input(hidden_states, indices, batch_size, seq_len):
+    """unpad_input的逆操作, [total_tokens, ...] -> [btz, seq_len, ...], padding位置填0
+    """
+    outputs = hidden_states.new_zeros((batch_size * seq_len,) + hidden_states.shape[1:])
+    outputs = outputs.index_copy(0, indices, hidden_states)
+    return outputs.view((batch_size, seq_len) + hidden_states.shape[1:])
+
+
 def insert_arguments(**arguments):
     """装饰器，为类方法增加参数（主要用于类的__init__方法）
     """
@@ -505,7 +522,9 @@ class ProgbarLogger(Callback):
 
         # Skip progbar update for the last batch;
         # will be handled by on_epoch_end.
-        if self.verbose and self.seen < self.target:
+        # Also skip steps without synced metrics (fit with log_interval>1),
+        # so that the next update weights the averaged values by all the steps.
+        if self.verbose and self.seen < self.target and self.log_values:
             self.progbar.update(self.seen, self.log_values)
 
     def on_epoch_end(self, global_step=None, epoch=None, logs=None):
@@ -524,7 +543,8 @@ class ProgbarLogger(Callback):
 def metric_mapping(metric, y_pred, y_true):
     if metric == 'accuracy':
         y_pred = torch.argmax(y_pred, dim=-1)
-        acc = torch.sum(y_pred.eq(y_true)).item() / y_true.size(0)
+        # 返回tensor, 由fit按log_interval统一同步
+        acc = torch.sum(y_pred.eq(y_true)).float() / y_true.size(0)
         return acc
     return None
 
@@ -606,10 +626,25 @@ class AutoRegressiveDecoder(object):
         说明: 定义的时候，需要用wraps方法进行装饰，传入default_rtype和use_states，
              其中default_rtype为字符串logits或probas，probas时返回归一化的概率，
              rtype=logits时则返回softmax前的结果或者概率对数。
+             use_states=True时可配合模型的K/V缓存使用，即states为None时输入完整序列，
+             否则仅输入output_ids[:, -1:]，如model.predict([token_ids], states=states, use_states=True)
         返回: 二元组 (得分或概率, states)
         """
         raise NotImplementedError
 
+    @staticmethod
+    def select_states(states, indices):
+        """按照indices选取states中batch维度(第0维)对应的行，用于beam search重排和剔除已完成序列
+        说明: states中的tensor需以batch为第0维，非tensor元素(如计数)原样返回
+        """
+        if isinstance(states, torch.Tensor):
+            return states[indices]
+        elif isinstance(states, (list, tuple)):
+            return type(states)(AutoRegressiveDecoder.select_states(i, indices) for i in states)
+        elif isinstance(states, dict):
+            return {k: AutoRegressiveDecoder.select_states(v, indices) for k, v in states.items()}
+        return states
+
     def beam_search(self, inputs_raw, topk, states=None, temperature=1, min_ends=1, add_btz_dim=True):
         """beam search解码
         说明: 这里的topk即beam size；
@@ -638,6 +673,7 @@ class AutoRegressiveDecoder(object):
             indices_2 = (indices % scores.shape[1]).reshape((-1, 1))  # 列索引
             output_ids = torch.cat([output_ids[indices_1], indices_2], 1)  # 更新输出
             output_scores = torch.take_along_dim(scores, indices, dim=None)  # 更新得分
+            states = self.select_states(states, indices_1)  # 缓存跟随beam重排
             is_end = output_ids[:, -1] == self.end_id  # 标记是否以end标记结束
             end_counts = (output_ids == self.end_id).sum(1)  # 统计出现的end标记
             if output_ids.shape[1] >= self.minlen:  # 最短长度判断
@@ -651,10 +687,68 @@ class AutoRegressiveDecoder(object):
                         output_ids = output_ids[flag]  # 扔掉已完成序列
                         output_scores = output_scores[flag]  # 扔掉已完成序列
                         end_counts = end_counts[flag]  # 扔掉已完成end计数
+                        states = self.select_states(states, flag)  # 扔掉已完成序列的缓存
                         topk = flag.sum()  # topk相应变化
         # 达到长度直接输出
         return output_ids[output_scores.argmax()]
 
+    def batch_beam_search(self, inputs_raw, topk, states=None, temperature=1, min_ends=1):
+        """batch版beam search解码, 每一步用一次前向同时计算btz*topk条候选
+        说明: inputs_raw的每个元素为btz个样本的输入, 可以是tensor或者待padding的list/ndarray；
+             每个样本单独维护topk个beam，最优beam完成后该样本即从batch中移除；
+        返回: btz个最优解码序列组成的list。
+        """
+        inputs = []
+        for i in inputs_raw:
+            if isinstance(i, torch.Tensor):
+                pass
+            elif isinstance(i, (list, tuple, np.ndarray)):
+                i = torch.tensor(sequence_padding(i), device=self.device)
+            else:
+                raise ValueError('Beam search inputs ele only support tensor、array、list、tuple')
+            inputs.append(i)
+
+        btz = inputs[0].shape[0]
+        results = [None] * btz
+        batch_ids = list(range(btz))  # 未完成样本在原batch中的位置
+        output_ids = self.first_output_ids.repeat(btz, 1)
+        output_scores = torch.zeros(btz, 1, device=self.device)  # [btz, beam数]
+        for step in range(self.maxlen):
+            scores, states = self.predict(inputs, output_ids, states, temperature, 'logits')  # 计算当前得分, [btz*beam数, vocab_size]
+            if step == 0:  # 第1步预测后将输入重复topk次
+                inputs = [i.repeat_interleave(topk, dim=0) for i in inputs]
+            vocab_size, n_beams = scores.shape[-1], output_scores.shape[1]
+            scores = (output_scores.reshape(-1, 1) + scores).reshape(len(batch_ids), -1)  # 综合累积得分, [btz, beam数*vocab_size]
+            output_scores, indices = scores.topk(topk, dim=-1)  # 每个样本仅保留topk, 并更新得分
+            indices_1 = torch.div(indices, vocab_size, rounding_mode='trunc')  # 样本内的行索引
+            indices_1 = (indices_1 + torch.arange(len(batch_ids), device=scores.device).unsqueeze(1) * n_beams).flatten()  # 全局行索引
+            indices_2 = (indices % vocab_size).reshape((-1, 1))  # 列索引
+            output_ids = torch.cat([output_ids[indices_1], indices_2], 1)  # 更新输出
+            states = self.select_states(states, indices_1)  # 缓存跟随beam重排
+            is_end = (output_ids[:, -1] == self.end_id).reshape(-1, topk)  # 标记是否以end标记结束
+            end_counts = (output_ids == self.end_id).sum(1).reshape(-1, topk)  # 统计出现的end标记
+            if output_ids.shape[1] >= self.minlen:  # 最短长度判断
+                best = output_scores.argmax(dim=1)  # 每个样本得分最大的那个
+                is_finished = is_end & (end_counts >= min_ends)  # 标记已完成序列
+                flag = ~is_finished[torch.arange(len(batch_ids), device=scores.device), best]  # 标记最优beam未完成的样本
+                for row in (~flag).nonzero().flatten().tolist():  # 最优beam已终止的样本直接输出
+                    results[batch_ids[row]] = output_ids[row * topk + best[row]]
+                if not flag.any():
+                    return results
+                output_scores = output_scores.masked_fill(is_finished, -float('inf'))  # 已完成的非最优beam不再扩展
+                if not flag.all():  # 扔掉已完成的样本
+                    beam_flag = flag.repeat_interleave(topk)
+                    inputs = [i[beam_flag] for i in inputs]
+                    output_ids = output_ids[beam_flag]
+                    output_scores = output_scores[flag]
+                    states = self.select_states(states, beam_flag)
+                    batch_ids = [b for b, f in zip(batch_ids, flag.tolist()) if f]
+        # 达到长度直接输出
+        best = output_scores.argmax(dim=1)
+        for row, b in enumerate(batch_ids):
+            results[b] = output_ids[row * topk + best[row]]
+        return results
+
     def random_sample(
         self,
         inputs,
@@ -680,6 +774,7 @@ class AutoRegressiveDecoder(object):
                 probas = probas.repeat([n]+[1]*(len(probas.shape)-1))
                 inputs = [i.repeat([n]+[1]*(len(i.shape)-1)) for i in inputs]
                 output_ids = output_ids.repeat([n]+[1]*(len(output_ids.shape)-1))
+                states = self.select_states(states, torch.zeros(n, dtype=torch.long, device=self.device))
             if topk is not None:
                 k_indices = probas.argsort(dim=-1, descending=True)[:, :topk]  # 仅保留topk
                 probas = torch.take_along_dim(probas, k_indices, dim=1)  # topk概率
@@ -712,6 +807,7 @@ class AutoRegressiveDecoder(object):
                     inputs = [i[flag] for i in inputs]  # 只保留未完成部分输入
                     output_ids = output_ids[flag]  # 只保留未完成部分候选集
                     end_counts = end_counts[flag]  # 只保留未完成部分end计数
+                    states = self.select_states(states, flag)  # 只保留未完成部分缓存
                     if len(output_ids) == 0:
                         break
         # 如果还有未完成序列，直接放入结果
@@ -755,6 +851,88 @@ class ListDataset(Dataset):
         return file_path
 
 
+class BucketBatchSampler(Sampler):
+    """按长度分桶的batch_sampler，长度相近的样本组成一个batch，batch大小由max_tokens(batch内最大长度*样本数)控制
+       用法：DataLoader(dataset, batch_sampler=BucketBatchSampler(dataset, max_tokens=4096), collate_fn=collate_fn)
+       collate_fn中使用sequence_padding即可padding到batch内最大长度
+
+       lengths: 各样本的长度，不传入时使用length_fn(dataset[i])计算，默认取样本(或样本首个元素)的len
+       bucket_size: 每个桶包含的样本数，桶内按长度排序后切分batch，桶越大padding越少但随机性越差
+       num_replicas/rank: DDP时的进程数和当前进程序号，默认从torch.distributed中获取
+    """
+    def __init__(self, dataset=None, max_tokens=4096, lengths=None, length_fn=None, bucket_size=1024, max_batch_size=None,
+                 shuffle=True, drop_last=False, num_replicas=None, rank=None, seed=0):
+        if lengths is None:
+            length_fn = length_fn or (lambda x: len(x[0]) if isinstance(x, (tuple, list)) else len(x))
+            lengths = [length_fn(dataset[i]) for i in range(len(dataset))]
+        self.lengths = np.array(lengths)
+        self.max_tokens = max_tokens
+        self.bucket_size = bucket_size
+        self.max_batch_size = max_batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size() if torch.distributed.is_available() and torch.distributed.is_initialized() else 1
+        if rank is None:
+            rank = torch.distributed.get_rank() if torch.distributed.is_available() and torch.distributed.is_initialized() else 0
+        self.num_replicas, self.rank = num_replicas, rank
+        self.seed = seed
+        self.epoch = 0
+        self.epoch_iterated = False  # 当前epoch的batch是否已被遍历过
+        self.batches_cache = None  # (epoch, batches)
+
+    def set_epoch(self, epoch):
+        """和DistributedSampler一致，各进程设置相同的epoch以保证划分一致
+        """
+        self.epoch = epoch
+        self.epoch_iterated = False
+
+    def get_batches(self):
+        """生成当前epoch本进程的全部batch，相同的seed和epoch结果一致
+        """
+        if (self.batches_cache is not None) and (self.batches_cache[0] == self.epoch):
+            return self.batches_cache[1]
+
+        rng = np.random.RandomState(self.seed + self.epoch)
+        indices = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = indices[start:start+self.bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')]
+            batch, max_len = [], 0
+            for idx in bucket:
+                new_max_len = max(max_len, self.lengths[idx])
+                # 加入该样本后超出预算则另起一个batch，单条样本超出预算时单独成batch
+                if batch and ((new_max_len * (len(batch) + 1) > self.max_tokens) or (len(batch) == self.max_batch_size)):
+                    batches.append(batch)
+                    batch, new_max_len = [], self.lengths[idx]
+                batch.append(int(idx))
+                max_len = new_max_len
+            if batch:
+                batches.append(batch)
+        if self.shuffle:  # 在batch粒度上打乱
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+
+        # DDP时各进程batch数需一致
+        if self.drop_last:
+            batches = batches[:len(batches) // self.num_replicas * self.num_replicas]
+        elif len(batches) % self.num_replicas != 0:
+            batches += batches[:self.num_replicas - len(batches) % self.num_replicas]
+        batches = batches[self.rank::self.num_replicas]
+        self.batches_cache = (self.epoch, batches)
+        return batches
+
+    def __iter__(self):
+        # 未手动调用set_epoch时，再次遍历前自动进入下一个epoch换一种划分；遍历期间epoch不变，__len__与正在遍历的batch一致
+        if self.shuffle and self.epoch_iterated:
+            self.epoch += 1
+        self.epoch_iterated = True
+        return iter(self.get_batches())
+
+    def __len__(self):
+        return len(self.get_batches())
+
+
 # sinusoid编码
 def get_sinusoid_encoding_table(n_position, d_hid, padding_idx=None):
     '''Returns: [seq_len, d_hid]
@@ -804,6 +982,161 @@ def get_kw(cls, kwargs):
     return kwargs_new
 
 
+@contextmanager
+def skip_init_weights():
+    '''构建模型时跳过nn.Linear/nn.Embedding的随机初始化, 参数仅分配内存(未初始化), 需要随后加载权重
+    '''
+    classes = [nn.Linear, nn.Embedding]
+    reset_parameters = [cls.reset_parameters for cls in classes]
+    for cls in classes:
+        cls.reset_parameters = lambda self: None
+    try:
+        yield
+    finally:
+        for cls, fn in zip(classes, reset_parameters):
+            cls.reset_parameters = fn
+
+
+class SafetensorsStateDict(collections.abc.Mapping):
+    '''按需读取.safetensors文件中的tensor, 只有被访问到的tensor才会读入内存
+    '''
+    def __init__(self, checkpoint):
+        from safetensors import safe_open
+        self.file = safe_open(checkpoint, framework='pt', device='cpu')
+        self.names = list(self.file.keys())
+
+    def __getitem__(self, name):
+        if name not in self.file.keys():
+            raise KeyError(name)
+        return self.file.get_tensor(name)
+
+    def __contains__(self, name):
+        return name in self.file.keys()
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+
+def load_checkpoint(checkpoint, mmap=True):
+    '''加载checkpoint, 返回{name: tensor}
+    .safetensors文件按需读取各个tensor; 分片保存的checkpoint按需读取各个分片;
+    其余使用torch.load, mmap=True(torch>=2.1)时tensor映射到文件, 仅在使用时读入内存
+    '''
+    index_file = get_shard_index_file(checkpoint)
+    if index_file is not None:
+        return ShardedStateDict(index_file, mmap=mmap)
+    if checkpoint.endswith('.safetensors'):
+        return SafetensorsStateDict(checkpoint)
+    if mmap:
+        try:
+            return torch.load(checkpoint, map_location='cpu', mmap=True)
+        except (TypeError, RuntimeError):
+            # 旧版本torch不支持mmap参数, 或者不是zip格式(torch<1.6保存)的文件
+            pass
+    return torch.load(checkpoint, map_location='cpu')
+
+
+def parse_size(size):
+    '''把'2GB', '500MB'等转为字节数
+    '''
+    if isinstance(size, int):
+        return size
+    units = {'KB': 2**10, 'MB': 2**20, 'GB': 2**30, 'TB': 2**40}
+    size = size.upper().strip()
+    for unit, scale in units.items():
+        if size.endswith(unit):
+            return int(float(size[:-len(unit)]) * scale)
+    return int(size)
+
+
+def get_shard_index_file(checkpoint):
+    '''分片保存时返回索引文件路径, 否则返回None
+    checkpoint可以是索引文件本身, 也可以是save_weights时传入的save_path
+    '''
+    if checkpoint.endswith('.index.json'):
+        return checkpoint
+    if (not os.path.exists(checkpoint)) and os.path.exists(checkpoint + '.index.json'):
+        return checkpoint + '.index.json'
+    return None
+
+
+def compact_tensor(tensor):
+    '''tensor为大storage的切片(如sdpa时q/k/v是qkv的切片)时clone一份, 避免torch.save写入整个storage
+    '''
+    try:
+        storage_size = tensor.untyped_storage().nbytes()
+    except AttributeError:  # torch<2.0
+        storage_size = tensor.storage().size() * tensor.element_size()
+    return tensor.clone() if storage_size > tensor.numel() * tensor.element_size() else tensor
+
+
+def save_sharded_state_dict(state_dict, save_path, max_shard_size='2GB'):
+    '''按max_shard_size分片保存state_dict, 并写入{save_path}.index.json索引文件
+    分片文件名为{name}-00001-of-00003{ext}, 同一个模块下的权重(如q/k/v)不会被拆到不同分片
+    '''
+    max_shard_size = parse_size(max_shard_size)
+    # 按模块分组, 保证加载时load_state_dict的hook(如qkv合并)能拿到完整的权重
+    groups = collections.OrderedDict()
+    for name, tensor in state_dict.items():
+        groups.setdefault(name.rsplit('.', 2)[0], []).append(name)
+
+    shards, shard, shard_size, total_size = [], [], 0, 0
+    for names in groups.values():
+        group_size = sum([state_dict[name].numel() * state_dict[name].element_size() for name in names])
+        if shard and (shard_size + group_size > max_shard_size):
+            shards.append(shard)
+            shard, shard_size = [], 0
+        shard.extend(names)
+        shard_size += group_size
+        total_size += group_size
+    if shard:
+        shards.append(shard)
+
+    save_dir, file_name = os.path.split(save_path)
+    stem, ext = os.path.splitext(file_name)
+    weight_map = {}
+    for i, names in enumerate(shards):
+        shard_file = f'{stem}-{i+1:05d}-of-{len(shards):05d}{ext}'
+        torch.save({name: compact_tensor(state_dict[name]) for name in names}, os.path.join(save_dir, shard_file))
+        weight_map.update({name: shard_file for name in names})
+
+    index = {'metadata': {'total_size': total_size}, 'weight_map': weight_map}
+    with open(save_path + '.index.json', 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=2, ensure_ascii=False)
+    return save_path + '.index.json'
+
+
+class ShardedStateDict(collections.abc.Mapping):
+    '''分片保存的checkpoint, 访问到某个tensor时才加载其所在的分片
+    '''
+    def __init__(self, index_file, mmap=True):
+        self.save_dir = os.path.dirname(index_file)
+        self.mmap = mmap
+        with open(index_file, encoding='utf-8') as f:
+            self.weight_map = json.load(f)['weight_map']
+        self.shards = {}
+
+    def load_shard(self, shard_file):
+        if shard_file not in self.shards:
+            self.shards[shard_file] = load_checkpoint(os.path.join(self.save_dir, shard_file), mmap=self.mmap)
+        return self.shards[shard_file]
+
+    def __getitem__(self, name):
+        return self.load_shard(self.weight_map[name])[name]
+
+    def __contains__(self, name):
+        return name in self.weight_map
+
+    def __iter__(self):
+        return iter(self.weight_map)
+
+    def __len__(self):
+        return len(self.weight_map)
+
+
 class FGM():
     '''对抗训练
     '''
@@ -1069,4 +1402,48 @@ def get_pool_emb(hidden_state=None, pooler=None, attention_mask=None, pool_strat
         attention_mask = torch.sum(attention_mask, dim=1)[:, None]
         return hid / (i * attention_mask)
     else:
-        raise ValueError('pool_strategy illegal')
\ No newline at end of file
+        raise ValueError('pool_strategy illegal')
+
+def gplinker_decode(entity_output, head_output, tail_output, mask=None, threshold=0, texts=None, mappings=None):
+    ''' GPLinker的三元组解码，整个batch一起处理
+        entity_output: [btz, 2, seq_len, seq_len], subject/object的GlobalPointer输出
+        head_output, tail_output: [btz, predicate_num, seq_len, seq_len], subject和object首/尾配对的GlobalPointer输出
+        mask: [btz, seq_len], padding部分为0, 首尾的[CLS]和[SEP]不作为实体
+        texts, mappings: 原文和tokenizer.rematch的结果, 传入时返回各样本的[(subject, predicate_id, object)]
+        否则返回[n, 6]的tensor, 每行为(batch_id, subject_start, subject_end, predicate_id, object_start, object_end)
+    '''
+    btz, _, seq_len, _ = entity_output.shape
+    if mask is None:
+        mask = torch.ones(btz, seq_len, dtype=torch.long, device=entity_output.device)
+    valid = mask.bool().clone()
+    valid[:, 0] = False
+    valid[torch.arange(btz, device=valid.device), mask.sum(dim=1).long() - 1] = False
+
+    # 抽取subject和object, 每行为(batch_id, 0为subject/1为object, start, end)
+    entities = (entity_output > threshold).nonzero()
+    entities = entities[valid[entities[:, 0], entities[:, 2]] & valid[entities[:, 0], entities[:, 3]]]
+    subjects, objects = entities[entities[:, 1] == 0], entities[entities[:, 1] == 1]
+
+    # 同一样本内的subject和object两两配对
+    sub_idx, obj_idx = (subjects[:, :1] == objects[:, 0].unsqueeze(0)).nonzero(as_tuple=True)
+    subjects, objects = subjects[sub_idx], objects[obj_idx]
+    batch_ids = subjects[:, 0]
+
+    # 识别对应的predicate, 首和尾均大于阈值
+    head_scores = head_output[batch_ids, :, subjects[:, 2], objects[:, 2]]  # [pair_num, predicate_num]
+    tail_scores = tail_output[batch_ids, :, subjects[:, 3], objects[:, 3]]  # [pair_num, predicate_num]
+    pair_idx, predicates = ((head_scores > threshold) & (tail_scores > threshold)).nonzero(as_tuple=True)
+    spoes = torch.stack([batch_ids[pair_idx], subjects[pair_idx, 2], subjects[pair_idx, 3], predicates,
+                         objects[pair_idx, 2], objects[pair_idx, 3]], dim=1)
+    if texts is None:
+        return spoes
+
+    # 批量映射回原文的字符位置
+    char_starts = sequence_padding([[j[0] if j else 0 for j in mapping] for mapping in mappings], length=seq_len)
+    char_ends = sequence_padding([[j[-1] if j else 0 for j in mapping] for mapping in mappings], length=seq_len)
+    b, sh, st, p, oh, ot = spoes.cpu().numpy().T
+    sh, st, oh, ot = char_starts[b, sh], char_ends[b, st] + 1, char_starts[b, oh], char_ends[b, ot] + 1
+    results = [set() for _ in range(btz)]
+    for i in range(len(b)):
+        results[b[i]].add((texts[b[i]][sh[i]:st[i]], int(p[i]), texts[b[i]][oh[i]:ot[i]]))
+    return [list(i) for i in results]
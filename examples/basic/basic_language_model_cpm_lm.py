@@ -43,11 +43,12 @@ model = build_transformer_model(
 class TextExpansion(AutoRegressiveDecoder):
     """基于随机采样的文本续写
     """
-    @AutoRegressiveDecoder.wraps(default_rtype='probas')
+    @AutoRegressiveDecoder.wraps(default_rtype='probas', use_states=True)
     def predict(self, inputs, output_ids, states):
-        token_ids = torch.cat([inputs[0], output_ids], 1)
-        logits = model.predict([token_ids])
-        return logits[:, -1, :]
+        # 第一步输入完整序列，后续仅输入新生成的token，历史的K/V从states中读取
+        token_ids = torch.cat([inputs[0], output_ids], 1) if states is None else output_ids[:, -1:]
+        logits, states = model.predict([token_ids], states=states, use_states=True)
+        return logits[:, -1, :], states
 
     def generate(self, text, n=1, topp=0.95, temperature=1):
         """输出结果会有一定的随机性，如果只关心Few Shot效果，
@@ -2,89 +2,18 @@
 # 将清华开源的中文GPT2模型（26亿参数）
 # 项目链接(tf版本)：https://github.com/TsinghuaAI/CPM-Generate
 # pytorch版权重下载链接：https://huggingface.co/TsinghuaAI/CPM-Generate，经过本脚本转成bert4torch适用的权重
+# 逐个tensor转换并分片保存，build_transformer_model时checkpoint_path仍传output_ckpt_file即可
 
-import torch
+from bert4torch.convert import convert_checkpoint
 
 ckpt_dir = 'F:/Projects/pretrain_ckpt/gpt2/[cpm_gpt2_torch]--cpm_lm_2.6b'
 ckpt_file = f'{ckpt_dir}/pytorch_model.bin'
 output_ckpt_file = f'{ckpt_dir}/bert4torch_pytorch_model.bin'
-num_hidden_layers = 32
+max_shard_size = '2GB'  # 设为None则保存为单个文件
 
 
 def convert():
-    torch_weights = torch.load(ckpt_file)
-    new_weights = {}
-    prefix = 'gpt2'
-
-    w = torch_weights['transformer.wte.weight']
-    new_weights[f'{prefix}.embeddings.word_embeddings.weight'] = w
-
-    w = torch_weights['transformer.wpe.weight']
-    new_weights[f'{prefix}.embeddings.position_embeddings.weight'] = w
-
-    qkv = ['query', 'key', 'value']
-    for i in range(num_hidden_layers):
-        prefix_i = f'{prefix}.encoder.layer.%d.' % i
-
-        # q, k, v
-        w = torch_weights['transformer.h.%s.attn.c_attn.weight' % i]
-        ws = torch.chunk(w, 3, dim=1)
-        for k, w in zip(qkv, ws):
-            name = prefix_i + f'attention.self.{k}.weight'
-            new_weights[name] = w.T
-        b = torch_weights['transformer.h.%s.attn.c_attn.bias' % i]
-        bs = torch.chunk(b, 3, dim=0)
-        for k, b in zip(qkv, bs):
-            name = prefix_i + f'attention.self.{k}.bias'
-            new_weights[name] = b
-
-        # hdsz-hdsz的全连接
-        w = torch_weights['transformer.h.%s.attn.c_proj.weight' % i]
-        name = prefix_i + 'attention.output.dense.weight'
-        new_weights[name] = w.T
-        b = torch_weights['transformer.h.%s.attn.c_proj.bias' % i]
-        name = prefix_i + 'attention.output.dense.bias'
-        new_weights[name] = b
-
-        # layernorm1
-        w = torch_weights['transformer.h.%s.ln_1.weight' % i]
-        name = prefix_i + 'attention.output.LayerNorm.weight'
-        new_weights[name] = w
-        b = torch_weights['transformer.h.%s.ln_1.bias' % i]
-        name = prefix_i + 'attention.output.LayerNorm.bias'
-        new_weights[name] = b
-
-        # feed forward 第一层
-        w = torch_weights['transformer.h.%s.mlp.c_fc.weight' % i]
-        name = prefix_i + 'intermediate.dense.weight'
-        new_weights[name] = w.T
-        b = torch_weights['transformer.h.%s.mlp.c_fc.bias' % i]
-        name = prefix_i + 'intermediate.dense.bias'
-        new_weights[name] = b
-
-        # feed forward 第二层
-        w = torch_weights['transformer.h.%s.mlp.c_proj.weight' % i]
-        name = prefix_i + 'output.dense.weight'
-        new_weights[name] = w.T
-        b = torch_weights['transformer.h.%s.mlp.c_proj.bias' % i]
-        name = prefix_i + 'output.dense.bias'
-        new_weights[name] = b
-
-        # layernorm2
-        w = torch_weights['transformer.h.%s.ln_2.weight' % i]
-        name = prefix_i + 'output.LayerNorm.weight'
-        new_weights[name] = w
-        b = torch_weights['transformer.h.%s.ln_2.bias' % i]
-        name = prefix_i + 'output.LayerNorm.bias'
-        new_weights[name] = b
-
-        # layernorm_final
-        w = torch_weights['transformer.ln_f.weight']
-        new_weights[f'{prefix}.LayerNormFinal.weight'] = w
-        b = torch_weights['transformer.ln_f.bias']
-        new_weights[f'{prefix}.LayerNormFinal.bias'] = b
-        
-    torch.save(new_weights, output_ckpt_file)
+    convert_checkpoint(ckpt_file, output_ckpt_file, 'gpt2', max_shard_size=max_shard_size, prefix='gpt2', src_prefix='transformer.')
 
 if __name__ == '__main__':
     convert()
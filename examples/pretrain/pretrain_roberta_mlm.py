@@ -3,6 +3,7 @@
 # 改DDP需几行代码，参考https://github.com/Tongjilibo/bert4torch/blob/master/examples/training_trick/task_distributed_data_parallel.py
 
 from bert4torch.models import build_transformer_model
+from bert4torch.tokenizers import Tokenizer
 from bert4torch.snippets import sequence_padding, Callback
 from bert4torch.optimizers import get_linear_schedule_with_warmup
 from torch.utils.data import Dataset
@@ -10,9 +11,9 @@ import torch.nn as nn
 import torch
 import torch.optim as optim
 from torch.utils.data import DataLoader
+import numpy as np
 import json
 import os
-import shelve
 import random
 import time
 
@@ -25,7 +26,11 @@ task_name = 'roberta'
 # 其他配置
 maxlen = 512
 batch_size = 7
+packing = True  # 语料是否由多个段落拼接而成(数据生成脚本中packing=True), 此时各段落间互不可见, 位置id各自从0开始
+dynamic_mask = True  # 语料是否未做mask(数据生成脚本中dynamic_mask=True), 此时在collate_fn中动态做全词mask
+mask_rate = 0.15
 config_path = 'F:/Projects/pretrain_ckpt/bert/[google_tf_base]--chinese_L-12_H-768_A-12/bert_config.json'
+dict_path = 'F:/Projects/pretrain_ckpt/bert/[google_tf_base]--chinese_L-12_H-768_A-12/vocab.txt'
 checkpoint_path = 'F:/Projects/pretrain_ckpt/bert/[google_tf_base]--chinese_L-12_H-768_A-12/pytorch_model.bin'  # 如果从零训练，就设为None
 learning_rate = 0.00176
 weight_decay_rate = 0.01  # 权重衰减
@@ -35,38 +40,93 @@ steps_per_epoch = 10000
 grad_accum_steps = 16  # 大于1即表明使用梯度累积
 epochs = num_train_steps * grad_accum_steps // steps_per_epoch
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
+tokenizer = Tokenizer(dict_path, do_lower_case=True)
 
 
 # 读取数据集，构建数据张量
-class MyDataset(Dataset):
+class MmapDataset(Dataset):
+    '''读取数据生成脚本写入的.bin/.idx.npy/.json文件, 通过np.memmap按需读取
+    '''
     def __init__(self, file):
-        super(MyDataset, self).__init__()
+        super(MmapDataset, self).__init__()
         self.file = file
-        self.len = self._get_dataset_length()
-        self.db = self._load_data()
+        record_info = json.load(open(self.file + ".json", "r", encoding="utf-8"))
+        self.len = record_info["samples_num"]
+        self.fields, self.dtype = record_info["fields"], record_info["dtype"]
+        self.offsets = np.load(self.file + ".idx.npy")
+        self.data = None  # 在首次读取时打开，保证DataLoader的各个worker使用各自的memmap
 
     def __getitem__(self, index):
-        return self.db[str(index)]
+        if self.data is None:
+            self.data = self._load_data()
+        sample = self.data[self.offsets[index]:self.offsets[index+1]].reshape(len(self.fields), -1)
+        # 切片不拷贝数据, 直接转为tensor
+        return {field: torch.from_numpy(sample[i]) for i, field in enumerate(self.fields)}
 
     def __len__(self):
         return self.len
 
-    def _get_dataset_length(self):
-        file_record_info = self.file + ".json"
-        record_info = json.load(open(file_record_info, "r", encoding="utf-8"))
-        return record_info["samples_num"]
+    def __getstate__(self):
+        # 多进程时不序列化memmap，由子进程自行打开
+        state = self.__dict__.copy()
+        state['data'] = None
+        return state
 
     def _load_data(self):
-        return shelve.open(self.file)
+        # 'c'模式为copy-on-write，得到可写的array以便torch.from_numpy零拷贝转换，不会写回文件
+        return np.memmap(self.file + ".bin", dtype=self.dtype, mode='c')
+
+    def close(self):
+        self.data = None
+
+def get_packing_inputs(batch_document_ids):
+    '''根据document_ids生成位置id和attention_mask, 同一行中不同段落互不可见
+    '''
+    btz, seq_len = batch_document_ids.shape
+    index = torch.arange(seq_len, device=batch_document_ids.device).expand(btz, -1)
+    is_start = torch.ones_like(batch_document_ids, dtype=torch.bool)
+    is_start[:, 1:] = batch_document_ids[:, 1:] != batch_document_ids[:, :-1]
+    # 每个段落的起始位置, 用cummax向后传播
+    start_index = torch.cummax(torch.where(is_start, index, torch.zeros_like(index)), dim=1).values
+    batch_position_ids = index - start_index
+    # [btz, seq_len, seq_len], 仅同一段落且非padding的位置可见
+    attention_mask = (batch_document_ids.unsqueeze(2) == batch_document_ids.unsqueeze(1)) & (batch_document_ids.unsqueeze(1) > 0)
+    return batch_position_ids, attention_mask
+
+def whole_word_mask(batch_token_ids, batch_word_starts):
+    '''动态全词mask, 按mask_rate选中整个词, 选中的token以80%的几率替换为[MASK]，以10%的几率保持不变，以10%的几率替换为一个随机token
+    batch_word_starts: 每个词首个token为1，其余为0
+    '''
+    # 每个token所属的词编号，同一个词共用一个随机数
+    batch_word_ids = batch_word_starts.cumsum(dim=1)
+    word_rands = torch.rand(batch_word_ids.shape[0], batch_word_ids.shape[1] + 1)
+    is_masked = torch.gather(word_rands, 1, batch_word_ids) < mask_rate
+    special_ids = torch.tensor([tokenizer._token_pad_id, tokenizer._token_start_id, tokenizer._token_end_id])
+    is_masked &= ~torch.isin(batch_token_ids, special_ids)
+
+    batch_labels = torch.where(is_masked, batch_token_ids, torch.zeros_like(batch_token_ids))
+    rands = torch.rand(batch_token_ids.shape)
+    batch_token_ids = torch.where(is_masked & (rands <= 0.8), torch.full_like(batch_token_ids, tokenizer._token_mask_id), batch_token_ids)
+    random_token_ids = torch.randint(0, tokenizer._vocab_size, batch_token_ids.shape)
+    batch_token_ids = torch.where(is_masked & (rands > 0.9), random_token_ids, batch_token_ids)
+    return batch_token_ids, batch_labels
 
 def collate_fn(batch):
-    batch_token_ids, batch_labels = [], []
+    batch_token_ids, batch_labels, batch_document_ids = [], [], []
     for item in batch:
         batch_token_ids.append(item['input_ids'])
-        batch_labels.append(item['masked_lm_labels'])
-
-    batch_token_ids = torch.tensor(sequence_padding(batch_token_ids), dtype=torch.long, device=device)
-    batch_labels = torch.tensor(batch_labels, dtype=torch.long, device=device)
+        batch_labels.append(item['word_starts'] if dynamic_mask else item['masked_lm_labels'])
+        if packing:
+            batch_document_ids.append(item['document_ids'])
+
+    batch_token_ids = sequence_padding(batch_token_ids).long()
+    batch_labels = sequence_padding(batch_labels).long()
+    if dynamic_mask:  # 此时batch_labels为word_starts
+        batch_token_ids, batch_labels = whole_word_mask(batch_token_ids, batch_labels)
+    batch_token_ids, batch_labels = batch_token_ids.to(device), batch_labels.to(device)
+    if packing:
+        batch_document_ids = sequence_padding(batch_document_ids).long().to(device)
+        return [batch_token_ids, *get_packing_inputs(batch_document_ids)], batch_labels
     return [batch_token_ids], batch_labels
 
 
@@ -75,17 +135,16 @@ def get_train_dataloader():
     while True:
         # prepare dataset
         files_training_data = os.listdir(dir_training_data)
-        files_training_data = [file.split(".")[0] for file in files_training_data if "train" in file]
-        # 防止使用到正在生成的文件
-        files_training_data = [i for i in set(files_training_data) if files_training_data.count(i)==4]
+        # .json最后写入, 防止使用到正在生成的文件
+        files_training_data = [file.split(".")[0] for file in files_training_data if ("train" in file) and file.endswith(".json")]
         if files_training_data:
             file_train = random.choice(files_training_data)
-            for suffix in [".bak", ".dat", ".dir", ".json"]:
+            for suffix in [".bin", ".idx.npy", ".json"]:
                 file_old = os.path.join(dir_training_data, file_train + suffix)
                 file_new = os.path.join(dir_training_data, task_name + suffix)
                 os.renames(file_old, file_new)
             cur_load_file = file_new.split(".")[0]
-            train_dataloader = DataLoader(MyDataset(cur_load_file), batch_size=batch_size, shuffle=True, collate_fn=collate_fn)
+            train_dataloader = DataLoader(MmapDataset(cur_load_file), batch_size=batch_size, shuffle=True, collate_fn=collate_fn)
             break
         else:
             print("No training data! Sleep 300s!")
@@ -94,7 +153,8 @@ def get_train_dataloader():
     return train_dataloader
 train_dataloader = get_train_dataloader()
 
-model = build_transformer_model(config_path, checkpoint_path, segment_vocab_size=0, with_mlm=True).to(device)
+model = build_transformer_model(config_path, checkpoint_path, segment_vocab_size=0, with_mlm=True, 
+                                custom_position_ids=packing, custom_attention_mask=packing).to(device)
 
 # weight decay
 param_optimizer = list(model.named_parameters())
@@ -122,9 +182,9 @@ class ModelCheckpoint(Callback):
     """自动保存最新模型
     """
     def on_dataloader_end(self, logs=None):
-        # 在dataloader结束的时候，关闭db并且删除训练的文件
-        model.train_dataloader.dataset.db.close()
-        for suffix in [".bak", ".dat", ".dir", ".json"]:
+        # 在dataloader结束的时候，关闭memmap并且删除训练的文件
+        model.train_dataloader.dataset.close()
+        for suffix in [".bin", ".idx.npy", ".json"]:
             file_remove = os.path.join(dir_training_data, task_name + suffix)
             try:
                 os.remove(file_remove)
@@ -1,17 +1,18 @@
 #! -*- coding: utf-8 -*-
 # 预训练语料构建，这里实现的mlm任务的，NSP和SOP未使用
 # 方案：一直动态生成文件，超过最大保存数目时候sleep，
-# 当训练速度超过文件生成速度时候，可开启多个数据生成脚本
+# 当训练速度超过文件生成速度时候，可设置num_workers多进程按语料文件分片生成
+# 文件格式：{record_name}.bin为各样本各字段首尾相接的token数组, {record_name}.idx.npy为各样本在.bin中的起始位置,
+#          {record_name}.json记录字段名、dtype和样本数, 最后写入, 存在即表示文件已生成完毕
 
 import numpy as np
 from bert4torch.tokenizers import Tokenizer
 import json, glob, re
 from tqdm import tqdm
-import collections
 import gc
-import shelve
 import time
 import os
+import multiprocessing
 import random
 import jieba
 jieba.initialize()
@@ -20,17 +21,21 @@ jieba.initialize()
 class TrainingDataset(object):
     """预训练数据集生成器
     """
-    def __init__(self, tokenizer, sequence_length=512):
+    def __init__(self, tokenizer, sequence_length=512, packing=False):
         """参数说明：
             tokenizer必须是bert4keras自带的tokenizer类；
+            packing为True时将多个段落拼接到同一个样本中, 减少padding, 并额外保存document_ids用于区分各段落
         """
         self.tokenizer = tokenizer
         self.sequence_length = sequence_length
+        self.packing = packing
+        self.pack_buffer, self.pack_paddings = None, None  # packing时尚未写满的样本
         self.token_pad_id = tokenizer._token_pad_id
         self.token_cls_id = tokenizer._token_start_id
         self.token_sep_id = tokenizer._token_end_id
         self.token_mask_id = tokenizer._token_mask_id
         self.vocab_size = tokenizer._vocab_size
+        self.dtype = 'int16' if self.vocab_size < 32768 else 'int32'  # token id均小于vocab_size, 节省磁盘
 
     def padding(self, sequence, padding_value=None):
         """对单个序列进行补0
@@ -63,11 +68,11 @@ class TrainingDataset(object):
 
             # 如果长度即将溢出
             if new_length > self.sequence_length - 1:
-                # 插入终止符，并padding
+                # 插入终止符，并padding(packing时在拼接后统一padding)
                 complete_instance = []
                 for item, end, pad in zip(instance, ends, paddings):
                     item.append(end)
-                    item = self.padding(item, pad)
+                    item = item if self.packing else self.padding(item, pad)
                     complete_instance.append(item)
                 # 存储结果，并构建新样本
                 instances.append(complete_instance)
@@ -81,43 +86,71 @@ class TrainingDataset(object):
         complete_instance = []
         for item, end, pad in zip(instance, ends, paddings):
             item.append(end)
-            item = self.padding(item, pad)
+            item = item if self.packing else self.padding(item, pad)
             complete_instance.append(item)
 
         # 存储最后的instance
         instances.append(complete_instance)
 
-        return instances
+        return self.pack(instances, paddings) if self.packing else instances
 
-    def serialize(self, instances, db, count):
-        """写入到文件
+    def pack(self, instances, paddings):
+        """将未padding的instance依次拼接到长度接近sequence_length，段落末尾较短的instance可与下一段落拼接
+        额外增加一列document_ids，同一instance内相同，从1开始编号，padding部分为0
         """
+        packed_instances = []
         for instance in instances:
-            input_ids, masked_lm_labels = instance[0], instance[1]
-            assert len(input_ids) <= sequence_length
-            features = collections.OrderedDict()
-            features["input_ids"] = input_ids
-            features["masked_lm_labels"] = masked_lm_labels
-            db[str(count)] = features
-            count += 1
-        return count
+            if (self.pack_buffer is not None) and (len(self.pack_buffer[0]) + len(instance[0]) > self.sequence_length):
+                packed_instances.append(self.pack_flush())
+            if self.pack_buffer is None:
+                self.pack_buffer = [[] for _ in range(len(instance) + 1)]
+                self.pack_paddings = list(paddings) + [0]
+            document_ids = self.pack_buffer[-1]
+            document_id = document_ids[-1] + 1 if document_ids else 1
+            for item, sub_item in zip(self.pack_buffer, instance):
+                item.extend(sub_item)
+            document_ids.extend([document_id] * len(instance[0]))
+        return packed_instances
+
+    def pack_flush(self):
+        """对拼接中的样本做padding并返回
+        """
+        complete_instance = [self.padding(item, pad) for item, pad in zip(self.pack_buffer, self.pack_paddings)]
+        self.pack_buffer = None
+        return complete_instance
+
+    def serialize(self, instances, writer, offsets):
+        """写入到文件，各字段去除末尾padding后首尾相接写入, offsets记录每个样本的结束位置
+        """
+        for instance in instances:
+            input_ids = instance[0]
+            assert len(input_ids) <= self.sequence_length
+            length = len(input_ids)
+            while length > 0 and input_ids[length-1] == self.token_pad_id:
+                length -= 1
+            sample = np.array([item[:length] for item in instance], dtype=self.dtype)
+            writer.write(sample.tobytes())
+            offsets.append(offsets[-1] + sample.size)
+        return len(offsets) - 1
 
     def process(self, corpus, record_name):
         """处理输入语料（corpus）
         """
-        count = 0
-
-        db = shelve.open(record_name)
-        for texts in corpus:
-            instances = self.paragraph_process(texts)
-            count = self.serialize(instances, db, count)
-            
-        db.close()
-        del instances
+        count, offsets = 0, [0]
+
+        with open(record_name + '.bin', 'wb') as writer:
+            for texts in corpus:
+                instances = self.paragraph_process(texts)
+                count = self.serialize(instances, writer, offsets)
+            if self.packing and (self.pack_buffer is not None):
+                instances = [self.pack_flush()]
+                count = self.serialize(instances, writer, offsets)
+        np.save(record_name + '.idx.npy', np.array(offsets, dtype=np.int64))
         gc.collect()
 
-        # 记录对应的文件名和样本量
-        record_info = {"filename": record_name, "samples_num": count}
+        # 记录对应的文件名、字段和样本量, 最后写入
+        fields = self.fields + (['document_ids'] if self.packing else [])
+        record_info = {"filename": record_name, "samples_num": count, "fields": fields, "dtype": self.dtype}
         json.dump(record_info, open(record_name + ".json", "w", encoding="utf-8"))
 
         print('write %s examples into %s' % (count, record_name))
@@ -126,14 +159,17 @@ class TrainingDataset(object):
 class TrainingDatasetRoBERTa(TrainingDataset):
     """预训练数据集生成器（RoBERTa模式）
     """
-    def __init__(self, tokenizer, word_segment, mask_rate=0.15, sequence_length=512):
+    def __init__(self, tokenizer, word_segment, mask_rate=0.15, sequence_length=512, packing=False, dynamic_mask=False):
         """参数说明：
             tokenizer必须是bert4torch自带的tokenizer类；
             word_segment是任意分词函数。
+            dynamic_mask为True时不在生成阶段做mask，保存原始token_ids和词边界word_starts，由训练时的collate_fn动态mask
         """
-        super(TrainingDatasetRoBERTa, self).__init__(tokenizer, sequence_length)
+        super(TrainingDatasetRoBERTa, self).__init__(tokenizer, sequence_length, packing)
         self.word_segment = word_segment
         self.mask_rate = mask_rate
+        self.dynamic_mask = dynamic_mask
+        self.fields = ['input_ids', 'word_starts'] if dynamic_mask else ['input_ids', 'masked_lm_labels']
 
     def token_process(self, token_id):
         """以80%的几率替换为[MASK]，以10%的几率保持不变，
@@ -152,6 +188,8 @@ class TrainingDatasetRoBERTa(TrainingDataset):
         流程：分词，然后转id，按照mask_rate构建全词mask的序列, 来指定哪些token是否要被mask
         """
         words = self.word_segment(text)
+        if self.dynamic_mask:
+            return self.sentence_process_unmasked(words)
         rands = np.random.random(len(words))
 
         token_ids, mask_ids = [], []
@@ -171,30 +209,30 @@ class TrainingDatasetRoBERTa(TrainingDataset):
                 
         return [token_ids, mask_ids]
 
+    def sentence_process_unmasked(self, words):
+        """dynamic_mask时的处理函数，返回token_ids和word_starts(每个词首个token为1，其余为0)
+        """
+        token_ids, word_starts = [], []
+        for word in words:
+            word_token_ids = self.tokenizer.tokens_to_ids(self.tokenizer.tokenize(text=word)[1:-1])
+            token_ids.extend(word_token_ids)
+            word_starts.extend([1] + [0] * (len(word_token_ids) - 1) if word_token_ids else [])
+        return [token_ids, word_starts]
+
     def paragraph_process(self, texts):
         """给原方法补上starts、ends、paddings
         """
-        starts = [self.token_cls_id, 0]
-        ends = [self.token_sep_id, 0]
+        starts = [self.token_cls_id, 1 if self.dynamic_mask else 0]
+        ends = [self.token_sep_id, 1 if self.dynamic_mask else 0]
         paddings = [self.token_pad_id, 0]
         return super(TrainingDatasetRoBERTa, self).paragraph_process(texts, starts, ends, paddings)
 
 
-if __name__ == '__main__':
-    sequence_length = 512  # 文本长度
-    max_file_num = 40  # 最大保存的文件个数
-    dict_path = 'F:/Projects/pretrain_ckpt/bert/[google_tf_base]--chinese_L-12_H-768_A-12/vocab.txt'  # 字典文件
-    dir_training_data = 'E:/Github/bert4torch/examples/datasets/pretrain'  # 保存的文件目录
-    dir_corpus = 'F:/Projects/data/corpus/pretrain'  # 读入的语料地址
-    tokenizer = Tokenizer(dict_path, do_lower_case=True)
-
-    def some_texts():
-        '''挑选语料
-        '''
-        files_corpus = glob.glob(f'{dir_corpus}/*/*')  # 根据目录结构自行调整
-        file_corpus = random.choice(files_corpus)  # 随机挑选一篇文章
+def corpus_texts(files_corpus):
+    '''依次读取语料文件, 每10篇文章合在一起作为一个段落
+    '''
+    for file_corpus in files_corpus:
         count, texts = 0, []
-
         with open(file_corpus, encoding='utf-8') as f:
             for l in tqdm(f, desc=f'Load data from {file_corpus}'):
                 l = l.strip()
@@ -206,18 +244,63 @@ if __name__ == '__main__':
         if texts:
             yield texts
 
-    def word_segment(text):
-        return jieba.lcut(text)
 
-    TD = TrainingDatasetRoBERTa(tokenizer, word_segment, sequence_length=sequence_length)
+def word_segment(text):
+    return jieba.lcut(text)
 
-    while True:
-        train_files = [file for file in os.listdir(dir_training_data) if ('train_' in file) and ('dat' in file)]
-        # 当保存的训练文件未达到指定数量时
-        if len(train_files) < max_file_num:
-            record_name = f'{dir_training_data}/train_'+ time.strftime('%Y%m%d%H%M%S', time.localtime())
-            TD.process(corpus=some_texts(), record_name=record_name)
-            time.sleep(1)  # 可不加，这里是防止生成文件名一样
-        else:
-            time.sleep(300)
 
+def init_worker(dict_path, sequence_length, packing, dynamic_mask):
+    '''每个进程各自构建tokenizer和TrainingDataset, 避免每个任务重复序列化
+    '''
+    global TD
+    tokenizer = Tokenizer(dict_path, do_lower_case=True)
+    TD = TrainingDatasetRoBERTa(tokenizer, word_segment, sequence_length=sequence_length, packing=packing, dynamic_mask=dynamic_mask)
+
+
+def process_shard(args):
+    '''生成单个分片, 随机种子由分片决定, 同样的语料和分片方式结果可复现
+    '''
+    shard_id, files_corpus, record_name, seed = args
+    np.random.seed(seed)
+    random.seed(seed)
+    TD.pack_buffer = None
+    TD.process(corpus=corpus_texts(files_corpus), record_name=record_name)
+    record_info = json.load(open(record_name + '.json', encoding='utf-8'))
+    record_info.update({'shard_id': shard_id, 'files': files_corpus, 'seed': seed})
+    return record_info
+
+
+if __name__ == '__main__':
+    sequence_length = 512  # 文本长度
+    packing = True  # 是否将多个段落拼接成一个样本，需和训练脚本中的packing保持一致
+    dynamic_mask = True  # 是否在训练时动态mask，需和训练脚本中的dynamic_mask保持一致
+    max_file_num = 40  # 最大保存的文件个数
+    num_workers = 8  # 大于0时多进程一次性生成全部语料的分片，为0时按原方式循环动态生成
+    files_per_shard = 4  # 每个分片包含的语料文件数
+    seed = 42  # 各分片的随机种子为seed+shard_id
+    dict_path = 'F:/Projects/pretrain_ckpt/bert/[google_tf_base]--chinese_L-12_H-768_A-12/vocab.txt'  # 字典文件
+    dir_training_data = 'E:/Github/bert4torch/examples/datasets/pretrain'  # 保存的文件目录
+    dir_corpus = 'F:/Projects/data/corpus/pretrain'  # 读入的语料地址
+    files_corpus = sorted(glob.glob(f'{dir_corpus}/*/*'))  # 根据目录结构自行调整
+
+    if num_workers > 0:
+        # 按语料文件切分成若干分片，各进程独立写入各自的分片文件，最后写入manifest.json
+        shards = [(shard_id, files_corpus[i:i+files_per_shard], f'{dir_training_data}/train_{shard_id:05d}', seed + shard_id)
+                  for shard_id, i in enumerate(range(0, len(files_corpus), files_per_shard))]
+        with multiprocessing.Pool(num_workers, initializer=init_worker, initargs=(dict_path, sequence_length, packing, dynamic_mask)) as pool:
+            manifest = list(pool.imap_unordered(process_shard, shards))
+        manifest = sorted(manifest, key=lambda x: x['shard_id'])
+        json.dump({'shards': manifest, 'samples_num': sum(i['samples_num'] for i in manifest)}, 
+                  open(f'{dir_training_data}/manifest.json', 'w', encoding='utf-8'), ensure_ascii=False, indent=2)
+        print('write %s shards into %s' % (len(manifest), dir_training_data))
+    else:
+        init_worker(dict_path, sequence_length, packing, dynamic_mask)
+        while True:
+            train_files = [file for file in os.listdir(dir_training_data) if ('train_' in file) and file.endswith('.json')]
+            # 当保存的训练文件未达到指定数量时
+            if len(train_files) < max_file_num:
+                record_name = f'{dir_training_data}/train_'+ time.strftime('%Y%m%d%H%M%S', time.localtime())
+                TD.process(corpus=corpus_texts([random.choice(files_corpus)]), record_name=record_name)  # 随机挑选一个语料文件
+                time.sleep(1)  # 可不加，这里是防止生成文件名一样
+            else:
+                time.sleep(300)
@@ -7,7 +7,7 @@ import json
 from bert4torch.layers import GlobalPointer
 from bert4torch.tokenizers import Tokenizer
 from bert4torch.models import build_transformer_model, BaseModel
-from bert4torch.snippets import sequence_padding, Callback, ListDataset
+from bert4torch.snippets import sequence_padding, Callback, ListDataset, gplinker_decode
 from bert4torch.losses import SparseMultilabelCategoricalCrossentropy
 from tqdm import tqdm
 import torch
@@ -154,38 +154,21 @@ class MyLoss(SparseMultilabelCategoricalCrossentropy):
 
 model.compile(loss=MyLoss(mask_zero=True), optimizer=optim.Adam(model.parameters(), 1e-5), metrics=['entity_loss', 'head_loss', 'tail_loss'])
 
-def extract_spoes(text, threshold=0):
-    """抽取输入text所包含的三元组
+def extract_spoes(texts, threshold=0):
+    """批量抽取输入texts所包含的三元组
     """
-    tokens = tokenizer.tokenize(text, maxlen=maxlen)
-    mapping = tokenizer.rematch(text, tokens)
-    token_ids, segment_ids = tokenizer.encode(text, maxlen=maxlen)
-    token_ids = torch.tensor([token_ids], dtype=torch.long, device=device)
-    segment_ids = torch.tensor([segment_ids], dtype=torch.long, device=device)
-    outputs = model.predict([token_ids, segment_ids])
-    outputs = [o[0].cpu().numpy() for o in outputs]  # [heads, seq_len, seq_len]
-    # 抽取subject和object
-    subjects, objects = set(), set()
-    outputs[0][:, [0, -1]] -= float('inf')
-    outputs[0][:, :, [0, -1]] -= float('inf')
-    for l, h, t in zip(*np.where(outputs[0] > threshold)):
-        if l == 0:
-            subjects.add((h, t))
-        else:
-            objects.add((h, t))
-    # 识别对应的predicate
-    spoes = set()
-    for sh, st in subjects:
-        for oh, ot in objects:
-            p1s = np.where(outputs[1][:, sh, oh] > threshold)[0]
-            p2s = np.where(outputs[2][:, st, ot] > threshold)[0]
-            ps = set(p1s) & set(p2s)
-            for p in ps:
-                spoes.add((
-                    text[mapping[sh][0]:mapping[st][-1] + 1], id2predicate[p],
-                    text[mapping[oh][0]:mapping[ot][-1] + 1]
-                ))
-    return list(spoes)
+    batch_token_ids, batch_segment_ids, mappings = [], [], []
+    for text in texts:
+        tokens = tokenizer.tokenize(text, maxlen=maxlen)
+        mappings.append(tokenizer.rematch(text, tokens))
+        token_ids, segment_ids = tokenizer.encode(text, maxlen=maxlen)
+        batch_token_ids.append(token_ids)
+        batch_segment_ids.append(segment_ids)
+    batch_token_ids = torch.tensor(sequence_padding(batch_token_ids), dtype=torch.long, device=device)
+    batch_segment_ids = torch.tensor(sequence_padding(batch_segment_ids), dtype=torch.long, device=device)
+    outputs = model.predict([batch_token_ids, batch_segment_ids])
+    spoes = gplinker_decode(*outputs, mask=batch_token_ids.gt(0).long(), threshold=threshold, texts=texts, mappings=mappings)
+    return [[(s, id2predicate[p], o) for s, p, o in spo] for spo in spoes]
 
 
 class SPO(tuple):
@@ -209,18 +192,21 @@ def evaluate(data):
     X, Y, Z = 0, 1e-10, 1e-10
     f = open('dev_pred.json', 'w', encoding='utf-8')
     pbar = tqdm()
-    for d in data:
-        R = set([SPO(spo) for spo in extract_spoes(d['text'])])
-        T = set([SPO(spo) for spo in d['spo_list']])
-        X += len(R & T)
-        Y += len(R)
-        Z += len(T)
+    for i in range(0, len(data), batch_size):
+        batch_data = data[i:i+batch_size]
+        batch_spoes = extract_spoes([d['text'] for d in batch_data])
+        for d, spoes in zip(batch_data, batch_spoes):
+            R = set([SPO(spo) for spo in spoes])
+            T = set([SPO(spo) for spo in d['spo_list']])
+            X += len(R & T)
+            Y += len(R)
+            Z += len(T)
+            s = json.dumps({'text': d['text'], 'spo_list': list(T), 'spo_list_pred': list(R),
+                            'new': list(R - T), 'lack': list(T - R)}, ensure_ascii=False, indent=4)
+            f.write(s + '\n')
         f1, precision, recall = 2 * X / (Y + Z), X / Y, X / Z
-        pbar.update()
+        pbar.update(len(batch_data))
         pbar.set_description('f1: %.5f, precision: %.5f, recall: %.5f' % (f1, precision, recall))
-        s = json.dumps({'text': d['text'], 'spo_list': list(T), 'spo_list_pred': list(R),
-                        'new': list(R - T), 'lack': list(T - R)}, ensure_ascii=False, indent=4)
-        f.write(s + '\n')
     pbar.close()
     f.close()
     return f1, precision, recall
@@ -86,13 +86,18 @@ model.compile(loss=CrossEntropyLoss(ignore_index=0), optimizer=optim.Adam(model.
 class AutoTitle(AutoRegressiveDecoder):
     """seq2seq解码器
     """
-    @AutoRegressiveDecoder.wraps(default_rtype='logits')
+    @AutoRegressiveDecoder.wraps(default_rtype='logits', use_states=True)
     def predict(self, inputs, output_ids, states):
-        token_ids, segment_ids = inputs
-        token_ids = torch.cat([token_ids, output_ids], 1)
-        segment_ids = torch.cat([segment_ids, torch.ones_like(output_ids, device=device)], 1)
-        _, y_pred = model.predict([token_ids, segment_ids])
-        return y_pred[:, -1, :]
+        if states is None:  # 第一步输入完整序列
+            token_ids, segment_ids = inputs
+            token_ids = torch.cat([token_ids, output_ids], 1)
+            segment_ids = torch.cat([segment_ids, torch.ones_like(output_ids, device=device)], 1)
+        else:  # 后续仅输入新生成的token，历史的K/V从states中读取
+            token_ids = output_ids[:, -1:]
+            segment_ids = torch.ones_like(token_ids, device=device)
+        (_, y_pred), states = model.predict([token_ids, segment_ids], states=states, use_states=True)
+        last_index = (token_ids != 0).sum(dim=1) - 1  # 每个样本最后一个非padding的位置，兼容batch解码
+        return y_pred[torch.arange(len(last_index), device=device), last_index], states
 
     def generate(self, text, topk=1, topp=0.95):
         max_c_len = maxlen - self.maxlen
@@ -100,6 +105,18 @@ class AutoTitle(AutoRegressiveDecoder):
         output_ids = self.beam_search([token_ids, segment_ids], topk=topk)  # 基于beam search
         return tokenizer.decode(output_ids.cpu().numpy())
 
+    def batch_generate(self, texts, topk=1):
+        """多条文本一起解码，适用于离线批量生成
+        """
+        max_c_len = maxlen - self.maxlen
+        batch_token_ids, batch_segment_ids = [], []
+        for text in texts:
+            token_ids, segment_ids = tokenizer.encode(text, maxlen=max_c_len)
+            batch_token_ids.append(token_ids)
+            batch_segment_ids.append(segment_ids)
+        results = self.batch_beam_search([batch_token_ids, batch_segment_ids], topk=topk)  # 基于batch版beam search
+        return [tokenizer.decode(output_ids.cpu().numpy()) for output_ids in results]
+
 
 autotitle = AutoTitle(start_id=None, end_id=tokenizer._token_end_id, maxlen=32, device=device)
 
@@ -109,6 +126,7 @@ def just_show():
     s2 = u'8月28日，网络爆料称，华住集团旗下连锁酒店用户数据疑似发生泄露。从卖家发布的内容看，数据包含华住旗下汉庭、禧玥、桔子、宜必思等10余个品牌酒店的住客信息。泄露的信息包括华住官网注册资料、酒店入住登记的身份信息及酒店开房记录，住客姓名、手机号、邮箱、身份证号、登录账号密码等。卖家对这个约5亿条数据打包出售。第三方安全平台威胁猎人对信息出售者提供的三万条数据进行验证，认为数据真实性非常高。当天下午 ，华 住集 团发声明称，已在内部迅速开展核查，并第一时间报警。当晚，上海警方消息称，接到华住集团报案，警方已经介入调查。'
     for s in [s1, s2]:
         print(u'生成标题:', autotitle.generate(s))
+    print(u'批量生成标题:', autotitle.batch_generate([s1, s2]))
 
 class Evaluator(Callback):
     """评估与保存
@@ -94,10 +94,13 @@ model.compile(loss=CrossEntropyLoss(ignore_index=0), optimizer=optim.Adam(model.
 class AutoTitle(AutoRegressiveDecoder):
     """seq2seq解码器
     """
-    @AutoRegressiveDecoder.wraps(default_rtype='logits')
+    @AutoRegressiveDecoder.wraps(default_rtype='logits', use_states=True)
     def predict(self, inputs, output_ids, states):
         # inputs中包含了[decoder_ids, encoder_hidden_state, encoder_attention_mask]
-        return model.decoder.predict([output_ids] + inputs)[-1][:, -1, :]  # 保留最后一位
+        # 使用K/V缓存时，除第一步外仅需输入最后一个token
+        token_ids = output_ids if states is None else output_ids[:, -1:]
+        outputs, states = model.decoder.predict([token_ids] + inputs, states=states, use_states=True)
+        return outputs[-1][:, -1, :], states  # 保留最后一位
 
     def generate(self, text, topk=1):
         token_ids, _ = tokenizer.encode(text, maxlen=max_c_len)
@@ -115,17 +115,13 @@ def evaluate(data, threshold=0.5):
     X, Y, Z, threshold = 1e-10, 1e-10, 1e-10, 0
     for x_true, label in data:
         scores = model.predict(x_true)
-        for i, score in enumerate(scores):
-            R = set()
-            for l, start, end in zip(*np.where(score.cpu() > threshold)):
-                R.add((start, end, categories_id2label[l]))  
-
-            T = set()
-            for l, start, end in zip(*np.where(label[i].cpu() > threshold)):
-                T.add((start, end, categories_id2label[l]))
-            X += len(R & T)
-            Y += len(R)
-            Z += len(T)
+        # 整个batch一起解码, 每行为(batch_id, label_id, start, end)
+        spans, _ = model.global_pointer.decode(scores, x_true.gt(0).long(), threshold=threshold)
+        R = set(tuple(i) for i in spans.tolist())
+        T = set(tuple(i) for i in (label > threshold).nonzero().tolist())
+        X += len(R & T)
+        Y += len(R)
+        Z += len(T)
     f1, precision, recall = 2 * X / (Y + Z), X / Y, X / Z
     return f1, precision, recall
 
@@ -83,7 +83,8 @@ model = Model().to(device)
 model.compile(
     loss=nn.CrossEntropyLoss(),
     optimizer=optim.Adam(model.parameters(), lr=2e-5),  # 用足够小的学习率
-    use_amp=True,  # True表示使用梯度累积
+    use_amp=True,  # True表示使用混合精度
+    device_type='cuda' if torch.cuda.is_available() else 'cpu',  # cpu上使用bfloat16混合精度，不需要GradScaler
     metrics=['accuracy'],
 )
 
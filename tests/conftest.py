@@ -0,0 +1,21 @@
+import pytest
+
+
+# 随机初始化的小模型配置, 各测试中按需覆盖
+TINY_CONFIG = {
+    'vocab_size': 100,
+    'hidden_size': 32,
+    'num_hidden_layers': 2,
+    'num_attention_heads': 4,
+    'intermediate_size': 64,
+    'hidden_act': 'gelu',
+    'max_position': 64,
+    'segment_vocab_size': 2,
+    'dropout_rate': 0.0,
+    'attention_probs_dropout_prob': 0.0,
+}
+
+
+@pytest.fixture
+def tiny_config():
+    return dict(TINY_CONFIG)
@@ -0,0 +1,34 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from bert4torch.snippets import BucketBatchSampler
+
+
+def make_sampler(**kwargs):
+    lengths = [(i * 7) % 23 + 1 for i in range(200)]
+    return BucketBatchSampler(lengths=lengths, max_tokens=64, bucket_size=50, num_replicas=1, rank=0, **kwargs)
+
+
+def test_len_matches_current_iteration():
+    sampler = make_sampler()
+    for _ in range(3):
+        batches = list(iter(sampler))
+        assert len(sampler) == len(batches)
+
+
+def test_set_epoch_is_respected():
+    sampler, reference = make_sampler(), make_sampler()
+    for epoch in (0, 3, 3, 1):
+        sampler.set_epoch(epoch)
+        batches = list(sampler)
+        reference.set_epoch(epoch)
+        assert batches == reference.get_batches()
+        assert sampler.epoch == epoch
+
+
+def test_reshuffles_between_iterations_without_set_epoch():
+    sampler = make_sampler()
+    first, second = list(sampler), list(sampler)
+    assert first != second
+    assert sorted(i for b in first for i in b) == sorted(i for b in second for i in b) == list(range(200))
@@ -0,0 +1,268 @@
+import warnings
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from bert4torch.convert import convert_checkpoint, ShardedCheckpointWriter
+from bert4torch.snippets import load_checkpoint, save_sharded_state_dict, ShardedStateDict
+
+
+HIDDEN, VOCAB, MAX_POSITION, NUM_LAYERS = 8, 20, 16, 2
+
+
+# ========================= 原转换脚本的逻辑, 作为对照 =========================
+def old_convert_bert(torch_weights):
+    state_dict_new = {}
+    for k, v in torch_weights.items():
+        if 'LayerNorm.gamma' in k:
+            k = k.replace('LayerNorm.gamma', 'LayerNorm.weight')
+            state_dict_new[k] = v
+        elif 'LayerNorm.beta' in k:
+            k = k.replace('LayerNorm.beta', 'LayerNorm.bias')
+            state_dict_new[k] = v
+        else:
+            state_dict_new[k] = v
+    return state_dict_new
+
+
+def old_convert_gpt2(torch_weights, prefix, src, word_embeddings='wte', position_embeddings='wpe',
+                     emb_norm=False, ln_f=False, swap_tokens=False):
+    new_weights = {}
+    w = torch_weights[f'{src}{word_embeddings}.weight']
+    if swap_tokens:
+        w = torch.cat([w[1:2], w[:1], w[2:]], axis=0)
+    new_weights[f'{prefix}.embeddings.word_embeddings.weight'] = w
+    new_weights[f'{prefix}.embeddings.position_embeddings.weight'] = torch_weights[f'{src}{position_embeddings}.weight']
+    if emb_norm:
+        new_weights[f'{prefix}.embeddings.LayerNorm.weight'] = torch_weights['emb_norm.weight']
+        new_weights[f'{prefix}.embeddings.LayerNorm.bias'] = torch_weights['emb_norm.bias']
+
+    qkv = ['query', 'key', 'value']
+    for i in range(NUM_LAYERS):
+        prefix_i = f'{prefix}.encoder.layer.%d.' % i
+        ws = torch.chunk(torch_weights[f'{src}h.%s.attn.c_attn.weight' % i], 3, dim=1)
+        for k, w in zip(qkv, ws):
+            new_weights[prefix_i + f'attention.self.{k}.weight'] = w.T
+        bs = torch.chunk(torch_weights[f'{src}h.%s.attn.c_attn.bias' % i], 3, dim=0)
+        for k, b in zip(qkv, bs):
+            new_weights[prefix_i + f'attention.self.{k}.bias'] = b
+        new_weights[prefix_i + 'attention.output.dense.weight'] = torch_weights[f'{src}h.%s.attn.c_proj.weight' % i].T
+        new_weights[prefix_i + 'attention.output.dense.bias'] = torch_weights[f'{src}h.%s.attn.c_proj.bias' % i]
+        new_weights[prefix_i + 'attention.output.LayerNorm.weight'] = torch_weights[f'{src}h.%s.ln_1.weight' % i]
+        new_weights[prefix_i + 'attention.output.LayerNorm.bias'] = torch_weights[f'{src}h.%s.ln_1.bias' % i]
+        new_weights[prefix_i + 'intermediate.dense.weight'] = torch_weights[f'{src}h.%s.mlp.c_fc.weight' % i].T
+        new_weights[prefix_i + 'intermediate.dense.bias'] = torch_weights[f'{src}h.%s.mlp.c_fc.bias' % i]
+        new_weights[prefix_i + 'output.dense.weight'] = torch_weights[f'{src}h.%s.mlp.c_proj.weight' % i].T
+        new_weights[prefix_i + 'output.dense.bias'] = torch_weights[f'{src}h.%s.mlp.c_proj.bias' % i]
+        new_weights[prefix_i + 'output.LayerNorm.weight'] = torch_weights[f'{src}h.%s.ln_2.weight' % i]
+        new_weights[prefix_i + 'output.LayerNorm.bias'] = torch_weights[f'{src}h.%s.ln_2.bias' % i]
+        if ln_f:
+            new_weights[f'{prefix}.LayerNormFinal.weight'] = torch_weights[f'{src}ln_f.weight']
+            new_weights[f'{prefix}.LayerNormFinal.bias'] = torch_weights[f'{src}ln_f.bias']
+    return new_weights
+
+
+def old_convert_transformer_xl(torch_weights):
+    key_map = {}
+    for i in range(4):
+        key_map[f'transformer.word_emb.emb_layers.{i}.weight'] = f'embeddings.emb_layers.{i}.weight'
+        key_map[f'transformer.word_emb.emb_projs.{i}'] = f'embeddings.emb_projs.{i}'
+    for i in range(NUM_LAYERS):
+        key_map.update({
+            f'transformer.layers.{i}.dec_attn.r_r_bias': f'encoderLayer.{i}.multiHeadAttention.r_r_bias',
+            f'transformer.layers.{i}.dec_attn.r_w_bias': f'encoderLayer.{i}.multiHeadAttention.r_w_bias',
+            f'transformer.layers.{i}.dec_attn.o_net.weight': f'encoderLayer.{i}.multiHeadAttention.o.weight',
+            f'transformer.layers.{i}.dec_attn.layer_norm.weight': f'encoderLayer.{i}.layerNorm1.weight',
+            f'transformer.layers.{i}.dec_attn.layer_norm.bias': f'encoderLayer.{i}.layerNorm1.bias',
+            f'transformer.layers.{i}.dec_attn.r_net.weight': f'encoderLayer.{i}.multiHeadAttention.r.weight',
+            f'transformer.layers.{i}.pos_ff.CoreNet.0.weight': f'encoderLayer.{i}.feedForward.intermediateDense.weight',
+            f'transformer.layers.{i}.pos_ff.CoreNet.0.bias': f'encoderLayer.{i}.feedForward.intermediateDense.bias',
+            f'transformer.layers.{i}.pos_ff.CoreNet.3.weight': f'encoderLayer.{i}.feedForward.outputDense.weight',
+            f'transformer.layers.{i}.pos_ff.CoreNet.3.bias': f'encoderLayer.{i}.feedForward.outputDense.bias',
+            f'transformer.layers.{i}.pos_ff.layer_norm.weight': f'encoderLayer.{i}.layerNorm2.weight',
+            f'transformer.layers.{i}.pos_ff.layer_norm.bias': f'encoderLayer.{i}.layerNorm2.bias',
+        })
+    model_new = {value: torch_weights[key] for key, value in key_map.items()}
+    for i in range(NUM_LAYERS):
+        qkv_net = torch_weights[f'transformer.layers.{i}.dec_attn.qkv_net.weight']
+        model_new[f'encoderLayer.{i}.multiHeadAttention.q.weight'], model_new[f'encoderLayer.{i}.multiHeadAttention.k.weight'], \
+            model_new[f'encoderLayer.{i}.multiHeadAttention.v.weight'] = qkv_net.chunk(3, dim=0)
+    return model_new
+
+
+def old_bart_map():
+    '''原脚本中的{源key: 目标key}映射表(原脚本逐条列出, 这里按同样的规律生成, 层数取NUM_LAYERS)
+    '''
+    mapping = {'bart.embeddings.word_embeddings.weight': 'encoder.embed_tokens.weight',
+               'bart.embeddings.position_embeddings.weight': 'encoder.embed_positions.weight',
+               'bart.embeddings.LayerNorm.weight': 'encoder.layernorm_embedding.weight',
+               'bart.embeddings.LayerNorm.bias': 'encoder.layernorm_embedding.bias'}
+    for stack in ['encoder', 'decoder']:
+        attentions = [('attention', 'self_attn')] + ([('crossattention', 'encoder_attn')] if stack == 'decoder' else [])
+        for i in range(NUM_LAYERS):
+            src_i, tgt_i = f'bart.{stack}.{stack}_layer.{i}.', f'{stack}.layers.{i}.'
+            for name in ['weight', 'bias']:
+                for src_attn, tgt_attn in attentions:
+                    for s, t in [('query', 'q'), ('key', 'k'), ('value', 'v')]:
+                        mapping[f'{src_i}{src_attn}.self.{s}.{name}'] = f'{tgt_i}{tgt_attn}.{t}_proj.{name}'
+                    mapping[f'{src_i}{src_attn}.output.dense.{name}'] = f'{tgt_i}{tgt_attn}.out_proj.{name}'
+                    mapping[f'{src_i}{src_attn}.output.LayerNorm.{name}'] = f'{tgt_i}{tgt_attn}_layer_norm.{name}'
+                mapping[f'{src_i}intermediate.dense.{name}'] = f'{tgt_i}fc1.{name}'
+                mapping[f'{src_i}output.dense.{name}'] = f'{tgt_i}fc2.{name}'
+                mapping[f'{src_i}output.LayerNorm.{name}'] = f'{tgt_i}final_layer_norm.{name}'
+    return mapping
+
+
+def old_convert_bart(torch_weights):
+    return {value: torch_weights[key] for key, value in old_bart_map().items()}
+
+
+# ========================= 构造随机的源权重 =========================
+def randn(*shape):
+    return torch.randn(*shape)
+
+
+def make_bert_weights():
+    weights = {'bert.embeddings.word_embeddings.weight': randn(VOCAB, HIDDEN),
+               'bert.embeddings.LayerNorm.gamma': randn(HIDDEN),
+               'bert.embeddings.LayerNorm.beta': randn(HIDDEN)}
+    for i in range(NUM_LAYERS):
+        weights[f'bert.encoder.layer.{i}.attention.self.query.weight'] = randn(HIDDEN, HIDDEN)
+        weights[f'bert.encoder.layer.{i}.output.LayerNorm.gamma'] = randn(HIDDEN)
+        weights[f'bert.encoder.layer.{i}.output.LayerNorm.beta'] = randn(HIDDEN)
+    return weights
+
+
+def make_gpt2_weights(src, word_embeddings='wte', position_embeddings='wpe', emb_norm=False, ln_f=False):
+    weights = {f'{src}{word_embeddings}.weight': randn(VOCAB, HIDDEN),
+               f'{src}{position_embeddings}.weight': randn(MAX_POSITION, HIDDEN)}
+    if emb_norm:
+        weights.update({'emb_norm.weight': randn(HIDDEN), 'emb_norm.bias': randn(HIDDEN)})
+    for i in range(NUM_LAYERS):
+        weights.update({
+            f'{src}h.{i}.attn.bias': torch.tril(torch.ones(MAX_POSITION, MAX_POSITION)),  # 原脚本不转换的buffer
+            f'{src}h.{i}.attn.c_attn.weight': randn(HIDDEN, 3 * HIDDEN),
+            f'{src}h.{i}.attn.c_attn.bias': randn(3 * HIDDEN),
+            f'{src}h.{i}.attn.c_proj.weight': randn(HIDDEN, HIDDEN),
+            f'{src}h.{i}.attn.c_proj.bias': randn(HIDDEN),
+            f'{src}h.{i}.ln_1.weight': randn(HIDDEN),
+            f'{src}h.{i}.ln_1.bias': randn(HIDDEN),
+            f'{src}h.{i}.mlp.c_fc.weight': randn(HIDDEN, 4 * HIDDEN),
+            f'{src}h.{i}.mlp.c_fc.bias': randn(4 * HIDDEN),
+            f'{src}h.{i}.mlp.c_proj.weight': randn(4 * HIDDEN, HIDDEN),
+            f'{src}h.{i}.mlp.c_proj.bias': randn(HIDDEN),
+            f'{src}h.{i}.ln_2.weight': randn(HIDDEN),
+            f'{src}h.{i}.ln_2.bias': randn(HIDDEN),
+        })
+    if ln_f:
+        weights.update({f'{src}ln_f.weight': randn(HIDDEN), f'{src}ln_f.bias': randn(HIDDEN)})
+    return weights
+
+
+def make_transformer_xl_weights():
+    weights = {}
+    for i in range(4):
+        weights[f'transformer.word_emb.emb_layers.{i}.weight'] = randn(VOCAB // (i + 1), HIDDEN // (i + 1))
+        weights[f'transformer.word_emb.emb_projs.{i}'] = randn(HIDDEN, HIDDEN // (i + 1))
+    for i in range(NUM_LAYERS):
+        prefix = f'transformer.layers.{i}.'
+        weights.update({
+            prefix + 'dec_attn.qkv_net.weight': randn(3 * HIDDEN, HIDDEN),
+            prefix + 'dec_attn.r_r_bias': randn(2, HIDDEN // 2),
+            prefix + 'dec_attn.r_w_bias': randn(2, HIDDEN // 2),
+            prefix + 'dec_attn.o_net.weight': randn(HIDDEN, HIDDEN),
+            prefix + 'dec_attn.r_net.weight': randn(HIDDEN, HIDDEN),
+            prefix + 'dec_attn.layer_norm.weight': randn(HIDDEN),
+            prefix + 'dec_attn.layer_norm.bias': randn(HIDDEN),
+            prefix + 'pos_ff.CoreNet.0.weight': randn(4 * HIDDEN, HIDDEN),
+            prefix + 'pos_ff.CoreNet.0.bias': randn(4 * HIDDEN),
+            prefix + 'pos_ff.CoreNet.3.weight': randn(HIDDEN, 4 * HIDDEN),
+            prefix + 'pos_ff.CoreNet.3.bias': randn(HIDDEN),
+            prefix + 'pos_ff.layer_norm.weight': randn(HIDDEN),
+            prefix + 'pos_ff.layer_norm.bias': randn(HIDDEN),
+        })
+    weights['crit.out_layers.0.bias'] = randn(VOCAB)  # 原脚本不转换的adaptive softmax
+    return weights
+
+
+def make_bart_weights():
+    shapes = {'weight': (HIDDEN, HIDDEN), 'bias': (HIDDEN,)}
+    return {key: randn(*shapes[key.rsplit('.', 1)[-1]]) for key in old_bart_map()}
+
+
+# 规则名: (构造源权重, 原脚本的转换逻辑)
+CASES = {
+    'bert': (make_bert_weights, old_convert_bert),
+    'gpt2': (lambda: make_gpt2_weights('transformer.', ln_f=True),
+             lambda w: old_convert_gpt2(w, 'gpt2', 'transformer.', ln_f=True)),
+    'gpt2_ml': (lambda: make_gpt2_weights('', emb_norm=True),
+                lambda w: old_convert_gpt2(w, 'gpt2_ml', '', emb_norm=True)),
+    'cdial_gpt': (lambda: make_gpt2_weights('transformer.', 'tokens_embed', 'positions_embed'),
+                  lambda w: old_convert_gpt2(w, 'gpt', 'transformer.', 'tokens_embed', 'positions_embed', swap_tokens=True)),
+    'transformer_xl': (make_transformer_xl_weights, old_convert_transformer_xl),
+    'bart_cloudwalk': (make_bart_weights, old_convert_bart),
+}
+
+
+def assert_same_state_dict(converted, expected):
+    assert set(converted.keys()) == set(expected.keys())
+    for key, value in expected.items():
+        assert converted[key].shape == value.shape, key
+        assert converted[key].dtype == value.dtype, key
+        assert torch.equal(converted[key], value), key
+
+
+@pytest.mark.parametrize('max_shard_size', [None, '1KB'])
+@pytest.mark.parametrize('name', sorted(CASES))
+def test_convert_matches_old_scripts(tmp_path, name, max_shard_size):
+    torch.manual_seed(0)
+    make_weights, old_convert = CASES[name]
+    source = make_weights()
+    ckpt_file = str(tmp_path / 'pytorch_model.bin')
+    torch.save(source, ckpt_file)
+    expected = old_convert(torch.load(ckpt_file))
+
+    output_file = str(tmp_path / 'bert4torch_pytorch_model.bin')
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')  # 原脚本同样跳过的key只做警告
+        saved_file = convert_checkpoint(ckpt_file, output_file, name, max_shard_size=max_shard_size)
+    if max_shard_size is None:
+        assert saved_file == output_file
+    else:
+        assert saved_file == output_file + '.index.json'
+
+    converted = load_checkpoint(output_file)
+    assert_same_state_dict({k: converted[k] for k in converted}, expected)
+
+
+def test_convert_strict_rejects_unmatched_keys(tmp_path):
+    ckpt_file = str(tmp_path / 'pytorch_model.bin')
+    torch.save(make_gpt2_weights('transformer.'), ckpt_file)
+    with pytest.raises(ValueError):
+        convert_checkpoint(ckpt_file, str(tmp_path / 'out.bin'), 'gpt2', max_shard_size=None, strict=True)
+
+
+def test_sharded_writer_round_trips_through_sharded_state_dict(tmp_path):
+    torch.manual_seed(0)
+    state_dict = {f'encoder.layer.{i}.attention.{k}.weight': randn(HIDDEN, HIDDEN) for i in range(3) for k in 'qkv'}
+    save_path = str(tmp_path / 'model.bin')
+    writer = ShardedCheckpointWriter(save_path, max_shard_size=3 * HIDDEN * HIDDEN * 4)
+    for name, tensor in state_dict.items():
+        writer.add(name, tensor)
+    index_file = writer.close()
+
+    assert index_file == save_path + '.index.json'
+    sharded = ShardedStateDict(index_file)
+    assert sorted(set(sharded.weight_map.values())) == [f'model-{i:05d}-of-00003.bin' for i in range(1, 4)]
+    assert not list(tmp_path.glob('*.tmp'))
+    # 同一层的q/k/v在同一个分片中
+    for i in range(3):
+        assert len({sharded.weight_map[f'encoder.layer.{i}.attention.{k}.weight'] for k in 'qkv'}) == 1
+    assert_same_state_dict({k: sharded[k] for k in sharded}, state_dict)
+
+    # 与save_sharded_state_dict的命名和索引格式一致
+    other_path = str(tmp_path / 'other.bin')
+    other_index = save_sharded_state_dict(state_dict, other_path, max_shard_size=3 * HIDDEN * HIDDEN * 4)
+    other = ShardedStateDict(other_index)
+    assert {k: v.replace('other', 'model') for k, v in other.weight_map.items()} == sharded.weight_map
+    assert_same_state_dict({k: other[k] for k in other}, state_dict)
@@ -0,0 +1,99 @@
+import itertools
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from bert4torch.layers import CRF
+
+
+NUM_LABELS, LENGTHS = 3, [4, 2, 1, 3]
+
+
+def make_inputs():
+    torch.manual_seed(0)
+    crf = CRF(NUM_LABELS)
+    with torch.no_grad():
+        crf.transitions.normal_()
+        crf.transitions[:, crf.START_TAG_IDX] = -10000.0
+        crf.transitions[crf.END_TAG_IDX, :] = -10000.0
+    tag_size = NUM_LABELS + 2
+    feats = torch.randn(len(LENGTHS), max(LENGTHS), tag_size)
+    mask = torch.zeros(len(LENGTHS), max(LENGTHS), dtype=torch.long)
+    tags = torch.zeros(len(LENGTHS), max(LENGTHS), dtype=torch.long)
+    for i, length in enumerate(LENGTHS):
+        mask[i, :length] = 1
+        tags[i, :length] = torch.randint(0, NUM_LABELS, (length,))
+    return crf, feats, mask, tags
+
+
+# ========================= 逐样本、逐时间步的参考实现 =========================
+def path_score(crf, feats, path):
+    '''单个样本的路径分数: START->t0, 各位置的发射分数, 相邻tag的转移分数, t_{L-1}->END
+    '''
+    transitions = crf.transitions
+    score = transitions[crf.START_TAG_IDX, path[0]] + transitions[path[-1], crf.END_TAG_IDX]
+    for idx, tag in enumerate(path):
+        score = score + feats[idx, tag]
+        if idx > 0:
+            score = score + transitions[path[idx - 1], tag]
+    return score
+
+
+def all_path_scores(crf, feats, length):
+    '''枚举长度为length的全部路径(小规模时可行)
+    '''
+    tag_size = feats.size(-1)
+    paths = list(itertools.product(range(tag_size), repeat=length))
+    return paths, torch.stack([path_score(crf, feats, path) for path in paths])
+
+
+def test_forward_alg_matches_reference():
+    crf, feats, mask, _ = make_inputs()
+    expected = sum(torch.logsumexp(all_path_scores(crf, feats[i], length)[1], dim=0) for i, length in enumerate(LENGTHS))
+    torch.testing.assert_close(crf._forward_alg(feats, mask), expected, rtol=1e-5, atol=1e-4)
+
+
+def test_score_sentence_matches_reference():
+    crf, feats, mask, tags = make_inputs()
+    expected = sum(path_score(crf, feats[i], tags[i, :length].tolist()) for i, length in enumerate(LENGTHS))
+    torch.testing.assert_close(crf._score_sentence(feats, mask, tags), expected, rtol=1e-5, atol=1e-4)
+
+
+def test_neg_log_likelihood_gradients_match_reference():
+    crf, feats, mask, tags = make_inputs()
+    feats.requires_grad_(True)
+    crf.neg_log_likelihood_loss(feats, mask, tags).backward()
+    grads = feats.grad.clone(), crf.transitions.grad.clone()
+
+    feats.grad, crf.transitions.grad = None, None
+    loss = 0
+    for i, length in enumerate(LENGTHS):
+        _, scores = all_path_scores(crf, feats[i], length)
+        loss = loss + torch.logsumexp(scores, dim=0) - path_score(crf, feats[i], tags[i, :length].tolist())
+    (loss / len(LENGTHS)).backward()
+    torch.testing.assert_close(grads[0], feats.grad, rtol=1e-4, atol=1e-5)
+    torch.testing.assert_close(grads[1], crf.transitions.grad, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize('nbest', [1, 3])
+def test_viterbi_decode_matches_reference(nbest):
+    crf, feats, mask, _ = make_inputs()
+    paths, scores = crf._viterbi_decode(feats, mask, nbest=nbest)
+    assert paths.shape == (len(LENGTHS), nbest, max(LENGTHS))
+    for i, length in enumerate(LENGTHS):
+        all_paths, all_scores = all_path_scores(crf, feats[i], length)
+        best_scores, best_indices = all_scores.topk(nbest)
+        torch.testing.assert_close(scores[i], best_scores, rtol=1e-5, atol=1e-4)
+        for k, index in enumerate(best_indices.tolist()):
+            assert paths[i, k, :length].tolist() == list(all_paths[index])
+            assert paths[i, k, length:].eq(0).all()
+
+
+def test_forward_returns_best_path():
+    '''forward在nbest=1时返回[bts, seq_len]的最优路径
+    '''
+    crf, feats, mask, _ = make_inputs()
+    paths, scores = crf._viterbi_decode(feats, mask, nbest=1)
+    best_paths, best_scores = crf(feats, mask, return_scores=True)
+    assert torch.equal(best_paths, paths[:, 0])
+    torch.testing.assert_close(best_scores, scores[:, 0])
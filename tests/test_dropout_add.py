@@ -0,0 +1,24 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from bert4torch.layers import dropout_add
+
+
+def test_inplace_when_dtype_matches():
+    x, residual = torch.randn(2, 3), torch.randn(2, 3)
+    expected = x + residual
+    with torch.no_grad():
+        output = dropout_add(x, residual, p=0.1, training=False)
+    assert output is x
+    torch.testing.assert_close(output, expected)
+
+
+def test_keeps_fp32_residual_for_half_inputs():
+    '''autocast下x为半精度、residual为fp32时不原地加, 结果保持fp32
+    '''
+    x, residual = torch.randn(2, 3).to(torch.bfloat16), torch.randn(2, 3) + 1e-3
+    with torch.no_grad():
+        output = dropout_add(x, residual, p=0.1, training=False)
+    assert output.dtype == torch.float32
+    torch.testing.assert_close(output, x.float() + residual)
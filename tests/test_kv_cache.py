@@ -0,0 +1,81 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from bert4torch.models import build_transformer_model
+
+
+def build_lm(tiny_config, model, application, attn_impl):
+    torch.manual_seed(0)
+    configs = dict(tiny_config, segment_vocab_size=0, attn_impl=attn_impl)
+    if model == 'gpt2':
+        configs['final_activation'] = 'linear'
+    return build_transformer_model(**configs, model=model, application=application).eval()
+
+
+def last_logits(output):
+    output = output[-1] if isinstance(output, (list, tuple)) else output  # bert+lm时为[hidden_states, mlm_scores]
+    return output[:, -1]
+
+
+def greedy_uncached(model, token_ids, steps):
+    logits = []
+    for _ in range(steps):
+        logit = last_logits(model.predict([token_ids]))
+        logits.append(logit)
+        token_ids = torch.cat([token_ids, logit.argmax(dim=-1, keepdim=True)], dim=1)
+    return torch.stack(logits, dim=1), token_ids
+
+
+def greedy_cached(model, token_ids, steps):
+    logits = []
+    output, states = model.predict([token_ids], states=None, use_states=True)
+    for step in range(steps):
+        logit = last_logits(output)
+        logits.append(logit)
+        next_ids = logit.argmax(dim=-1, keepdim=True)
+        token_ids = torch.cat([token_ids, next_ids], dim=1)
+        if step < steps - 1:
+            output, states = model.predict([next_ids], states=states, use_states=True)
+    return torch.stack(logits, dim=1), token_ids
+
+
+@pytest.mark.parametrize('attn_impl', [None, 'sdpa'])
+@pytest.mark.parametrize('model,application', [('gpt2', 'encoder'), ('bert', 'lm')])
+def test_cached_greedy_decode_matches_uncached(tiny_config, model, application, attn_impl):
+    lm = build_lm(tiny_config, model, application, attn_impl)
+    token_ids = torch.randint(1, tiny_config['vocab_size'], (2, 5))
+
+    uncached_logits, uncached_ids = greedy_uncached(lm, token_ids, steps=6)
+    cached_logits, cached_ids = greedy_cached(lm, token_ids, steps=6)
+    assert torch.equal(cached_ids, uncached_ids)
+    torch.testing.assert_close(cached_logits, uncached_logits, rtol=1e-5, atol=1e-5)
+
+
+def test_interleaved_decoders_do_not_share_states(tiny_config):
+    '''两个解码过程交替使用同一个模型, 结果与各自单独解码一致
+    '''
+    lm = build_lm(tiny_config, 'gpt2', 'encoder', None)
+    prompts = [torch.randint(1, tiny_config['vocab_size'], (1, length)) for length in (3, 7)]
+    expected = [greedy_uncached(lm, prompt, steps=4)[0] for prompt in prompts]
+
+    outputs, states, logits = [None, None], [None, None], [[], []]
+    for i, prompt in enumerate(prompts):
+        outputs[i], states[i] = lm.predict([prompt], states=None, use_states=True)
+    for _ in range(4):
+        for i in range(2):
+            logit = last_logits(outputs[i])
+            logits[i].append(logit)
+            outputs[i], states[i] = lm.predict([logit.argmax(dim=-1, keepdim=True)], states=states[i], use_states=True)
+    for i in range(2):
+        torch.testing.assert_close(torch.stack(logits[i], dim=1), expected[i], rtol=1e-5, atol=1e-5)
+
+
+def test_forward_argcount_keeps_list_inputs(tiny_config):
+    '''states/use_states为keyword-only, predict/train_step仍以列表整体传入forward
+    '''
+    lm = build_lm(tiny_config, 'gpt2', 'encoder', None)
+    assert lm.forward.__code__.co_argcount == 2
+    token_ids = torch.randint(1, tiny_config['vocab_size'], (2, 4))
+    output = lm.predict([token_ids])
+    assert output.shape == (2, 4, tiny_config['vocab_size'])
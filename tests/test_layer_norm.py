@@ -0,0 +1,51 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from bert4torch.layers import LayerNorm
+
+
+def reference_layer_norm(ln, inputs, cond=None):
+    '''逐步计算的layernorm/条件layernorm, 均值方差在fp32下计算
+    '''
+    hidden = inputs.float()
+    u = hidden.mean(-1, keepdim=True)
+    s = (hidden - u).pow(2).mean(-1, keepdim=True)
+    o = ((hidden - u) / torch.sqrt(s + ln.eps)).to(inputs.dtype)
+    if cond is None:
+        return ln.weight * o + ln.bias
+    for _ in range(inputs.dim() - cond.dim()):
+        cond = cond.unsqueeze(dim=1)
+    return (ln.weight + ln.dense1(cond)) * o + (ln.bias + ln.dense2(cond))
+
+
+def make_conditional_layer_norm(hidden_size=16, conditional_size=8):
+    torch.manual_seed(0)
+    ln = LayerNorm(hidden_size, eps=1e-12, conditional_size=conditional_size)
+    with torch.no_grad():  # 默认全零初始化, 随机化后条件部分才会影响输出
+        for param in ln.parameters():
+            param.normal_()
+    return ln
+
+
+@pytest.mark.parametrize('cond_shape', [(2, 8), (2, 5, 8)])
+def test_conditional_layer_norm_matches_reference(cond_shape):
+    ln = make_conditional_layer_norm()
+    inputs, cond = torch.randn(2, 5, 16), torch.randn(*cond_shape)
+    torch.testing.assert_close(ln([inputs, cond]), reference_layer_norm(ln, inputs, cond))
+
+
+def test_conditional_layer_norm_half_inputs():
+    '''bf16输入时均值方差在fp32下计算, 条件部分仍使用传入的cond
+    '''
+    ln = make_conditional_layer_norm()
+    inputs, cond = torch.randn(2, 5, 16).to(torch.bfloat16), torch.randn(2, 8)
+    torch.testing.assert_close(ln([inputs, cond]), reference_layer_norm(ln, inputs, cond))
+
+
+def test_layer_norm_matches_reference():
+    ln = LayerNorm(16, eps=1e-12)
+    with torch.no_grad():
+        ln.weight.normal_(), ln.bias.normal_()
+    inputs = torch.randn(2, 5, 16)
+    torch.testing.assert_close(ln([inputs]), reference_layer_norm(ln, inputs))
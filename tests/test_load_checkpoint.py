@@ -0,0 +1,58 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from bert4torch.models import build_transformer_model
+
+
+def save_raw_checkpoint(model, path, skip_prefixes=()):
+    '''按variable_mapping中原始的key保存checkpoint, 跳过skip_prefixes开头的权重
+    '''
+    state_dict = model.state_dict()
+    raw_state_dict = {old_key: state_dict[new_key].clone() for new_key, old_key in model.variable_mapping().items()
+                      if (new_key in state_dict) and not new_key.startswith(skip_prefixes)}
+    torch.save(raw_state_dict, path)
+
+
+def test_skip_init_initializes_mapped_weights_missing_from_checkpoint(tmp_path, tiny_config):
+    torch.manual_seed(0)
+    source = build_transformer_model(**tiny_config, with_pool=True)
+    checkpoint = str(tmp_path / 'pytorch_model.bin')
+    save_raw_checkpoint(source, checkpoint, skip_prefixes=('pooler.',))
+
+    model = build_transformer_model(checkpoint_path=checkpoint, **tiny_config, with_pool=True, skip_init=True)
+    state_dict = model.state_dict()
+    for key, value in source.state_dict().items():
+        if not key.startswith('pooler.'):
+            assert torch.equal(state_dict[key], value), key
+
+    # pooler在mapping中但checkpoint中没有, 需按init_model_weights的规则初始化, 而不是保留torch.empty的内容
+    assert torch.equal(model.pooler.bias, torch.zeros_like(model.pooler.bias))
+    assert torch.isfinite(model.pooler.weight).all()
+    assert 0.01 < model.pooler.weight.std().item() < 0.03
+
+
+def test_load_weights_reports_missing_keys(tmp_path, tiny_config):
+    source = build_transformer_model(**tiny_config, with_pool=True)
+    checkpoint = str(tmp_path / 'pytorch_model.bin')
+    save_raw_checkpoint(source, checkpoint, skip_prefixes=('pooler.',))
+
+    model = build_transformer_model(**tiny_config, with_pool=True)
+    missing_keys = model.load_weights_from_pytorch_checkpoint(checkpoint)
+    assert missing_keys == {'pooler.weight', 'pooler.bias'}
+
+
+def test_tied_weights_are_not_reported_missing(tmp_path, tiny_config, capsys):
+    '''gpt2的dense.weight和word_embeddings共享, 从word_embeddings加载后不应作为缺失的权重
+    '''
+    configs = dict(tiny_config, segment_vocab_size=0)
+    source = build_transformer_model(**configs, model='gpt2', with_lm=True)
+    checkpoint = str(tmp_path / 'pytorch_model.bin')
+    save_raw_checkpoint(source, checkpoint)
+
+    model = build_transformer_model(**configs, model='gpt2', with_lm=True)
+    capsys.readouterr()
+    missing_keys = model.load_weights_from_pytorch_checkpoint(checkpoint)
+    assert missing_keys == set()
+    assert 'not loaded' not in capsys.readouterr().out
+    assert torch.equal(model.dense.weight, source.embeddings.word_embeddings.weight)
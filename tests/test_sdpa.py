@@ -0,0 +1,61 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from bert4torch.models import build_transformer_model
+
+
+def build_pair(tiny_config, **kwargs):
+    '''构建eager和sdpa两个模型, sdpa模型通过load_state_dict加载eager模型的权重(q/k/v合并为qkv)
+    '''
+    torch.manual_seed(0)
+    eager = build_transformer_model(**tiny_config, **kwargs).eval()
+    sdpa = build_transformer_model(**tiny_config, attn_impl='sdpa', **kwargs).eval()
+    sdpa.load_state_dict(eager.state_dict())
+    return eager, sdpa
+
+
+def make_inputs(vocab_size):
+    token_ids = torch.randint(1, vocab_size, (3, 10))
+    token_ids[0, 6:] = 0
+    token_ids[2, 2:] = 0
+    segment_ids = torch.zeros_like(token_ids)
+    segment_ids[:, 5:] = 1
+    return [token_ids, segment_ids]
+
+
+@pytest.mark.parametrize('application', ['encoder', 'unilm'])
+def test_sdpa_matches_eager(tiny_config, application):
+    eager, sdpa = build_pair(tiny_config, application=application)
+    inputs = make_inputs(tiny_config['vocab_size'])
+    mask = (inputs[0] > 0).unsqueeze(-1).float()
+    with torch.no_grad():
+        eager_output, sdpa_output = eager(inputs), sdpa(inputs)
+    if isinstance(eager_output, (list, tuple)):
+        eager_output, sdpa_output = eager_output[0], sdpa_output[0]
+    torch.testing.assert_close(sdpa_output * mask, eager_output * mask, rtol=1e-5, atol=1e-5)
+
+
+def test_sdpa_state_dict_round_trip(tiny_config):
+    eager, sdpa = build_pair(tiny_config)
+    eager_state_dict, sdpa_state_dict = eager.state_dict(), sdpa.state_dict()
+
+    # 保存时qkv拆分为q/k/v, 与eager的key和数值一致
+    assert set(sdpa_state_dict.keys()) == set(eager_state_dict.keys())
+    assert not any('qkv' in key for key in sdpa_state_dict)
+    for key, value in eager_state_dict.items():
+        assert torch.equal(sdpa_state_dict[key], value), key
+
+    # 再加载回eager模型, 权重不变
+    torch.manual_seed(1)
+    other = build_transformer_model(**tiny_config).eval()
+    other.load_state_dict(sdpa_state_dict)
+    for key, value in other.state_dict().items():
+        assert torch.equal(value, eager_state_dict[key]), key
+
+    # sdpa模型间直接加载
+    torch.manual_seed(1)
+    other_sdpa = build_transformer_model(**tiny_config, attn_impl='sdpa').eval()
+    other_sdpa.load_state_dict(sdpa_state_dict)
+    qkv_weight = other_sdpa.encoderLayer[0].multiHeadAttention.qkv.weight
+    assert torch.equal(qkv_weight, sdpa.encoderLayer[0].multiHeadAttention.qkv.weight)
@@ -0,0 +1,38 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from bert4torch.models import build_transformer_model
+
+
+def build_t5(tiny_config):
+    torch.manual_seed(0)
+    configs = dict(tiny_config, segment_vocab_size=0, relative_attention_num_buckets=8)
+    return build_transformer_model(**configs, model='t5').eval()
+
+
+@pytest.mark.parametrize('stack', ['encoder', 'decoder'])
+def test_position_bias_slice_matches_full(tiny_config, stack):
+    '''增量解码时只计算最后query_len行, 与完整偏置的对应切片一致
+    '''
+    t5 = build_t5(tiny_config)
+    layers = t5.encoder.encoderLayer if stack == 'encoder' else t5.decoder.decoderLayer
+    attention = layers[0].multiHeadAttention
+    with torch.no_grad():
+        full = attention.get_position_bias(9, 9)
+        for query_len in (1, 3):
+            torch.testing.assert_close(attention.get_position_bias(query_len, 9), full[:, :, -query_len:])
+        # 解码步不会覆盖完整序列的缓存
+        assert attention.get_position_bias(9, 9) is full
+
+
+def test_relative_positions_shared_and_not_saved(tiny_config):
+    t5 = build_t5(tiny_config)
+    for layers in (t5.encoder.encoderLayer, t5.decoder.decoderLayer):
+        assert all(layer.multiHeadAttention.relative_positions is layers[0].multiHeadAttention.relative_positions for layer in layers)
+
+    state_dict = t5.state_dict()
+    assert not [k for k in state_dict if k.endswith('relative_position')]
+    # 旧版本保存的权重中每层都有relative_position, 仍可严格加载
+    state_dict['decoder.decoderLayer.1.multiHeadAttention.relative_positions.relative_position'] = torch.zeros(1, dtype=torch.long)
+    t5.load_state_dict(state_dict)
@@ -0,0 +1,60 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from bert4torch.models import build_transformer_model
+
+
+def make_token_ids(lengths, seq_len, vocab_size):
+    '''按lengths生成右侧padding(0)的token_ids
+    '''
+    token_ids = torch.zeros(len(lengths), seq_len, dtype=torch.long)
+    for i, length in enumerate(lengths):
+        token_ids[i, :length] = torch.randint(1, vocab_size, (length,))
+    return token_ids
+
+
+def run_step(model, inputs, mask):
+    model.zero_grad()
+    output = model(inputs)
+    (output * mask).pow(2).sum().backward()
+    grads = {name: param.grad.clone() for name, param in model.named_parameters() if param.grad is not None}
+    return output.detach(), grads
+
+
+@pytest.mark.parametrize('lengths', [[5, 12, 1, 9], [12, 12, 12, 12]])
+def test_unpad_matches_padded_outputs_and_grads(tiny_config, lengths):
+    torch.manual_seed(0)
+    model = build_transformer_model(**tiny_config).eval()
+    token_ids = make_token_ids(lengths, 12, tiny_config['vocab_size'])
+    segment_ids = torch.zeros_like(token_ids)
+    mask = (token_ids > 0).unsqueeze(-1).float()
+
+    model.unpad = False
+    padded_output, padded_grads = run_step(model, [token_ids, segment_ids], mask)
+    model.unpad = True
+    unpad_output, unpad_grads = run_step(model, [token_ids, segment_ids], mask)
+
+    # 有效位置的输出一致, unpad时padding位置为0
+    torch.testing.assert_close(unpad_output * mask, padded_output * mask, rtol=1e-5, atol=1e-5)
+    assert torch.all(unpad_output[mask.squeeze(-1) == 0] == 0)
+    assert padded_grads.keys() == unpad_grads.keys()
+    for name in padded_grads:
+        torch.testing.assert_close(unpad_grads[name], padded_grads[name], rtol=1e-4, atol=1e-5, msg=name)
+
+
+def test_unpad_all_encoded_layers(tiny_config):
+    torch.manual_seed(0)
+    model = build_transformer_model(**tiny_config, output_all_encoded_layers=True).eval()
+    token_ids = make_token_ids([3, 8, 6], 8, tiny_config['vocab_size'])
+    inputs = [token_ids, torch.zeros_like(token_ids)]
+    mask = (token_ids > 0).unsqueeze(-1).float()
+
+    with torch.no_grad():
+        model.unpad = False
+        padded_layers = model(inputs)
+        model.unpad = True
+        unpad_layers = model(inputs)
+    assert len(padded_layers) == len(unpad_layers) == tiny_config['num_hidden_layers'] + 1
+    for padded, unpad in zip(padded_layers, unpad_layers):
+        torch.testing.assert_close(unpad * mask, padded * mask, rtol=1e-5, atol=1e-5)